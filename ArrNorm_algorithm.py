@@ -24,9 +24,8 @@ from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessingAlgorithm, QgsProcessingParameterDefinition,
                        QgsProcessingParameterRasterDestination, QgsProcessingParameterNumber,
-                       QgsProcessingParameterRasterLayer, QgsProcessingParameterBoolean)
-
-from ArrNorm.core.arrnorm import Normalization
+                       QgsProcessingParameterRasterLayer, QgsProcessingParameterBoolean,
+                       QgsProcessingParameterFile, QgsProcessingParameterEnum)
 
 
 class ArrNormAlgorithm(QgsProcessingAlgorithm):
@@ -50,6 +49,15 @@ class ArrNormAlgorithm(QgsProcessingAlgorithm):
     NODATA_MASK = 'NODATA_MASK'
     NODATA_MASK_VALUE = 'NODATA_MASK_VALUE'
     KEEP_MASK_LAYER = 'KEEP_MASK_LAYER'
+    REGISTER_TARGET = 'REGISTER_TARGET'
+    CACHE_DIR = 'CACHE_DIR'
+    CACHE_MAX_SIZE = 'CACHE_MAX_SIZE'
+    MEMORY_BUDGET = 'MEMORY_BUDGET'
+    OUTPUT_FORMAT = 'OUTPUT_FORMAT'
+    SCALED_OUTPUT = 'SCALED_OUTPUT'
+    SAVE_COEFFICIENTS = 'SAVE_COEFFICIENTS'
+    CHANGE_MAP = 'CHANGE_MAP'
+    TILES = 'TILES'
     OUTPUT = 'OUTPUT'
 
     # Value-less parameters used only to render section headers in the dialog.
@@ -83,7 +91,26 @@ class ArrNormAlgorithm(QgsProcessingAlgorithm):
         normalized output.</p>
 
         <p>If the reference and target images are not on the same pixel grid, the reference is \
-        automatically reprojected and clipped to match the target before processing.</p>
+        automatically reprojected and clipped to match the target before processing. If the two \
+        images are misaligned by a few pixels, enable <b>co-registration</b>: the shift is estimated \
+        once (and remembered for the same image pair) and applied virtually to the target, without \
+        writing a resampled copy.</p>
+
+        <p>The normalized output keeps the data type of the input images by default. For float \
+        inputs, the <b>output data type</b> option can store UInt16/Int16 codes instead, with a \
+        per-band scale/offset chosen from the regression and the target's range (the quantization \
+        error is logged per band). This makes the output 2–4× smaller.</p>
+
+        <p>The <b>memory budget</b> (advanced) bounds the memory of a run: block sizes, the number of \
+        stages running side by side and whether IR-MAD keeps both images in RAM across its iterations \
+        (instead of re-reading them from disk) are derived from it and the image size, and a stage \
+        whose resident memory exceeds it is reported with a warning in the log. 0 keeps the \
+        fixed defaults.</p>
+
+        <p><b>Save the RadCal coefficients</b> (advanced) writes the per-band intercept, slope, \
+        correlation and no-change pixel count next to the output as <i>&lt;output&gt;_radcal.json</i>. \
+        The <i>Apply saved normalization coefficients</i> algorithm applies them to other rasters \
+        (e.g. the full scene or a reprocessed product) in seconds, without running IR-MAD again.</p>
 
         <p><b>&#9888; Nodata masking is strongly recommended when nodata pixels are present.</b> \
         Nodata values are arbitrary fill numbers that do not represent actual surface reflectance. \
@@ -269,6 +296,15 @@ class ArrNormAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.REGISTER_TARGET,
+                self.tr('Co-register target to reference before normalization (whole-pixel shift)'),
+                defaultValue=False,
+                optional=True
+            )
+        )
+
         # =====================================================================
         # Advanced: algorithm tuning
         # =====================================================================
@@ -306,6 +342,100 @@ class ArrNormAlgorithm(QgsProcessingAlgorithm):
         parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
         self.addParameter(parameter)
 
+        parameter = \
+            QgsProcessingParameterFile(
+                self.CACHE_DIR,
+                self.tr('Cache directory for intermediate results (reused on reruns)'),
+                behavior=QgsProcessingParameterFile.Behavior.Folder,
+                optional=True
+            )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(parameter)
+
+        parameter = \
+            QgsProcessingParameterNumber(
+                self.CACHE_MAX_SIZE,
+                self.tr('Maximum cache size (GB)'),
+                type=QgsProcessingParameterNumber.Type.Double,
+                minValue=0.1,
+                defaultValue=5,
+                optional=True
+            )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(parameter)
+
+        parameter = \
+            QgsProcessingParameterNumber(
+                self.MEMORY_BUDGET,
+                self.tr('Memory budget (GB, 0 = no limit)'),
+                type=QgsProcessingParameterNumber.Type.Double,
+                minValue=0,
+                defaultValue=0,
+                optional=True
+            )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(parameter)
+
+        parameter = \
+            QgsProcessingParameterEnum(
+                self.OUTPUT_FORMAT,
+                self.tr('Output format'),
+                options=[self.tr('GeoTIFF'),
+                         self.tr('Cloud-Optimized GeoTIFF (tiled, compressed, with overviews)')],
+                defaultValue=0,
+                optional=True
+            )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(parameter)
+
+        parameter = \
+            QgsProcessingParameterEnum(
+                self.SCALED_OUTPUT,
+                self.tr('Output data type'),
+                options=[self.tr('Same as the input images'),
+                         self.tr('UInt16 with scale/offset'),
+                         self.tr('Int16 with scale/offset')],
+                defaultValue=0,
+                optional=True
+            )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(parameter)
+
+        parameter = \
+            QgsProcessingParameterBoolean(
+                self.SAVE_COEFFICIENTS,
+                self.tr('Save the RadCal coefficients next to the output (<output>_radcal.json)'),
+                defaultValue=False,
+                optional=True
+            )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(parameter)
+
+        parameter = \
+            QgsProcessingParameterEnum(
+                self.CHANGE_MAP,
+                self.tr('Change map next to the output (<output>_change.tif)'),
+                options=[self.tr('None'),
+                         self.tr('No-change probability (UInt8)'),
+                         self.tr('Binary change mask')],
+                defaultValue=0,
+                optional=True
+            )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(parameter)
+
+        parameter = \
+            QgsProcessingParameterNumber(
+                self.TILES,
+                self.tr('Tiles per side for a spatially adaptive normalization (0 = one global fit)'),
+                type=QgsProcessingParameterNumber.Type.Integer,
+                minValue=0,
+                defaultValue=0,
+                optional=True
+            )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(parameter)
+
         # =====================================================================
         # Output
         # =====================================================================
@@ -321,6 +451,9 @@ class ArrNormAlgorithm(QgsProcessingAlgorithm):
         """
         Here is where the processing itself takes place.
         """
+        # Imported here, not at module level: it loads GDAL, NumPy and SciPy,
+        # which QGIS would otherwise pay for at startup when the provider loads.
+        from ArrNorm.core.arrnorm import Normalization
 
         def get_inputfilepath(layer):
             source = layer.source()
@@ -359,8 +492,17 @@ class ArrNormAlgorithm(QgsProcessingAlgorithm):
             nodata_mask=self.parameterAsBoolean(parameters, self.NODATA_MASK, context),
             nodata_mask_value=nodata_mask_value,
             keep_mask_layer=self.parameterAsBoolean(parameters, self.KEEP_MASK_LAYER, context),
+            register_target=self.parameterAsBoolean(parameters, self.REGISTER_TARGET, context),
             output_file=output_file,
-            feedback=feedback)
+            feedback=feedback,
+            cache_dir=self.parameterAsString(parameters, self.CACHE_DIR, context) or None,
+            cache_max_bytes=int((self.parameterAsDouble(parameters, self.CACHE_MAX_SIZE, context) or 5) * 1024 ** 3),
+            output_format=('GTiff', 'COG')[self.parameterAsEnum(parameters, self.OUTPUT_FORMAT, context)],
+            scaled_output=(None, 'UInt16', 'Int16')[self.parameterAsEnum(parameters, self.SCALED_OUTPUT, context)],
+            memory_budget=int(self.parameterAsDouble(parameters, self.MEMORY_BUDGET, context) * 1024 ** 3) or None,
+            save_coefficients=self.parameterAsBoolean(parameters, self.SAVE_COEFFICIENTS, context),
+            change_map=(None, 'ncp', 'mask')[self.parameterAsEnum(parameters, self.CHANGE_MAP, context)],
+            tiles=self.parameterAsInt(parameters, self.TILES, context) or None)
 
         arrnorm.run()
 
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ArrNorm
+                          A QGIS plugin processing
+ Automatic relative radiometric normalization
+                              -------------------
+        copyright            : (C) 2021-2026 by Xavier Corredor Llano, SMByC
+        email                : xavier.corredor.llano@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+
+from qgis.PyQt.QtGui import QIcon
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingException,
+                       QgsProcessingParameterMultipleLayers, QgsProcessingParameterFile,
+                       QgsProcessingParameterFolderDestination, QgsProcessingParameterNumber,
+                       QgsProcessingOutputMultipleLayers)
+
+
+class ArrNormApplyAlgorithm(QgsProcessingAlgorithm):
+    """
+    Apply the RadCal coefficients saved by a normalization run to other
+    rasters, without running IR-MAD again
+    """
+
+    INPUT = 'INPUT'
+    COEFFICIENTS = 'COEFFICIENTS'
+    WORKERS = 'WORKERS'
+    OUTPUT_DIR = 'OUTPUT_DIR'
+    OUTPUTS = 'OUTPUTS'
+
+    def tr(self, string, context=''):
+        if context == '':
+            context = self.__class__.__name__
+        return QCoreApplication.translate(context, string)
+
+    def shortHelpString(self):
+        html_help = '''
+        <p>Applies the per-band linear normalization (intercept + slope × value) of a previous \
+        ArrNorm run to any number of rasters, e.g. the full scene of a clipped target or a \
+        reprocessed product of the same sensor. The coefficients are read from the \
+        <i>&lt;output&gt;_radcal.json</i> file written with the <b>Save the RadCal coefficients</b> \
+        option; no IR-MAD is run, so each raster takes a single streaming pass.</p>
+
+        <p>Every input raster is written to the output folder as <i>&lt;name&gt;_norm</i>, with the \
+        data type (or the scale/offset codes) of the original normalized output. Nodata pixels of \
+        the inputs stay nodata. Several rasters are processed side by side.</p>
+        '''
+        return html_help
+
+    def createInstance(self):
+        return ArrNormApplyAlgorithm()
+
+    def name(self):
+        return 'Apply saved normalization coefficients'
+
+    def displayName(self):
+        return self.tr(self.name())
+
+    def group(self):
+        return None
+
+    def groupId(self):
+        return None
+
+    def icon(self):
+        return QIcon(os.path.join(os.path.dirname(__file__), 'icons', 'arrnorm.svg'))
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+                self.INPUT,
+                self.tr('Rasters to normalize'),
+                layerType=QgsProcessing.TypeRaster
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.COEFFICIENTS,
+                self.tr('RadCal coefficients (<output>_radcal.json)'),
+                extension='json'
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Rasters processed side by side'),
+                type=QgsProcessingParameterNumber.Type.Integer,
+                minValue=1,
+                defaultValue=min(4, os.cpu_count() or 1),
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+                self.OUTPUT_DIR,
+                self.tr('Output folder')
+            )
+        )
+
+        self.addOutput(QgsProcessingOutputMultipleLayers(self.OUTPUTS, self.tr('Normalized rasters')))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Imported here, not at module level: it loads GDAL, NumPy and SciPy
+        from ArrNorm.core import radcal
+
+        coefficients_file = self.parameterAsFile(parameters, self.COEFFICIENTS, context)
+        try:
+            coefficients = radcal.load_coefficients(coefficients_file)
+        except (OSError, ValueError) as e:
+            raise QgsProcessingException(str(e))
+
+        output_dir = self.parameterAsString(parameters, self.OUTPUT_DIR, context)
+        os.makedirs(output_dir, exist_ok=True)
+        pairs = []
+        for layer in self.parameterAsLayerList(parameters, self.INPUT, context):
+            path = layer.source().split("|layername")[0]
+            if not os.path.exists(path):
+                raise QgsProcessingException(f"Raster source is not a valid file path: {path}")
+            root, ext = os.path.splitext(os.path.basename(path))
+            pairs.append((os.path.realpath(path), os.path.join(output_dir, root + '_norm' + (ext or '.tif'))))
+
+        feedback.pushInfo('Applying the coefficients of {} ({} band(s), NCP threshold {}) to {} raster(s)'.format(
+            os.path.basename(coefficients_file), len(coefficients['bands']), coefficients.get('ncp_threshold'),
+            len(pairs)))
+        records = radcal.apply_many(pairs, coefficients,
+                                    workers=self.parameterAsInt(parameters, self.WORKERS, context) or 1,
+                                    feedback=feedback, creation_options=["BIGTIFF=IF_SAFER"])
+        for r in records:
+            if r['status'] == 'error':
+                feedback.reportError('{}: {}'.format(os.path.basename(r['input']), r['error']))
+            else:
+                feedback.pushInfo('{:<8} {:6.1f}s  {}'.format(r['status'], r['elapsed_s'], r['output']))
+        if any(r['status'] == 'error' for r in records):
+            raise QgsProcessingException('{} of {} raster(s) failed'.format(
+                sum(r['status'] == 'error' for r in records), len(records)))
+
+        return {self.OUTPUT_DIR: output_dir,
+                self.OUTPUTS: [r['output'] for r in records if r['status'] == 'ok']}
@@ -23,6 +23,7 @@ import os
 from qgis.PyQt.QtGui import QIcon
 from qgis.core import QgsProcessingProvider
 from ArrNorm.ArrNorm_algorithm import ArrNormAlgorithm
+from ArrNorm.ArrNorm_apply_algorithm import ArrNormApplyAlgorithm
 from . import resources
 
 # plugin path
@@ -49,6 +50,7 @@ class ArrNormProvider(QgsProcessingProvider):
         Loads all algorithms belonging to this provider.
         """
         self.addAlgorithm(ArrNormAlgorithm())
+        self.addAlgorithm(ArrNormApplyAlgorithm())
         # add additional algorithms here
         # self.addAlgorithm(MyOtherAlgorithm())
 
@@ -0,0 +1,6 @@
+"""Headless entry point: ``python -m ArrNorm --help``."""
+import sys
+
+from ArrNorm.core.cli import main
+
+sys.exit(main())
@@ -18,8 +18,10 @@
  *                                                                         *
  ***************************************************************************/
 """
+import json
 import os
-import shutil
+import threading
+from collections import OrderedDict
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly
 try:
@@ -27,35 +29,154 @@ try:
 except ImportError:
     QgsProcessingException = Exception
 
-from ArrNorm.core import iMad, radcal
+from ArrNorm.core import iMad, radcal, register, tiled
 from ArrNorm.core import raster_ops
+from ArrNorm.core.autotune import load_profile
+from ArrNorm.core.cache import StageCache, DEFAULT_MAX_BYTES, fingerprint
+from ArrNorm.core.memory import (MemoryBudget, IMAD_COPIES, RADCAL_COPIES, RASTER_OPS_COPIES, TILE_COPIES,
+                                 format_size, parse_size)
+from ArrNorm.core.perf import PerfReport
+from ArrNorm.core.pipeline import Pipeline, Stage
+from ArrNorm.core.scratch import ScratchDir, sweep_stale
+
+# Registration transforms estimated in this process, keyed like the stage
+# cache, so batch runs against the same image pair skip the FFTs even
+# without a cache directory. Least recently used first, at most
+# REGISTER_TRANSFORMS_MAX entries so a long-running service stays bounded.
+REGISTER_TRANSFORMS_MAX = 256
+_REGISTER_TRANSFORMS = OrderedDict()
+_REGISTER_TRANSFORMS_LOCK = threading.Lock()
+
+
+def _remembered_transform(key, transform=None):
+    """The transform remembered for key, or remember transform for it."""
+    with _REGISTER_TRANSFORMS_LOCK:
+        if transform is None:
+            transform = _REGISTER_TRANSFORMS.get(key)
+        else:
+            _REGISTER_TRANSFORMS[key] = transform
+        if transform is not None:
+            _REGISTER_TRANSFORMS.move_to_end(key)
+            while len(_REGISTER_TRANSFORMS) > REGISTER_TRANSFORMS_MAX:
+                _REGISTER_TRANSFORMS.popitem(last=False)
+        return transform
 
 
 class Normalization:
     def __init__(self, img_ref, img_target, max_iters, conv_threshold, ncp_threshold, neg_to_nodata,
                  mask_ref, mask_ref_nodata, nodata_mask, nodata_mask_value, keep_mask_layer,
-                 output_file, feedback):
+                 output_file, feedback, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES,
+                 cache_content_hash=False, perf_report=False, register_target=False,
+                 register_band=1, register_overview=register.REGISTER_OVERVIEW, output_format='GTiff',
+                 scaled_output=None, stage_workers=None, memory_budget=None, tuning_profile=None,
+                 imad_iteration=None, export_trace=False, ncp_sweep=None, save_coefficients=False,
+                 change_map=None, tiles=None, tile_workers=None, tile_min_pixels=None):
         self.img_ref = img_ref
         self.img_target = img_target
         self.max_iters = max_iters
         self.conv_threshold = conv_threshold
         self.ncp_threshold = ncp_threshold
+        # Keep this IR-MAD iteration instead of the one chosen by conv_threshold
+        self.imad_iteration = imad_iteration
+        # Write the IR-MAD iterations as <output>_irmad_trace.csv/.json
+        self.export_trace = export_trace
+        # NCP thresholds whose RadCal fits are reported as <output>_ncp_sweep.csv/.json
+        self.ncp_sweep = sorted(set(ncp_sweep) | {ncp_threshold}) if ncp_sweep else None
+        # Write the RadCal coefficients as <output>_radcal.json, for radcal.apply_coefficients
+        self.save_coefficients = save_coefficients
+        self.coefficients_file = None
+        # Optional UInt8 change map from the IR-MAD output pass, <output>_change.tif:
+        # 'ncp' (quantized no-change probability) or 'mask' (1 = change at ncp_threshold)
+        if change_map is not None and change_map not in iMad.CHANGE_MAP_KINDS:
+            raise QgsProcessingException('Unknown change map: {}'.format(change_map))
+        self.change_map = change_map
+        self.change_map_file = None
+        # Spatially adaptive mode: IR-MAD + RadCal per tile of a (rows, cols) grid,
+        # with interpolated per-pixel coefficients (see core/tiled.py)
+        try:
+            self.tiles = tiled.parse_tiles(tiles)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        if self.tiles == (1, 1):
+            self.tiles = None
+        if self.tiles:
+            unsupported = [name for name, value in (
+                ('imad_iteration', imad_iteration), ('export_trace', export_trace), ('ncp_sweep', ncp_sweep),
+                ('save_coefficients', save_coefficients), ('change_map', change_map),
+                ('scaled_output', scaled_output)) if value]
+            if unsupported:
+                raise QgsProcessingException('Tiled normalization does not support: {}'.format(
+                    ', '.join(unsupported)))
+        self.tile_workers = tile_workers or os.cpu_count() or 1
+        self.tile_min_pixels = tile_min_pixels or tiled.MIN_TILE_PIXELS
         self.neg_to_nodata = neg_to_nodata
         self.mask_ref = mask_ref
         self.nodata_mask = nodata_mask
         self.keep_mask_layer = keep_mask_layer
         self.output_file = output_file
         self.feedback = feedback
+        self.register_target = register_target
+        self.register_band = register_band
+        self.register_overview = register_overview
+        if output_format not in raster_ops.OUTPUT_FORMATS:
+            raise QgsProcessingException('Unknown output format: {}'.format(output_format))
+        self.output_format = output_format
+        # Optional scaled-integer output: 'UInt16' or 'Int16' codes with per-band scale/offset
+        if scaled_output is not None and scaled_output not in radcal.SCALED_TYPES:
+            raise QgsProcessingException('Unknown scaled output type: {}'.format(scaled_output))
+        self.scaled_output = scaled_output
+        # Block height and stage workers measured by autotune on this machine:
+        # None reads the profile of this host, False ignores it, a dict is used as is
+        if tuning_profile is None or isinstance(tuning_profile, str):
+            tuning_profile = load_profile(tuning_profile)
+        self.tuning_profile = tuning_profile or {}
+        # Threads for independent pipeline stages (1 runs them strictly in order)
+        if stage_workers is None:
+            stage_workers = self.tuning_profile.get('stage_workers', 2)
+        self.stage_workers = stage_workers
+        # Optional memory budget in bytes (or '512M', '4G'): sizes the blocks,
+        # the IR-MAD tile cache and the stage workers, see core/memory.py
+        try:
+            memory_budget = parse_size(memory_budget)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        if memory_budget is not None and memory_budget <= 0:
+            raise QgsProcessingException('The memory budget must be positive: {}'.format(memory_budget))
 
         self.img_ref_clip = img_ref  # safe default if clean() is called before clipper()
+        self.img_target_reg = img_target  # target as read by the stages after register()
+        self.target_shift = None
         self.img_imad = None
         self.img_norm = None
         self.no_neg = None
         self.norm_masked = None
         self.mask_file = None
+        self.img_cog = None
+        # Per-run directory for every intermediate, created on first use
+        self.scratch = None
+        self._scratch_lock = threading.Lock()
+        # Side products written to the scratch directory, {scratch path: published path}
+        self.sidecars = {}
+
+        # Optional stage cache: the aligned reference and the IR-MAD output are
+        # kept across runs, so changing only RadCal/masking settings skips the
+        # clipper warp and the IR-MAD iterations.
+        self.cache = (StageCache(cache_dir, max_bytes=cache_max_bytes, content_hash=cache_content_hash)
+                      if cache_dir else None)
+        self.ref_clip_key = None
+
+        # Optional per-stage performance report, written next to the output as
+        # <output>_perf.json (ARRNORM_CPROFILE additionally dumps cProfile files).
+        # With a memory budget it also warns about stages exceeding it.
+        self.perf = PerfReport(enabled=perf_report,
+                               output_dir=os.path.dirname(os.path.abspath(output_file)),
+                               memory_budget=memory_budget, warn=self.feedback.pushInfo)
+        self.perf_file = None
 
         # Output dtype: use the higher-precision type of the two inputs.
         ref_ds = gdal.Open(self.img_ref, GA_ReadOnly)
+        if ref_ds is None:
+            raise QgsProcessingException('Cannot open reference image: {}'.format(self.img_ref))
         ref_band = ref_ds.GetRasterBand(1)
         ref_dtype_code = ref_band.DataType
         ref_nodata = ref_band.GetNoDataValue()
@@ -63,9 +184,20 @@ class Normalization:
         ref_ds = None
 
         target_ds = gdal.Open(self.img_target, GA_ReadOnly)
+        if target_ds is None:
+            raise QgsProcessingException('Cannot open target image: {}'.format(self.img_target))
         target_band = target_ds.GetRasterBand(1)
         target_dtype_code = target_band.DataType
         target_nodata = target_band.GetNoDataValue()
+        self.target_pixels = target_ds.RasterXSize * target_ds.RasterYSize
+        self.memory = MemoryBudget(memory_budget, target_ds.RasterXSize, target_ds.RasterYSize,
+                                   target_ds.RasterCount, preferred_rows=self.tuning_profile.get('block_rows'))
+        self.stage_workers = self.memory.workers(stage_workers)
+        if self.tiles:
+            # as tiled.main does: no more tiles than rows/columns of pixels
+            self.tiles = (min(self.tiles[0], target_ds.RasterYSize), min(self.tiles[1], target_ds.RasterXSize))
+        if self.tiles and self.memory.limited:
+            self.tile_workers = max(1, min(self.tile_workers, self.memory.budget // self.tile_bytes()))
         target_band = None
         target_ds = None
 
@@ -83,45 +215,192 @@ class Normalization:
 
         self.feedback.pushInfo("PROCESSING IMAGE: {target}".format(target=os.path.basename(self.img_target)))
 
-        self.feedback.setProgress(0)
-        self.clipper()
-        if self.feedback.isCanceled():
-            return
-
-        self.feedback.setProgress(10)
-        self.imad()
-        if self.feedback.isCanceled():
-            return
-
-        self.feedback.setProgress(90)
-        self.radcal()
-        if self.feedback.isCanceled():
-            return
+        if self.tuning_profile:
+            self.feedback.pushInfo("Tuning profile: {} rows per block, {} stage worker(s)".format(
+                self.memory_plan('imad')[0], self.stage_workers))
+        if self.memory.limited:
+            self.log_memory_plan()
 
-        if self.neg_to_nodata:
-            self.feedback.setProgress(93)
-            self.no_negative_value(self.img_norm)
-
-        if self.nodata_mask:
-            self.feedback.setProgress(97)
-            self.make_mask()
-            self.apply_mask(self.no_neg if self.no_neg else self.img_norm)
-
-        # finish
-        if self.norm_masked:
-            shutil.move(self.norm_masked, self.output_file)
-        elif self.no_neg:
-            shutil.move(self.no_neg, self.output_file)
-        else:
-            shutil.move(self.img_norm, self.output_file)
+        try:
+            if not self.pipeline().run():
+                return
+
+            # finish: move the products out of the scratch directory
+            final = self.img_cog or self.norm_masked or self.no_neg or self.img_norm
+            self.scratch.publish(final, self.output_file)
+            if self.keep_mask_layer and self.mask_file:
+                filename, ext = os.path.splitext(os.path.basename(self.output_file))
+                self.mask_file = self.scratch.publish(
+                    self.mask_file, os.path.join(os.path.dirname(os.path.abspath(self.output_file)),
+                                                 filename + "_Mask" + ext))
+            published = {src: self.scratch.publish(src, dst) for src, dst in self.sidecars.items()
+                         if os.path.exists(src)}
+            self.coefficients_file = published.get(self.coefficients_file)
+            self.change_map_file = published.get(self.change_map_file)
+        finally:
+            # also after a failure or cancel, once no stage is running any more
+            self.clean()
+            if self.scratch is not None:
+                self.scratch.cleanup()
+                self.scratch = None
 
-        self.clean()
+        if self.perf.enabled:
+            self.perf_file = self.perf.write(os.path.splitext(self.output_file)[0] + '_perf.json')
+            self.feedback.pushInfo('\nPerformance report: ' + os.path.basename(self.perf_file))
+            for line in self.perf.summary_lines():
+                self.feedback.pushInfo(line)
 
         self.feedback.setProgress(100)
         self.feedback.pushInfo('\nDONE: {img_target} PROCESSED\n'
-              '      image normalized saved in: {img_norm}\n'.format(
+              '      image normalized saved in: {output}\n'.format(
                 img_target=os.path.basename(self.img_target),
-                img_norm=os.path.basename(self.img_norm)))
+                output=os.path.basename(self.output_file)))
+
+    def pipeline(self):
+        """The stages of this run, declared by the artifacts they read and write.
+
+        make_mask only reads the (registered) target, so it overlaps with the
+        clipper and IR-MAD; no_negative_value and apply_mask are fused into
+        one pass when the intermediate raster is not needed.
+        """
+        final = 'masked' if self.nodata_mask else ('no_neg' if self.neg_to_nodata else 'norm')
+
+        def clipper(feedback, rec):
+            self.clipper()
+            rec['outputs'] = [self.img_ref_clip] if self.img_ref_clip != self.img_ref else []
+
+        stages = [Stage('clipper', clipper, inputs=['ref'], outputs=['ref_clip'], weight=5)]
+        if self.register_target:
+            stages.append(Stage('register', lambda feedback, rec: self.register(),
+                                inputs=['ref_clip', 'target'], outputs=['target_reg'], weight=5))
+        if self.tiles:
+            stages.append(Stage('tiled', lambda feedback, rec: self.tiled(perf_stats=rec, feedback=feedback),
+                                inputs=['ref_clip', 'target_reg'], outputs=['norm'], weight=84))
+        else:
+            stages += [
+                Stage('imad', lambda feedback, rec: self.imad(perf_stats=rec, feedback=feedback),
+                      inputs=['ref_clip', 'target_reg'], outputs=['imad'], weight=80),
+                Stage('radcal', lambda feedback, rec: self.radcal(),
+                      inputs=['imad', 'ref_clip', 'target_reg'], outputs=['norm'], weight=4),
+            ]
+        if self.neg_to_nodata:
+            stages.append(Stage('no_negative_value', lambda feedback, rec: self.no_negative_value(self.img_norm),
+                                inputs=['norm'], outputs=['no_neg'], weight=2))
+        if self.nodata_mask:
+            stages += [
+                Stage('make_mask', lambda feedback, rec: self.make_mask(),
+                      inputs=['target_reg'], outputs=['mask'], weight=2),
+                Stage('apply_mask', lambda feedback, rec: self.apply_mask(self.no_neg or self.img_norm),
+                      inputs=['no_neg' if self.neg_to_nodata else 'norm', 'mask'], outputs=['masked'],
+                      weight=2),
+            ]
+        if self.output_format == 'COG':
+            stages.append(Stage('write_cog', lambda feedback, rec: self.write_cog(self.artifact(final)),
+                                inputs=[final], outputs=['output'], weight=3))
+        fused = [Stage('no_negative_value+apply_mask', lambda feedback, rec: self.no_negative_and_mask(),
+                       inputs=['norm', 'mask'], outputs=['masked'], weight=3,
+                       replaces=('no_negative_value', 'apply_mask'))]
+        if self.memory.limited:
+            for stage in stages + fused:
+                self._record_memory_plan(stage)
+        return Pipeline(stages, self.feedback, perf=self.perf, workers=self.stage_workers, fused=fused,
+                        keep=[final], paths=self.artifact, pixels=self.target_pixels)
+
+    def memory_plan(self, stage):
+        """(block rows, planned bytes) of a stage, or None for the GDAL-driven stages.
+
+        Blocks are sized for the stages that may run side by side; without a
+        budget the block height is the fixed default.
+        """
+        memory = self.memory
+        if stage == 'imad':
+            block_rows = memory.block_rows(IMAD_COPIES, workers=self.stage_workers)
+            planned = memory.block_bytes(block_rows, IMAD_COPIES)
+            if memory.cache_imad():
+                planned += memory.imad_cache_bytes()
+            return block_rows, planned
+        if stage in ('no_negative_value', 'make_mask', 'apply_mask', 'no_negative_value+apply_mask'):
+            block_rows = memory.block_rows(RASTER_OPS_COPIES, bands=1, workers=self.stage_workers)
+            return block_rows, memory.block_bytes(block_rows, RASTER_OPS_COPIES, bands=1)
+        if stage == 'radcal':
+            # RadCal reads the images in row blocks, but the fit keeps the no-change
+            # pixels of both: planned as if every pixel were one
+            block_rows = memory.block_rows(RADCAL_COPIES, workers=self.stage_workers)
+            return block_rows, memory.block_bytes(block_rows, RADCAL_COPIES) + memory.block_bytes(memory.rows, 2)
+        if stage == 'tiled':
+            # every tile worker holds both images of its tile
+            block_rows = memory.block_rows(IMAD_COPIES, workers=self.stage_workers)
+            return block_rows, self.tile_workers * self.tile_bytes()
+        return None
+
+    def tile_bytes(self):
+        """Working set of one tile worker: TILE_COPIES of a whole tile and IMAD_COPIES of a block of it."""
+        memory = self.memory
+        tile_rows = -(-memory.rows // self.tiles[0])
+        block_rows = min(tile_rows, memory.block_rows(IMAD_COPIES, workers=self.stage_workers))
+        return max(1, memory.block_bytes(tile_rows * TILE_COPIES + block_rows * IMAD_COPIES, 1) // self.tiles[1])
+
+    def _record_memory_plan(self, stage):
+        plan = self.memory_plan(stage.name)
+        if plan is None:
+            return
+        func = stage.func
+
+        def run(feedback, rec):
+            rec['memory'] = {'block_rows': plan[0], 'planned_bytes': plan[1]}
+            func(feedback, rec)
+        stage.func = run
+
+    def log_memory_plan(self):
+        memory = self.memory
+        self.feedback.pushInfo("\nMemory budget: {} ({} stage worker(s))".format(
+            format_size(memory.budget), self.stage_workers))
+        if self.tiles:
+            self.feedback.pushInfo("  tiled iMad + Radcal: {} tile worker(s), ~{} planned".format(
+                self.tile_workers, format_size(self.memory_plan('tiled')[1])))
+        else:
+            block_rows, planned = self.memory_plan('imad')
+            self.feedback.pushInfo("  iMad: {} rows per block, tiles {} ({}), ~{} planned".format(
+                block_rows, 'cached in memory' if memory.cache_imad() else 're-read every iteration',
+                format_size(memory.imad_cache_bytes()), format_size(planned)))
+        block_rows, planned = self.memory_plan('apply_mask')
+        self.feedback.pushInfo("  raster steps: {} rows per block, ~{} planned".format(
+            block_rows, format_size(planned)))
+        if not self.tiles:
+            block_rows, planned = self.memory_plan('radcal')
+            self.feedback.pushInfo("  Radcal: {} rows per block, up to ~{} with the no-change pixels".format(
+                block_rows, format_size(planned)))
+            if planned > memory.budget:
+                self.feedback.pushInfo("  WARNING: if most pixels are no-change, Radcal exceeds the memory budget")
+
+    def scratch_file(self, name):
+        """Path for an intermediate file of this run.
+
+        Intermediates live in a private directory next to the output, so
+        concurrent runs on the same images never collide.
+        """
+        # stages running side by side must share one directory
+        with self._scratch_lock:
+            if self.scratch is None:
+                output_dir = os.path.dirname(os.path.abspath(self.output_file))
+                sweep_stale(output_dir)
+                self.scratch = ScratchDir(output_dir)
+            return self.scratch.file(name)
+
+    def sidecar_file(self, suffix):
+        """Scratch path of a side product published as <output><suffix> when the run succeeds."""
+        root = os.path.splitext(os.path.abspath(self.output_file))[0]
+        path = self.scratch_file(os.path.basename(root) + suffix)
+        with self._scratch_lock:
+            self.sidecars[path] = root + suffix
+        return path
+
+    def artifact(self, name):
+        """File of a pipeline artifact."""
+        return {'ref': self.img_ref, 'target': self.img_target, 'ref_clip': self.img_ref_clip,
+                'target_reg': self.img_target_reg, 'imad': self.img_imad, 'norm': self.img_norm,
+                'no_neg': self.no_neg, 'mask': self.mask_file, 'masked': self.norm_masked,
+                'output': self.img_cog}[name]
 
     def clipper(self):
         """Reproject and clip the reference image onto the target's exact pixel grid.
@@ -169,6 +448,21 @@ class Normalization:
             self.img_ref_clip = self.img_ref
             return
 
+        if self.cache is not None:
+            # the clip depends on the target's grid only, not on its pixels, so
+            # targets on the same grid (e.g. new scenes of a tile) share it
+            self.ref_clip_key = self.cache.fingerprint(
+                [self.img_ref],
+                {'stage': 'clipper', 'grid': [target_proj, list(target_gt), target_cols, target_rows],
+                 'mask_ref': self.mask_ref,
+                 'ref_mask_nodata': self.ref_mask_nodata if self.mask_ref else None})
+            cached = self.cache.get(self.ref_clip_key)
+            if cached is not None:
+                self.img_ref_clip = cached['ref_clip']
+                self.feedback.pushInfo(
+                    "\nReusing cached aligned reference: " + os.path.basename(self.img_ref_clip) + "\n")
+                return
+
         if already_aligned:
             self.feedback.pushInfo(
                 "\nReference image is already aligned with target. "
@@ -185,10 +479,8 @@ class Normalization:
                         nd=self.ref_mask_nodata) if self.mask_ref else ""))
 
         filename, ext = os.path.splitext(os.path.basename(self.img_ref))
-        self.img_ref_clip = os.path.join(
-            os.path.dirname(os.path.abspath(self.img_target)),
-            filename + "_" + os.path.splitext(os.path.basename(self.img_target))[0] + "_clip" + ext
-        )
+        self.img_ref_clip = self.scratch_file(
+            filename + "_" + os.path.splitext(os.path.basename(self.img_target))[0] + "_clip" + ext)
 
         try:
             if already_aligned:
@@ -232,71 +524,283 @@ class Normalization:
             if result is None:
                 raise RuntimeError('gdal.Warp returned None — check GDAL error log.')
             result = None  # close/release the output dataset
+            if self.cache is not None:
+                self.img_ref_clip = self.cache.put(
+                    self.ref_clip_key, {'ref_clip': self.img_ref_clip}, stage='clipper')['ref_clip']
             self.feedback.pushInfo(
                 'Reference prepared successfully: ' + os.path.basename(self.img_ref_clip))
         except Exception as e:
-            self.clean()
             raise QgsProcessingException('\nError clipping/reprojecting reference image: ' + str(e))
 
-    def imad(self):
+    def register(self):
+        """Co-register the target onto the aligned reference (translation only).
+
+        The transform is estimated once per image pair, coarse-to-fine, and
+        kept in memory and in the stage cache. It is applied virtually: the
+        following stages read a VRT of the target shifted by whole pixels
+        instead of a resampled full-scene copy.
+        """
+        params = {'stage': 'register', 'band': self.register_band, 'overview': self.register_overview,
+                  'mask_ref': self.mask_ref,
+                  'ref_mask_nodata': self.ref_mask_nodata if self.mask_ref else None}
+        key = (self.cache.fingerprint([self.img_ref, self.img_target], params) if self.cache is not None
+               else fingerprint([self.img_ref, self.img_target], params))
+
+        transform = _remembered_transform(key)
+        if transform is None and self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                with open(cached['transform']) as f:
+                    transform = json.load(f)
+        if transform is not None:
+            self.feedback.pushInfo("\nReusing registration transform: shift {}".format(transform['shift']))
+        else:
+            self.feedback.pushInfo("\nEstimating registration transform for:\n" +
+                  os.path.basename(self.img_ref_clip) + " " + os.path.basename(self.img_target))
+            try:
+                result = register.estimate_shift(self.img_ref_clip, self.img_target, warpband=self.register_band,
+                                                 overview=self.register_overview, feedback=self.feedback)
+            except Exception as e:
+                raise QgsProcessingException('\nError estimating the registration transform: ' + str(e))
+            if result is None:  # canceled
+                return
+            transform = {'scale': result[0], 'angle': result[1], 'shift': result[2]}
+            if self.cache is not None:
+                filename = os.path.splitext(os.path.basename(self.img_target))[0]
+                transform_file = self.scratch_file(filename + "_register.json")
+                with open(transform_file, 'w') as f:
+                    json.dump(transform, f)
+                self.cache.put(key, {'transform': transform_file}, stage='register')
+        _remembered_transform(key, transform)
+
+        if abs(transform['scale'] - 1) > 0.01 or abs(transform['angle']) > 0.5:
+            self.feedback.pushInfo("WARNING: estimated scale {:.4f} / angle {:.3f} are ignored, "
+                                   "only the translation is applied".format(transform['scale'], transform['angle']))
+        self.target_shift = [int(t) for t in transform['shift']]
+        if self.target_shift == [0, 0]:
+            self.feedback.pushInfo("Target is already registered to the reference (no shift).")
+            self.img_target_reg = self.img_target
+            return
+
+        filename = os.path.splitext(os.path.basename(self.img_target))[0]
+        self.img_target_reg = register.shift_virtual(self.img_target, self.target_shift,
+                                                     outfn=self.scratch_file(filename + "_warp.vrt"))
+        self.feedback.pushInfo("Target shifted by {} pixels (row, col): {}".format(
+            self.target_shift, os.path.basename(self.img_target_reg)))
+
+    def imad(self, perf_stats=None, feedback=None):
         # ======================================
         # iMad process
 
+        imad_key = trace_key = None
+        trace = None
+        if self.cache is not None:
+            ref_key = self.ref_clip_key or self.cache.fingerprint([self.img_ref])
+            # The trace of the iterations does not depend on where they stop, so
+            # another conv_threshold or iteration only needs the output pass.
+            trace_params = {'stage': 'imad_trace', 'ref': ref_key, 'max_iters': self.max_iters}
+            if self.target_shift is not None:
+                trace_params['shift'] = self.target_shift
+            trace_key = self.cache.fingerprint([self.img_target], trace_params)
+            imad_params = dict(trace_params, stage='imad', conv_threshold=self.conv_threshold)
+            if self.imad_iteration is not None:
+                imad_params['iteration'] = self.imad_iteration
+            imad_key = self.cache.fingerprint([self.img_target], imad_params)
+            cached = self.cache.get(imad_key)
+            if cached is not None:
+                self.img_imad = cached['imad']
+                self.feedback.pushInfo("\nReusing cached iMad result: " + os.path.basename(self.img_imad))
+                if perf_stats is not None:
+                    perf_stats.update(cached=True, passes=0)
+                if self.change_map:
+                    # no output pass to piggyback on: read the chi-square band of the cached MAD
+                    self.change_map_file = iMad.change_map(
+                        self.img_imad, self.sidecar_file('_change.tif'), self.change_map, self.ncp_threshold,
+                        img_target=self.img_target_reg, nodata=self.change_map_nodata(),
+                        block_rows=self.memory_plan('imad')[0])
+                    self.feedback.pushInfo("Change map: " + os.path.basename(
+                        os.path.splitext(self.output_file)[0]) + "_change.tif")
+                if self.export_trace:
+                    cached = self.cache.get(trace_key)
+                    if cached is not None:
+                        self.write_trace(iMad.IRMadTrace.load(cached['trace']))
+                return
+
+            cached = self.cache.get(trace_key)
+            if cached is not None:
+                trace = iMad.IRMadTrace.load(cached['trace'])
+                try:
+                    trace.select(self.conv_threshold, self.imad_iteration)
+                    self.feedback.pushInfo("\nReusing cached iMad trace: " + os.path.basename(cached['trace']))
+                except ValueError as e:
+                    self.feedback.pushInfo("\nCached iMad trace not usable, iterating again: " + str(e))
+                    trace = None
+
+        # radcal reads the reference/target names back from the MAD(...) file name
+        root_ref = os.path.splitext(os.path.basename(self.img_ref_clip))[0]
+        ext = os.path.splitext(self.img_ref_clip)[1]
+        output = self.scratch_file('MAD({}&{}){}'.format(root_ref, os.path.basename(self.img_target), ext))
+
+        if self.change_map:
+            self.change_map_file = self.sidecar_file('_change.tif')
+
+        trace_file = None
+        if trace is None and (self.cache is not None or self.export_trace):
+            trace_file = self.scratch_file(os.path.splitext(os.path.basename(output))[0] + '_trace.npz')
+
         self.feedback.pushInfo("\niMad process for:\n" +
-              os.path.basename(self.img_ref_clip) + " " + os.path.basename(self.img_target))
-        self.img_imad = iMad.main(self.img_ref_clip, self.img_target, max_iters=self.max_iters, conv_threshold=self.conv_threshold, feedback=self.feedback)
+              os.path.basename(self.img_ref_clip) + " " + os.path.basename(self.img_target_reg))
+        self.img_imad = iMad.main(self.img_ref_clip, self.img_target_reg, max_iters=self.max_iters,
+                                  conv_threshold=self.conv_threshold, output=output, perf_stats=perf_stats,
+                                  feedback=feedback or self.feedback, block_rows=self.memory_plan('imad')[0],
+                                  cache_tiles=trace is None and self.memory.cache_imad(), trace=trace,
+                                  save_trace=trace_file, iteration=self.imad_iteration,
+                                  change_map=self.change_map_file,
+                                  change_kind=self.change_map, ncp_threshold=self.ncp_threshold,
+                                  nodata=self.change_map_nodata())
+        if self.img_imad is None:
+            return
+        if self.change_map:
+            self.feedback.pushInfo("Change map: " + os.path.basename(
+                os.path.splitext(self.output_file)[0]) + "_change.tif")
+
+        if trace is None and trace_file is not None:
+            trace = iMad.IRMadTrace.load(trace_file)
+        if self.export_trace:
+            self.write_trace(trace)
+        if self.cache is not None:
+            self.img_imad = self.cache.put(imad_key, {'imad': self.img_imad}, stage='imad')['imad']
+            if trace_file is not None:
+                # a longer trace (run to a stricter threshold) replaces a shorter one
+                self.cache.put(trace_key, {'trace': trace_file}, stage='imad_trace', replace=True)
+
+    def change_map_nodata(self):
+        """Target nodata value marked in the change map, if the target is masked."""
+        return self.mask_nodata if self.nodata_mask else None
+
+    def write_trace(self, trace):
+        """Export the IR-MAD iterations next to the output for convergence monitoring."""
+        trace.to_csv(self.sidecar_file('_irmad_trace.csv'))
+        trace.to_json(self.sidecar_file('_irmad_trace.json'))
+        self.feedback.pushInfo("IR-MAD trace: " + os.path.basename(
+            os.path.splitext(self.output_file)[0]) + "_irmad_trace.csv/.json")
 
     def radcal(self):
         # ======================================
         # Radcal process
 
         filename, ext = os.path.splitext(os.path.basename(self.img_target))
-        self.img_norm = os.path.join(os.path.dirname(os.path.abspath(self.img_target)), filename + "_radcal" + ext)
+        self.img_norm = self.scratch_file(filename + "_radcal" + ext)
 
         self.feedback.pushInfo("\nRadcal process for\n" +
               os.path.basename(self.img_ref_clip) + " " + os.path.basename(self.img_target) +
               " with iMad image: " + os.path.basename(self.img_imad))
-        radcal.main(self.img_imad, img_ref=self.img_ref_clip, img_tgt=self.img_target, output=self.img_norm,
-                    ncp_threshold=self.ncp_threshold, out_dtype=self.out_dtype, feedback=self.feedback)
+        if self.save_coefficients:
+            self.coefficients_file = self.sidecar_file('_radcal.json')
+        sweep = None
+        if self.ncp_sweep:
+            sweep = radcal.NcpSweep(gdal.Open(self.img_ref_clip, GA_ReadOnly).RasterCount,
+                                    dof=gdal.Open(self.img_imad, GA_ReadOnly).RasterCount - 1)
+        radcal.main(self.img_imad, img_ref=self.img_ref_clip, img_tgt=self.img_target_reg, output=self.img_norm,
+                    ncp_threshold=self.ncp_threshold, out_dtype=self.out_dtype,
+                    scaled_dtype=radcal.SCALED_TYPES.get(self.scaled_output), feedback=self.feedback,
+                    coefficients_file=self.coefficients_file, sweep=sweep,
+                    block_rows=self.memory_plan('radcal')[0])
+        if self.coefficients_file and os.path.exists(self.coefficients_file):
+            # name the user's images, not the clipped/shifted intermediates
+            coefficients = radcal.load_coefficients(self.coefficients_file)
+            coefficients.update(reference=os.path.abspath(self.img_ref), target=os.path.abspath(self.img_target))
+            if self.target_shift is not None:
+                coefficients['target_shift'] = self.target_shift
+            radcal.save_coefficients(self.coefficients_file, coefficients)
+            self.feedback.pushInfo("RadCal coefficients: " + os.path.basename(
+                os.path.splitext(self.output_file)[0]) + "_radcal.json")
+        if sweep is not None:
+            self.write_ncp_sweep(sweep)
+
+    def tiled(self, perf_stats=None, feedback=None):
+        # ======================================
+        # IR-MAD + Radcal per tile, interpolated coefficients
+
+        filename, ext = os.path.splitext(os.path.basename(self.img_target))
+        self.img_norm = self.scratch_file(filename + "_radcal" + ext)
+
+        self.feedback.pushInfo("\nTiled iMad + Radcal process for\n" +
+              os.path.basename(self.img_ref_clip) + " " + os.path.basename(self.img_target))
+        result = tiled.main(self.img_ref_clip, self.img_target_reg, self.img_norm, self.tiles,
+                            max_iters=self.max_iters, conv_threshold=self.conv_threshold,
+                            ncp_threshold=self.ncp_threshold, out_dtype=self.out_dtype,
+                            nodata=self.mask_nodata if self.nodata_mask else None,
+                            min_pixels=self.tile_min_pixels, workers=self.tile_workers,
+                            block_rows=self.memory_plan('tiled')[0], feedback=feedback or self.feedback)
+        if result is not None and perf_stats is not None:
+            perf_stats['tiles'] = [t.as_dict() for row in result[1] for t in row]
+
+    def write_ncp_sweep(self, sweep):
+        """Report the RadCal fit for every threshold of the sweep accumulated by radcal."""
+        self.feedback.pushInfo('')
+        for line in sweep.report_lines(self.ncp_sweep):
+            self.feedback.pushInfo(line)
+        sweep.to_csv(self.sidecar_file('_ncp_sweep.csv'), self.ncp_sweep)
+        sweep.to_json(self.sidecar_file('_ncp_sweep.json'), self.ncp_sweep)
+        self.feedback.pushInfo("NCP sweep: " + os.path.basename(
+            os.path.splitext(self.output_file)[0]) + "_ncp_sweep.csv/.json")
 
     def no_negative_value(self, image):
         # ======================================
         # Convert negative values to NoData to image normalized
 
         filename, ext = os.path.splitext(os.path.basename(self.img_target))
-        self.no_neg = os.path.join(os.path.dirname(os.path.abspath(self.img_target)), filename + "_no_neg" + ext)
+        self.no_neg = self.scratch_file(filename + "_no_neg" + ext)
 
         self.feedback.pushInfo('\nConverting negative values for\n' + os.path.basename(os.path.basename(image)))
 
         try:
             raster_ops.no_negative_value(
                 image, self.no_neg, nodata_value=self.mask_nodata,
-                creation_options=["BIGTIFF=YES"])
+                creation_options=["BIGTIFF=YES"], block_rows=self.memory_plan('no_negative_value')[0])
             self.feedback.pushInfo('Negative values converted successfully: ' + os.path.basename(image))
         except Exception as e:
-            self.clean()
             raise QgsProcessingException('\nError converting values: ' + str(e))
 
+    def no_negative_and_mask(self):
+        # ======================================
+        # Negative values to NoData and nodata mask in a single pass
+
+        filename, ext = os.path.splitext(os.path.basename(self.img_target))
+        self.norm_masked = self.scratch_file(filename + "_norm_masked" + ext)
+
+        self.feedback.pushInfo('\nConverting negative values and applying nodata mask to\n' +
+              os.path.basename(self.img_target) + " " + os.path.basename(self.img_norm))
+
+        try:
+            raster_ops.no_negative_and_mask(
+                self.img_norm, self.mask_file, self.norm_masked, nodata_value=self.mask_nodata,
+                creation_options=["BIGTIFF=YES"], block_rows=self.memory_plan('no_negative_value+apply_mask')[0])
+            self.feedback.pushInfo('Negative values converted and mask applied successfully')
+        except Exception as e:
+            raise QgsProcessingException('\nError converting values/applying mask: ' + str(e))
+
     def make_mask(self):
         # ======================================
         # Make nodata mask from target image
 
-        img_to_process = self.img_target
+        img_to_process = self.img_target_reg
 
         self.feedback.pushInfo('\nMaking nodata mask (nodata value: {nd}) for target image:\n'.format(
               nd=self.mask_nodata) + os.path.basename(img_to_process))
 
         filename, ext = os.path.splitext(os.path.basename(self.output_file))
-        self.mask_file = os.path.join(os.path.dirname(os.path.abspath(self.output_file)), filename + "_Mask" + ext)
+        self.mask_file = self.scratch_file(filename + "_Mask" + ext)
 
         try:
             # "1*(A!=nodata)" is more general than the old "1*(A>0)" which incorrectly
             # treated negative values (valid in some sensor products) as nodata.
-            raster_ops.make_mask(img_to_process, self.mask_file, nodata_value=self.mask_nodata)
+            raster_ops.make_mask(img_to_process, self.mask_file, nodata_value=self.mask_nodata,
+                                 block_rows=self.memory_plan('make_mask')[0])
 
             self.feedback.pushInfo('Mask created successfully: ' + os.path.basename(self.mask_file))
         except Exception as e:
-            self.clean()
             raise QgsProcessingException('\nError creating mask: ' + str(e))
 
     def apply_mask(self, image):
@@ -304,7 +808,7 @@ class Normalization:
         # Apply nodata mask to normalized output
 
         filename, ext = os.path.splitext(os.path.basename(self.img_target))
-        self.norm_masked = os.path.join(os.path.dirname(os.path.abspath(self.img_target)), filename + "_norm_masked" + ext)
+        self.norm_masked = self.scratch_file(filename + "_norm_masked" + ext)
 
         self.feedback.pushInfo('\nApplying nodata mask to\n' +
               os.path.basename(self.img_target) + " " + os.path.basename(image))
@@ -312,24 +816,52 @@ class Normalization:
         try:
             raster_ops.apply_mask(
                 image, self.mask_file, self.norm_masked, nodata_value=self.mask_nodata,
-                creation_options=["BIGTIFF=YES"])
+                creation_options=["BIGTIFF=YES"], block_rows=self.memory_plan('apply_mask')[0])
             self.feedback.pushInfo('Mask applied successfully: ' + os.path.basename(self.mask_file))
         except Exception as e:
-            self.clean()
             raise QgsProcessingException('\nError applied mask: ' + str(e))
 
+    def write_cog(self, image):
+        # ======================================
+        # Write the final output (and the kept mask) as Cloud-Optimized GeoTIFF
+
+        self.feedback.pushInfo('\nWriting Cloud-Optimized GeoTIFF (tiled, compressed, with overviews):\n' +
+              os.path.basename(self.output_file))
+        filename, ext = os.path.splitext(os.path.basename(self.output_file))
+        self.img_cog = self.scratch_file(filename + "_cog" + ext)
+        try:
+            raster_ops.write_cog(image, self.img_cog)
+            if self.keep_mask_layer and self.mask_file and os.path.exists(self.mask_file):
+                root, ext = os.path.splitext(self.mask_file)
+                raster_ops.write_cog(self.mask_file, root + "_cog" + ext, overview_resampling='NEAREST')
+                os.replace(root + "_cog" + ext, self.mask_file)
+        except Exception as e:
+            raise QgsProcessingException('\nError writing Cloud-Optimized GeoTIFF: ' + str(e))
+
+    def _remove(self, path):
+        # cached artifacts are owned by the cache and must survive the run
+        if not path or not os.path.exists(path):
+            return
+        if self.cache is not None and self.cache.owns(path):
+            return
+        os.remove(path)
+
     def clean(self):
         # delete the MAD file
-        os.remove(self.img_imad) if self.img_imad and os.path.exists(self.img_imad) else None
+        self._remove(self.img_imad)
         # delete the clip reference image
         if self.img_ref_clip != self.img_ref:
-            os.remove(self.img_ref_clip) if os.path.exists(self.img_ref_clip) else None
-        os.remove(self.img_norm) if self.img_norm and os.path.exists(self.img_norm) else None
-        os.remove(self.no_neg) if self.no_neg and os.path.exists(self.no_neg) else None
-        os.remove(self.norm_masked) if self.norm_masked and os.path.exists(self.norm_masked) else None
+            self._remove(self.img_ref_clip)
+        # delete the shifted target VRT
+        if self.img_target_reg != self.img_target:
+            self._remove(self.img_target_reg)
+        self._remove(self.img_norm)
+        self._remove(self.no_neg)
+        self._remove(self.norm_masked)
+        self._remove(self.img_cog)
         # delete mask layer only if user did not ask to keep it
         if not self.keep_mask_layer:
-            os.remove(self.mask_file) if self.mask_file and os.path.exists(self.mask_file) else None
+            self._remove(self.mask_file)
 
 
 def get_extent_from_raster(raster_path):
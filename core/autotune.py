@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     autotune.py
+#  Purpose:  Benchmark block sizes, stage workers and the GDAL cache on this
+#            machine and keep the fastest settings in a tuning profile.
+#
+#  autotune() cuts a band of rows out of a real reference/target pair (a VRT
+#  window, so the reads still hit the original storage) and times the
+#  kernels of the pipeline on it:
+#
+#    - read:  both images read block by block as float64 tiles;
+#    - imad:  IR-MAD iterations over the tiles already in memory;
+#    - write: a raster_ops pass writing the target back to disk.
+#
+#  The block height is chosen first (lowest read + imad + write time), then
+#  the number of stages run side by side (highest throughput of concurrent
+#  kernels) and last the GDAL block cache (fastest re-reads, as the IR-MAD
+#  iterations do). More workers or cache are only taken when clearly faster.
+#
+#  The profile is a JSON file with one entry per host, so a home directory
+#  shared by a cluster keeps the settings of each node. Normalization reads
+#  the entry of the current host by default; the command line and the
+#  service also apply its GDAL cache size.
+#
+#    python -m ArrNorm --autotune ref.tif target.tif
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import json
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+
+PROFILE_ENV = 'ARRNORM_TUNING_PROFILE'
+
+BLOCK_ROWS = (64, 128, 256, 512, 1024)
+WORKERS = (1, 2, 4)
+GDAL_CACHE_MB = (64, 256, 1024)
+SAMPLE_ROWS = 1024
+IMAD_ITERATIONS = 3
+# more workers or a larger GDAL cache must be this much faster to be chosen
+MIN_GAIN = 1.05
+
+
+def default_profile_path():
+    """$ARRNORM_TUNING_PROFILE, else tuning.json in the user configuration directory."""
+    path = os.environ.get(PROFILE_ENV, '').strip()
+    if path:
+        return path
+    if os.name == 'nt':
+        config = os.environ.get('APPDATA') or os.path.expanduser('~')
+    else:
+        config = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+    return os.path.join(config, 'ArrNorm', 'tuning.json')
+
+
+def _read_profiles(path):
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return profiles if isinstance(profiles, dict) else {}
+
+
+def load_profile(path=None, host=None):
+    """Tuning profile of this host ({} if none was saved)."""
+    profile = _read_profiles(path or default_profile_path()).get(host or platform.node())
+    return profile if isinstance(profile, dict) else {}
+
+
+def save_profile(profile, path=None, host=None):
+    """Store the profile as the entry of this host, keeping the other hosts."""
+    path = path or default_profile_path()
+    profiles = _read_profiles(path)
+    profiles[host or platform.node()] = profile
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp, path)
+    return path
+
+
+def _timed(func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
+class _Sample(object):
+    """A window of rows of the reference and target, and the kernels timed on it."""
+
+    def __init__(self, img_ref, img_target, sample_rows, workdir):
+        from osgeo import gdal
+
+        ref_ds = gdal.Open(img_ref)
+        tgt_ds = gdal.Open(img_target)
+        if ref_ds is None or tgt_ds is None:
+            raise ValueError('Cannot open {}'.format(img_target if ref_ds else img_ref))
+        if ref_ds.RasterCount != tgt_ds.RasterCount:
+            raise ValueError('The reference and target have different band counts')
+        self.cols = min(ref_ds.RasterXSize, tgt_ds.RasterXSize)
+        self.rows = min(sample_rows, ref_ds.RasterYSize, tgt_ds.RasterYSize)
+        self.bands = ref_ds.RasterCount
+        # rows from the middle of the image, clear of any nodata border
+        y0 = (min(ref_ds.RasterYSize, tgt_ds.RasterYSize) - self.rows) // 2
+        window = [0, y0, self.cols, self.rows]
+        self.workdir = workdir
+        self.ref = os.path.join(workdir, 'ref.vrt')
+        self.target = os.path.join(workdir, 'target.vrt')
+        gdal.Translate(self.ref, ref_ds, format='VRT', srcWin=window)
+        gdal.Translate(self.target, tgt_ds, format='VRT', srcWin=window)
+
+    def read(self, block_rows):
+        """float64 tiles of both images, as the IR-MAD stage reads them."""
+        from osgeo import gdal
+        from ArrNorm.core import iMad
+
+        tiles = []
+        datasets = [gdal.Open(self.ref), gdal.Open(self.target)]
+        bands = [[ds.GetRasterBand(b + 1) for b in range(self.bands)] for ds in datasets]
+        for y, n in iMad._iter_row_blocks(self.rows, block_rows):
+            tiles.append(tuple(iMad._read_block(rb, 0, y, self.cols, n) for rb in bands))
+        return tiles
+
+    def imad(self, tiles):
+        from ArrNorm.core import iMad
+        from ArrNorm.core.cli import ConsoleFeedback
+
+        # conv_threshold 1 never converges: always IMAD_ITERATIONS iterations
+        iMad.irmad_chunks(lambda: iter(tiles), self.bands, max_iters=IMAD_ITERATIONS, conv_threshold=1.0,
+                          feedback=ConsoleFeedback(quiet=True))
+
+    def write(self, block_rows, name):
+        from ArrNorm.core import raster_ops
+
+        output = os.path.join(self.workdir, name + '.tif')
+        raster_ops.no_negative_value(self.target, output, block_rows=block_rows)
+        os.remove(output)
+
+    def run(self, block_rows, name='write'):
+        """Seconds of the read, imad and write kernels at this block height."""
+        timings = {}
+        t0 = time.perf_counter()
+        tiles = self.read(block_rows)
+        timings['read_s'] = time.perf_counter() - t0
+        timings['imad_s'] = _timed(self.imad, tiles)
+        timings['write_s'] = _timed(self.write, block_rows, name)
+        return timings
+
+
+def _concurrent(sample, block_rows, workers):
+    """Wall seconds of `workers` kernel runs side by side."""
+    errors = []
+
+    def one(i):
+        try:
+            sample.run(block_rows, name='write_{}'.format(i))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=one, args=(i,)) for i in range(workers)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - t0
+
+
+def autotune(img_ref, img_target, block_rows=BLOCK_ROWS, workers=WORKERS, gdal_cache_mb=GDAL_CACHE_MB,
+             sample_rows=SAMPLE_ROWS, repeat=2, feedback=None):
+    """Benchmark the kernels on a sample of the images and return the best profile.
+
+    Every measurement is the best of *repeat* runs. The returned dict holds
+    'block_rows', 'stage_workers' and 'gdal_cache_mb' plus the timings.
+    """
+    from osgeo import gdal
+
+    def _info(msg):
+        if feedback is not None:
+            feedback.pushInfo(msg)
+        else:
+            print(msg)
+
+    runs = range(max(1, repeat))
+
+    def kernels(rows):
+        timings = sample.run(rows)
+        timings['total_s'] = sum(timings.values())
+        return {k: round(v, 6) for k, v in timings.items()}
+
+    workdir = tempfile.mkdtemp(prefix='arrnorm-autotune-')
+    cache_before = gdal.GetCacheMax()
+    try:
+        sample = _Sample(img_ref, img_target, sample_rows, workdir)
+        pixels = sample.cols * sample.rows
+        _info('Autotune sample: {} x {} pixels, {} bands'.format(sample.cols, sample.rows, sample.bands))
+
+        by_rows = {}
+        for rows in sorted(set(min(r, sample.rows) for r in block_rows)):
+            by_rows[rows] = min((kernels(rows) for _ in runs), key=lambda t: t['total_s'])
+            _info(' block rows {:>5}: read {read_s:.3f}s  imad {imad_s:.3f}s  write {write_s:.3f}s'.format(
+                rows, **by_rows[rows]))
+        best_rows = min(by_rows, key=lambda r: by_rows[r]['total_s'])
+
+        by_workers = {}
+        best_workers, best_rate = 1, 0.0
+        for w in sorted(set(workers)):
+            wall = min(_concurrent(sample, best_rows, w) for _ in runs)
+            rate = w * pixels / wall / 1e6
+            by_workers[w] = {'wall_s': round(wall, 6), 'mpix_per_s': round(rate, 3)}
+            _info(' stage workers {:>2}: {:.2f} Mpix/s'.format(w, rate))
+            if rate > best_rate * MIN_GAIN:
+                best_workers, best_rate = w, rate
+
+        by_cache = {}
+        best_cache, best_time = None, float('inf')
+        for mb in sorted(set(gdal_cache_mb)):
+            gdal.SetCacheMax(int(mb) * 1024 * 1024)
+            sample.read(best_rows)  # warm the cache, then time the re-read
+            by_cache[mb] = round(min(_timed(sample.read, best_rows) for _ in runs), 6)
+            _info(' GDAL cache {:>5} MB: re-read {:.3f}s'.format(mb, by_cache[mb]))
+            if by_cache[mb] * MIN_GAIN < best_time:
+                best_cache, best_time = mb, by_cache[mb]
+    finally:
+        gdal.SetCacheMax(cache_before)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'block_rows': best_rows,
+        'stage_workers': best_workers,
+        'gdal_cache_mb': best_cache,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cpu_count': os.cpu_count(),
+        'sample': {'image': os.path.abspath(img_target), 'cols': sample.cols, 'rows': sample.rows,
+                   'bands': sample.bands},
+        'timings': {'block_rows': by_rows, 'stage_workers': by_workers, 'gdal_cache_mb': by_cache},
+    }
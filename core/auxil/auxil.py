@@ -3,25 +3,34 @@
 #  Name:     auxil.py
 #  Purpose:  Math primitives used by the IR-MAD / RadCal / Register pipeline.
 #
-#  Only four symbols are exported:
+#  Only six symbols are exported:
 #     Cpm           -- weighted streaming mean / covariance accumulator
 #     geneiv        -- symmetric generalized eigenproblem  A x = lambda B x
 #     orthoregress  -- orthogonal (total-least-squares) regression
+#     orthoregress_moments -- the same from means and (co)variances
 #     similarity    -- log-polar Fourier image-image similarity transform
+#     translation   -- phase-correlation translation only
 #
 #  Original auxiliaries: M. Canty 2012 (DWT, ATWT, PCA, MNF, kernels, PNG
 #  output, ENVI header parsing, supervised classifiers, congrid, ...) were
 #  not used by the IR-MAD pipeline and have been removed.
 #
+#  scipy.fft and scipy.ndimage are imported inside the registration
+#  functions, so the IR-MAD / RadCal path never loads them.
+#
+#  The high-pass filter and log-polar grids are cached per tile shape, but
+#  only up to GRID_CACHE_MAX_PIXELS: a full-scene grid (16 bytes a pixel)
+#  is rebuilt on every call instead of being kept for the whole process.
+#
 #  License: GPLv2+
 # ******************************************************************************
 
+import functools
 import math
 
 import numpy as np
 import scipy.linalg
-import scipy.ndimage as ndii
-from numpy.fft import fft2, fftshift, ifft2
+from numpy.fft import fftshift
 
 
 # -----------------
@@ -122,6 +131,11 @@ def orthoregress(x, y):
     sxx = np.dot(dx, dx) / n
     syy = np.dot(dy, dy) / n
     sxy = np.dot(dx, dy) / n
+    return orthoregress_moments(xm, ym, sxx, syy, sxy)
+
+
+def orthoregress_moments(xm, ym, sxx, syy, sxy):
+    """orthoregress from the means and (co)variances of x and y."""
     denom = math.sqrt(sxx * syy)
     R = sxy / denom if denom > 0.0 else 0.0
     if sxy == 0.0:
@@ -134,7 +148,100 @@ def orthoregress(x, y):
 # image-image similarity (Fourier log-polar)
 # -----------------------------
 
-def similarity(bn0, bn1):
+# Largest grid kept by the shape caches: 1024 x 1024 pixels is 16 MiB for a
+# log-polar grid plus 8 MiB for the filter, so at most ~400 MiB for 16 shapes
+GRID_CACHE_MAX_PIXELS = 1024 * 1024
+GRID_CACHE_SHAPES = 16
+
+
+def _cached_by_shape(func):
+    """lru_cache func(shape, ...) for shapes up to GRID_CACHE_MAX_PIXELS pixels only."""
+    cached = functools.lru_cache(maxsize=GRID_CACHE_SHAPES)(func)
+
+    @functools.wraps(func)
+    def wrapper(shape, *args):
+        if shape[0] * shape[1] > GRID_CACHE_MAX_PIXELS:
+            return func(shape, *args)
+        return cached(shape, *args)
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@_cached_by_shape
+def _highpass(shape):
+    """High-pass cosine filter to suppress DC before log-polar mapping.
+
+    Depends only on the shape, so it is built once per tile size.
+    """
+    x = np.outer(
+        np.cos(np.linspace(-math.pi / 2., math.pi / 2., shape[0])),
+        np.cos(np.linspace(-math.pi / 2., math.pi / 2., shape[1])))
+    h = (1.0 - x) * (2.0 - x)
+    h.flags.writeable = False
+    return h
+
+
+@_cached_by_shape
+def _logpolar_grid(shape, angles, radii):
+    """map_coordinates sample grid and log base for a log-polar mapping."""
+    center = shape[0] / 2, shape[1] / 2
+    theta = np.empty((angles, radii), dtype=np.float64)
+    theta.T[:] = -np.linspace(0, np.pi, angles, endpoint=False)
+    d = np.hypot(shape[0] - center[0], shape[1] - center[1])
+    log_base = 10.0 ** (math.log10(d) / radii)
+    radius = np.empty_like(theta)
+    radius[:] = np.power(log_base, np.arange(radii, dtype=np.float64)) - 1.0
+    coords = np.array([radius * np.sin(theta) + center[0],
+                       radius * np.cos(theta) + center[1]])
+    coords.flags.writeable = False
+    return coords, log_base
+
+
+def _logpolar(image):
+    """Map `image` into log-polar coordinates, return (image, log_base)."""
+    coords, log_base = _logpolar_grid(image.shape, image.shape[0], image.shape[1])
+    import scipy.ndimage as ndii
+
+    output = np.empty(image.shape, dtype=np.float64)
+    ndii.map_coordinates(image, coords, output=output)
+    return output, log_base
+
+
+def _magnitude_spectrum(image, workers=None):
+    """abs(fft2(image)) of a real image, computed with a real-input FFT.
+
+    rfft2 only returns the non-negative column frequencies; the others
+    follow from Hermitian symmetry |F[r, c]| = |F[-r, -c]|.
+    """
+    from scipy import fft as sp_fft
+
+    n0, n1 = image.shape
+    half = np.abs(sp_fft.rfft2(image, workers=workers))
+    h = half.shape[1]
+    full = np.empty((n0, n1), dtype=half.dtype)
+    full[:, :h] = half
+    if n1 > h:
+        full[:, h:] = half[(-np.arange(n0)) % n0][:, n1 - np.arange(h, n1)]
+    return full
+
+
+def _phase_correlation(a, b, workers=None):
+    """abs of the phase-correlation surface of two real images of equal shape.
+
+    The images are not zero-padded to a faster FFT size: pocketfft is
+    O(n log n) for any size, and padding moves the correlation peak on
+    featureless tiles, so estimates would no longer match numpy.fft.
+    """
+    from scipy import fft as sp_fft
+
+    fa = sp_fft.rfft2(a, workers=workers)
+    fb = sp_fft.rfft2(b, workers=workers)
+    return np.abs(sp_fft.irfft2((fa * fb.conjugate()) / (np.abs(fa) * np.abs(fb)),
+                                s=a.shape, workers=workers))
+
+
+def similarity(bn0, bn1, workers=None):
     """Estimate (scale, angle, [t_row, t_col]) registering bn1 -> bn0.
 
     Uses the Reddy-Chatterji log-polar / Fourier cross-correlation
@@ -142,58 +249,36 @@ def similarity(bn0, bn1):
     spectrum in log-polar coordinates, then translation is recovered
     from phase correlation of the rectified images.
 
+    All transforms are real-input FFTs from scipy.fft; *workers* is
+    passed through to them (-1 uses every core). The high-pass filter
+    and the log-polar sample grids are cached per tile shape.
+
     Adapted from M. Canty 2012 / Christoph Gohlke's Imreg.py.
     """
-
-    def highpass(shape):
-        """High-pass cosine filter to suppress DC before log-polar mapping."""
-        x = np.outer(
-            np.cos(np.linspace(-math.pi / 2., math.pi / 2., shape[0])),
-            np.cos(np.linspace(-math.pi / 2., math.pi / 2., shape[1])))
-        return (1.0 - x) * (2.0 - x)
-
-    def logpolar(image, angles=None, radii=None):
-        """Map `image` into log-polar coordinates, return (image, log_base)."""
-        shape = image.shape
-        center = shape[0] / 2, shape[1] / 2
-        if angles is None:
-            angles = shape[0]
-            if radii is None:
-                radii = shape[1]
-        theta = np.empty((angles, radii), dtype=np.float64)
-        theta.T[:] = -np.linspace(0, np.pi, angles, endpoint=False)
-        d = np.hypot(shape[0] - center[0], shape[1] - center[1])
-        log_base = 10.0 ** (math.log10(d) / radii)
-        radius = np.empty_like(theta)
-        radius[:] = np.power(log_base, np.arange(radii, dtype=np.float64)) - 1.0
-        x = radius * np.sin(theta) + center[0]
-        y = radius * np.cos(theta) + center[1]
-        output = np.empty_like(x)
-        ndii.map_coordinates(image, [x, y], output=output)
-        return output, log_base
+    import scipy.ndimage as ndii
+    from scipy import fft as sp_fft
 
     lines0, samples0 = bn0.shape
     bn1 = bn1[0:lines0, 0:samples0]  # crop to reference shape
+    # transform in double precision like numpy.fft (scipy.fft keeps float32)
+    bn0 = np.asarray(bn0, dtype=np.float64)
 
     # ---- scale + angle from log-polar of magnitude spectra
-    f0 = fftshift(abs(fft2(bn0)))
-    f1 = fftshift(abs(fft2(bn1)))
-    h = highpass(f0.shape)
-    f0 *= h
-    f1 *= h
-    del h
-    f0, log_base = logpolar(f0)
-    f1, log_base = logpolar(f1)
-    f0 = fft2(f0)
-    f1 = fft2(f1)
+    h = _highpass(bn0.shape)
+    f0 = fftshift(_magnitude_spectrum(bn0, workers)) * h
+    f1 = fftshift(_magnitude_spectrum(np.asarray(bn1, dtype=np.float64), workers)) * h
+    f0, log_base = _logpolar(f0)
+    f1, log_base = _logpolar(f1)
+    f0 = sp_fft.rfft2(f0, workers=workers)
+    f1 = sp_fft.rfft2(f1, workers=workers)
     r0 = abs(f0) * abs(f1)
-    ir = abs(ifft2((f0 * f1.conjugate()) / r0))
+    ir = abs(sp_fft.irfft2((f0 * f1.conjugate()) / r0, s=bn0.shape, workers=workers))
     i0, i1 = np.unravel_index(np.argmax(ir), ir.shape)
     angle = 180.0 * i0 / ir.shape[0]
     scale = log_base ** i1
     if scale > 1.8:
         # try the inverse direction
-        ir = abs(ifft2((f1 * f0.conjugate()) / r0))
+        ir = abs(sp_fft.irfft2((f1 * f0.conjugate()) / r0, s=bn0.shape, workers=workers))
         i0, i1 = np.unravel_index(np.argmax(ir), ir.shape)
         angle = -180.0 * i0 / ir.shape[0]
         scale = 1.0 / (log_base ** i1)
@@ -213,12 +298,26 @@ def similarity(bn0, bn1):
         bn2 = t
     elif bn2.shape > bn0.shape:
         bn2 = bn2[:bn0.shape[0], :bn0.shape[1]]
-    f0 = fft2(bn0)
-    f1 = fft2(bn2)
-    ir = abs(ifft2((f0 * f1.conjugate()) / (abs(f0) * abs(f1))))
+    return (scale, angle, translation(bn0, bn2, workers=workers))
+
+
+def translation(bn0, bn1, workers=None):
+    """Estimate the integer [t_row, t_col] shift registering bn1 -> bn0.
+
+    Phase correlation only (no scale or rotation); bn1 is cropped or
+    zero-padded to the shape of bn0.
+    """
+    bn0 = np.asarray(bn0, dtype=np.float64)
+    bn1 = np.asarray(bn1, dtype=np.float64)
+    if bn1.shape != bn0.shape:
+        t = np.zeros_like(bn0)
+        rows, cols = min(bn0.shape[0], bn1.shape[0]), min(bn0.shape[1], bn1.shape[1])
+        t[:rows, :cols] = bn1[:rows, :cols]
+        bn1 = t
+    ir = _phase_correlation(bn0, bn1, workers=workers)
     t0, t1 = np.unravel_index(np.argmax(ir), ir.shape)
-    if t0 > f0.shape[0] // 2:
-        t0 -= f0.shape[0]
-    if t1 > f0.shape[1] // 2:
-        t1 -= f0.shape[1]
-    return (scale, angle, [t0, t1])
+    if t0 > ir.shape[0] // 2:
+        t0 -= ir.shape[0]
+    if t1 > ir.shape[1] // 2:
+        t1 -= ir.shape[1]
+    return [t0, t1]
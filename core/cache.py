@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     cache.py
+#  Purpose:  Content-addressed cache for intermediate pipeline artifacts.
+#
+#  Normalization.clean() deletes the aligned reference and the IR-MAD output
+#  at the end of every run, so re-running with only a different RadCal or
+#  masking setting repeats the clipper warp and the whole IR-MAD loop. When
+#  a cache directory is given, those artifacts are stored under a key built
+#  from a fingerprint of the input files (size, mtime and optionally a hash
+#  of the content) plus the stage parameters, and later runs pick them up
+#  instead of recomputing.
+#
+#  Layout:  <cache_dir>/<key>/entry.json  + the cached files
+#  The mtime of entry.json is the "last used" time: the cache is trimmed
+#  least-recently-used first whenever it grows above max_bytes.
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# Default size cap for the whole cache directory (5 GiB).
+DEFAULT_MAX_BYTES = 5 * 1024 ** 3
+
+_ENTRY_FILE = 'entry.json'
+_HASH_CHUNK = 1024 * 1024
+
+
+def _file_digest(path):
+    """SHA-256 of the file content, read in 1 MiB chunks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path, content_hash=False):
+    """Identity of a file: real path, size and mtime, or size and content hash."""
+    st = os.stat(path)
+    if content_hash:
+        return {'size': st.st_size, 'sha256': _file_digest(path)}
+    return {'path': os.path.realpath(path), 'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns}
+
+
+def fingerprint(files, params=None, content_hash=False):
+    """Return a hex key for the given input files and stage parameters.
+
+    Parameters must be JSON-serializable; keys are sorted so the order
+    in which they are given does not matter.
+    """
+    payload = {
+        'files': [file_fingerprint(f, content_hash) for f in files],
+        'params': params or {},
+    }
+    blob = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()[:32]
+
+
+def _dir_size(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class StageCache(object):
+    """Directory cache of stage outputs keyed by input fingerprints.
+
+    With content_hash=False (the default) a file is identified by its real
+    path, size and modification time, which is cheap even for very large
+    rasters. With content_hash=True the path is left out and the file
+    content is hashed instead, so identical copies share cache entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, content_hash=False):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # -- keys ---------------------------------------------------------------
+
+    def file_fingerprint(self, path):
+        return file_fingerprint(path, self.content_hash)
+
+    def fingerprint(self, files, params=None):
+        """Return a hex key for the given input files and stage parameters."""
+        return fingerprint(files, params, self.content_hash)
+
+    # -- entries ------------------------------------------------------------
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """Return {name: path} for a cached entry, or None on a miss.
+
+        A hit refreshes the entry's last-used time.
+        """
+        entry_dir = self._entry_dir(key)
+        entry_file = os.path.join(entry_dir, _ENTRY_FILE)
+        try:
+            with open(entry_file) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        files = {name: os.path.join(entry_dir, fn) for name, fn in entry['files'].items()}
+        if not all(os.path.exists(p) for p in files.values()):
+            return None
+        try:
+            os.utime(entry_file)
+        except OSError:
+            pass
+        return files
+
+    def put(self, key, files, stage=None, replace=False):
+        """Move the given {name: path} files into the cache under key.
+
+        The entry is assembled in a temporary directory and renamed into
+        place, so concurrent readers never see a partial entry. If another
+        run stored the same key first, its entry is kept (it may be in use)
+        and the given files are dropped, unless replace is set for files
+        that readers load at once and never keep open. Returns the cached {name: path}
+        mapping; the caller should use those paths from now on, since the
+        originals have been moved.
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        names = {}
+        try:
+            for name, path in files.items():
+                fn = os.path.basename(path)
+                shutil.move(path, os.path.join(tmp_dir, fn))
+                names[name] = fn
+            with open(os.path.join(tmp_dir, _ENTRY_FILE), 'w') as f:
+                json.dump({'stage': stage, 'created': time.time(), 'files': names}, f)
+            existing = self.get(key)
+            if existing is not None and replace:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                existing = None
+            if existing is None:
+                if os.path.exists(entry_dir):  # incomplete leftover
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                try:
+                    os.rename(tmp_dir, entry_dir)
+                except OSError:
+                    existing = self.get(key)
+                    if existing is None:
+                        raise
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        if existing is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return existing
+        self.evict(keep=key)
+        return {name: os.path.join(entry_dir, fn) for name, fn in names.items()}
+
+    def entries(self):
+        """Return [(last_used, size, key)] for every complete entry."""
+        result = []
+        for key in os.listdir(self.cache_dir):
+            entry_file = os.path.join(self.cache_dir, key, _ENTRY_FILE)
+            if key.startswith('.') or not os.path.exists(entry_file):
+                continue
+            result.append((os.path.getmtime(entry_file),
+                           _dir_size(self._entry_dir(key)), key))
+        return result
+
+    def evict(self, keep=None):
+        """Delete least-recently-used entries until the cache fits max_bytes."""
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def owns(self, path):
+        """True if path lives inside the cache directory."""
+        if not path:
+            return False
+        path = os.path.abspath(path)
+        return os.path.commonpath([path, self.cache_dir]) == self.cache_dir
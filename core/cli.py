@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     cli.py
+#  Purpose:  Headless command-line runner for the normalization pipeline.
+#
+#  Drives Normalization without QGIS, for one reference/target pair or for a
+#  job manifest with many pairs:
+#
+#    python -m ArrNorm ref.tif target.tif -o target_norm.tif
+#    python -m ArrNorm --manifest jobs.json -j 4 --summary summary.json
+#
+#  A manifest is a JSON list (or one JSON object per line) of jobs with
+#  'ref', 'target' and optionally 'output' plus any option of the command
+#  line (e.g. "ncp_threshold": 0.9) overriding it for that job. Jobs run in
+#  separate processes, -j at a time, each in its own scratch directory. The
+#  summary lists status, output, elapsed time and error of every job; the
+#  exit status is 1 if any job failed.
+#
+#  With --serve ADDRESS the same options become the defaults of a resident
+#  worker service taking jobs over HTTP (see service.py), -j at a time.
+#
+#  --autotune ref.tif target.tif benchmarks this machine on the pair and
+#  saves the fastest block size, stage workers and GDAL cache as the tuning
+#  profile (see autotune.py) that later runs pick up.
+#
+#  --apply COEFFS.json a.tif b.tif ... applies the RadCal coefficients saved
+#  by --save-coefficients to every raster, -j at a time, without IR-MAD:
+#
+#    python -m ArrNorm --apply target_norm_radcal.json scene1.tif scene2.tif -j 4
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from ArrNorm.core.autotune import default_profile_path, load_profile
+from ArrNorm.core.memory import parse_size
+
+# Normalization options accepted on the command line and in manifest jobs,
+# with the defaults of the QGIS algorithm
+DEFAULTS = {
+    'max_iters': 25,
+    'conv_threshold': 0.99,
+    'ncp_threshold': 0.95,
+    'neg_to_nodata': False,
+    'mask_ref': False,
+    'mask_ref_nodata': None,
+    'nodata_mask': True,
+    'nodata_mask_value': None,
+    'keep_mask_layer': False,
+    'register_target': False,
+    'output_format': 'GTiff',
+    'scaled_output': None,
+    'cache_dir': None,
+    'perf_report': False,
+    'stage_workers': None,
+    'memory_budget': None,
+    'tuning_profile': None,
+    'imad_iteration': None,
+    'export_trace': False,
+    'ncp_sweep': None,
+    'save_coefficients': False,
+    'change_map': None,
+    'tiles': None,
+    'tile_workers': None,
+    'tile_min_pixels': None,
+}
+
+
+class ConsoleFeedback(object):
+    """Plain stand-in for QgsProcessingFeedback that logs to a stream."""
+
+    def __init__(self, prefix='', stream=None, quiet=False):
+        self.prefix = prefix
+        self.stream = stream or sys.stderr
+        self.quiet = quiet
+        self.progress = 0
+        self.canceled = False
+
+    def pushInfo(self, msg):
+        if not self.quiet:
+            for line in str(msg).strip('\n').splitlines():
+                print(self.prefix + line, file=self.stream, flush=True)
+
+    def reportError(self, msg, fatalError=False):
+        print(self.prefix + 'ERROR: ' + str(msg).strip('\n'), file=self.stream, flush=True)
+
+    def setProgress(self, value):
+        self.progress = value
+
+    def isCanceled(self):
+        return self.canceled
+
+
+def default_output(target, output_dir=None):
+    root, ext = os.path.splitext(os.path.basename(target))
+    return os.path.join(output_dir or os.path.dirname(os.path.abspath(target)), root + '_norm' + ext)
+
+
+def load_manifest(path):
+    """Jobs of a manifest file: a JSON list, or one JSON object per line."""
+    with open(path) as f:
+        text = f.read()
+    try:
+        jobs = json.loads(text)
+    except ValueError:
+        jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(jobs, dict):
+        jobs = [jobs]
+    for i, job in enumerate(jobs):
+        try:
+            validate_job(job)
+        except ValueError as e:
+            raise ValueError('job {} of {} {}'.format(i, path, e))
+    return jobs
+
+
+def validate_job(job):
+    """Raise ValueError unless job is a dict with 'ref', 'target' and known options."""
+    if not isinstance(job, dict):
+        raise ValueError('is not a JSON object')
+    missing = {'ref', 'target'} - set(job)
+    if missing:
+        raise ValueError('lacks {}'.format(', '.join(sorted(missing))))
+    unknown = set(job) - {'ref', 'target', 'output'} - set(DEFAULTS)
+    if unknown:
+        raise ValueError('has unknown options: {}'.format(', '.join(sorted(unknown))))
+
+
+def run_job(job, options, quiet=False, feedback=None):
+    """Run one job and return its summary record (never raises)."""
+    from ArrNorm.core.arrnorm import Normalization
+
+    params = {k: v for k, v in options.items() if k in DEFAULTS}
+    params.update({k: v for k, v in job.items() if k in DEFAULTS})
+    if options.get('cache_max_bytes') is not None:
+        params['cache_max_bytes'] = options['cache_max_bytes']
+    output = job.get('output') or default_output(job['target'], options.get('output_dir'))
+    record = {'ref': job['ref'], 'target': job['target'], 'output': output}
+    if feedback is None:
+        feedback = ConsoleFeedback(prefix='[{}] '.format(os.path.basename(job['target'])), quiet=quiet)
+    start = time.time()
+    try:
+        norm = Normalization(img_ref=job['ref'], img_target=job['target'], output_file=output,
+                             feedback=feedback, **params)
+        norm.run()
+        record['status'] = 'canceled' if feedback.isCanceled() else 'ok'
+        if norm.mask_file and params.get('keep_mask_layer'):
+            record['mask'] = norm.mask_file
+        if norm.perf_file:
+            record['perf_report'] = norm.perf_file
+        if norm.coefficients_file:
+            record['coefficients'] = norm.coefficients_file
+        if norm.change_map_file:
+            record['change_map'] = norm.change_map_file
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = str(e).strip()
+        feedback.reportError(traceback.format_exc())
+    record['elapsed_s'] = round(time.time() - start, 3)
+    return record
+
+
+def set_gdal_cache(gdal_cache_mb):
+    """GDAL block cache size of this process, in MB (None keeps GDAL's default)."""
+    if gdal_cache_mb:
+        from osgeo import gdal
+        gdal.SetCacheMax(int(gdal_cache_mb) * 1024 * 1024)
+
+
+def run_jobs(jobs, options, workers=1, quiet=False, gdal_cache_mb=None):
+    """Run the jobs, `workers` processes at a time; records in job order."""
+    if workers <= 1 or len(jobs) <= 1:
+        set_gdal_cache(gdal_cache_mb)
+        return [run_job(job, options, quiet) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_gdal_cache, initargs=(gdal_cache_mb,)) as pool:
+        futures = [pool.submit(run_job, job, options, quiet) for job in jobs]
+        return [f.result() for f in futures]
+
+
+def _thresholds(value):
+    return [float(t) for t in value.split(',') if t.strip()]
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m ArrNorm',
+        description='Automatic relative radiometric normalization (IR-MAD + RadCal) without QGIS.')
+    parser.add_argument('images', nargs='*', metavar='IMAGE',
+                        help='reference and target image, or the rasters of --apply')
+    parser.add_argument('-o', '--output', help='normalized output (default: <target>_norm next to the target)')
+    parser.add_argument('-m', '--manifest', help='JSON job manifest with many ref/target pairs')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='jobs run concurrently (default 1)')
+    parser.add_argument('-s', '--summary', help='write a JSON summary of all jobs here')
+    parser.add_argument('--output-dir', help='directory for outputs not given explicitly')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only report errors')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='run as a worker service on host:port or unix:/path/to/socket')
+    parser.add_argument('--gdal-cache-mb', type=int,
+                        help='GDAL block cache size of each job process or of the service')
+    parser.add_argument('--autotune', action='store_true',
+                        help='benchmark this machine on the ref/target pair and save the tuning profile')
+    parser.add_argument('--apply', metavar='COEFFS',
+                        help='apply the RadCal coefficients of a --save-coefficients file to the rasters')
+
+    group = parser.add_argument_group('normalization options')
+    group.add_argument('--max-iters', type=int, default=DEFAULTS['max_iters'])
+    group.add_argument('--conv-threshold', type=float, default=DEFAULTS['conv_threshold'])
+    group.add_argument('--ncp-threshold', type=float, default=DEFAULTS['ncp_threshold'])
+    group.add_argument('--neg-to-nodata', action='store_true')
+    group.add_argument('--mask-ref', action='store_true')
+    group.add_argument('--mask-ref-nodata', type=float)
+    group.add_argument('--nodata-mask', action=argparse.BooleanOptionalAction, default=DEFAULTS['nodata_mask'])
+    group.add_argument('--nodata-mask-value', type=float)
+    group.add_argument('--keep-mask-layer', action='store_true')
+    group.add_argument('--register-target', action='store_true')
+    group.add_argument('--output-format', choices=('GTiff', 'COG'), default=DEFAULTS['output_format'])
+    group.add_argument('--scaled-output', choices=('UInt16', 'Int16'))
+    group.add_argument('--cache-dir')
+    group.add_argument('--cache-max-gb', type=float)
+    group.add_argument('--perf-report', action='store_true')
+    group.add_argument('--stage-workers', type=int, help='default: tuning profile, else 2')
+    group.add_argument('--memory-budget', type=parse_size, metavar='SIZE',
+                       help="memory per job, e.g. 512M or 4G; sizes blocks, caches and stage workers, "
+                            "and warns about stages whose resident memory exceeds it")
+    group.add_argument('--imad-iteration', type=int, metavar='N',
+                       help='keep IR-MAD iteration N instead of the one chosen by --conv-threshold')
+    group.add_argument('--export-trace', action='store_true',
+                       help='write the IR-MAD iterations as <output>_irmad_trace.csv/.json')
+    group.add_argument('--ncp-sweep', type=_thresholds, metavar='T1,T2,...',
+                       help='report the RadCal fit for these NCP thresholds too (<output>_ncp_sweep.csv/.json)')
+    group.add_argument('--save-coefficients', action='store_true',
+                       help='write the RadCal coefficients as <output>_radcal.json, for --apply')
+    group.add_argument('--change-map', choices=('ncp', 'mask'),
+                       help='write <output>_change.tif from the IR-MAD output pass: the UInt8 no-change '
+                            'probability, or 1 where it is not above --ncp-threshold')
+    group.add_argument('--tiles', metavar='ROWSxCOLS',
+                       help='fit IR-MAD and RadCal per tile of this grid (e.g. 4 or 3x5) and interpolate '
+                            'the coefficients per pixel')
+    group.add_argument('--tile-workers', type=int, help='tiles fitted side by side (default: all CPUs)')
+    group.add_argument('--tile-min-pixels', type=int,
+                       help='no-change pixels a tile needs for its own fit, else it takes its '
+                            "neighbors' (default 500)")
+    group.add_argument('--tuning-profile', metavar='PATH',
+                       help='tuning profile to read or --autotune to write (default: {})'.format(
+                           default_profile_path()))
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    if args.apply:
+        if not args.images or args.manifest or args.serve or args.autotune:
+            parser.error('--apply takes the rasters to normalize')
+        if args.output and len(args.images) > 1:
+            parser.error('-o takes a single raster, use --output-dir for many')
+        return _apply(args)
+    if len(args.images) > 2:
+        parser.error('expected a reference and a target image, got {}'.format(len(args.images)))
+    args.ref, args.target = (args.images + [None, None])[:2]
+
+    if args.autotune:
+        if not (args.ref and args.target) or args.manifest or args.serve:
+            parser.error('--autotune takes one reference and one target image')
+        return _autotune(args)
+    if args.serve:
+        if args.manifest or args.ref or args.target:
+            parser.error('--serve takes its jobs from clients, not from the command line')
+    elif args.manifest:
+        if args.ref or args.target or args.output:
+            parser.error('give either a manifest or a ref/target pair, not both')
+        try:
+            jobs = load_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    elif args.ref and args.target:
+        jobs = [{'ref': args.ref, 'target': args.target, 'output': args.output}]
+    else:
+        parser.error('a reference and a target image, or --manifest, are required')
+
+    options = {k: getattr(args, k) for k in DEFAULTS}
+    options['output_dir'] = args.output_dir
+    if args.cache_max_gb is not None:
+        options['cache_max_bytes'] = int(args.cache_max_gb * 1024 ** 3)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    gdal_cache_mb = args.gdal_cache_mb or load_profile(args.tuning_profile).get('gdal_cache_mb')
+
+    if args.serve:
+        from ArrNorm.core.service import serve
+        serve(args.serve, options, workers=args.jobs, gdal_cache_mb=gdal_cache_mb, quiet=args.quiet)
+        return 0
+
+    start = time.time()
+    records = run_jobs(jobs, options, workers=args.jobs, quiet=args.quiet, gdal_cache_mb=gdal_cache_mb)
+    return 1 if _summarize(records, start, args.summary) else 0
+
+
+def _summarize(records, start, path=None):
+    """Print one line per record, write the JSON summary if asked; return the failures."""
+    failed = sum(r['status'] != 'ok' for r in records)
+    summary = {'jobs': len(records), 'ok': len(records) - failed, 'failed': failed,
+               'elapsed_s': round(time.time() - start, 3), 'results': records}
+    if path:
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+    for r in records:
+        print('{:<5} {:8.1f}s  {}'.format(r['status'], r['elapsed_s'],
+                                           r['output'] if r['status'] == 'ok' else r.get('error', '')))
+    return failed
+
+
+def _apply(args):
+    from ArrNorm.core import radcal
+
+    try:
+        coefficients = radcal.load_coefficients(args.apply)
+    except (OSError, ValueError) as e:
+        ConsoleFeedback().reportError(str(e))
+        return 1
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    set_gdal_cache(args.gdal_cache_mb or load_profile(args.tuning_profile).get('gdal_cache_mb'))
+    pairs = [(image, args.output or default_output(image, args.output_dir)) for image in args.images]
+    start = time.time()
+    records = radcal.apply_many(pairs, coefficients, workers=args.jobs, creation_options=['BIGTIFF=IF_SAFER'])
+    return 1 if _summarize(records, start, args.summary) else 0
+
+
+def _autotune(args):
+    from ArrNorm.core.autotune import autotune, save_profile
+
+    feedback = ConsoleFeedback(quiet=args.quiet)
+    try:
+        profile = autotune(args.ref, args.target, feedback=feedback)
+    except Exception as e:
+        feedback.reportError(str(e))
+        return 1
+    path = save_profile(profile, args.tuning_profile)
+    print('block rows {block_rows}, stage workers {stage_workers}, GDAL cache {gdal_cache_mb} MB'.format(
+        **profile))
+    print('tuning profile saved to ' + path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
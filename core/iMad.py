@@ -7,31 +7,32 @@
 #  Original algorithm: M. J. Canty (2014). Refactored for numerical
 #  stability and performance: see comments inline.
 #
+#  The output pass can also write a compact UInt8 change map from the same
+#  blocks: the no-change probability quantized to NCP_CODES steps, or a
+#  binary change mask (1 where the probability is not above the RadCal
+#  threshold), with 255 as nodata.
+#
 #  License: GPLv2+
 # ******************************************************************************
 
+import csv
+import json
 import os
 import time
-from operator import itemgetter
 
 import numpy as np
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly, GDT_Float32
-from scipy import stats
+from scipy.special import chdtrc
 
 from ArrNorm.core.auxil import auxil
+from ArrNorm.core.memory import DEFAULT_BLOCK_ROWS
 
 try:
     from qgis.core import QgsProcessingException
 except ImportError:
     QgsProcessingException = Exception
 
-# Block height (in rows) used when streaming both images band-by-band into
-# the running covariance accumulator. Reading 256 rows at a time amortizes
-# the per-call GDAL overhead by ~256x vs the original row-by-row loop
-# while keeping peak memory bounded (256 * cols * 2*bands * 8 bytes).
-DEFAULT_BLOCK_ROWS = 256
-
 
 def _iter_row_blocks(rows, block_rows):
     """Yield (y_offset, n_rows) chunks covering [0, rows)."""
@@ -49,114 +50,288 @@ def _read_block(raster_bands, x0, y0, cols, n_rows):
     return tile
 
 
-def main(img_ref, img_target, max_iters=30, conv_threshold=0.99, band_pos=None, dims=None,
-          graphics=False, ref_text='', block_rows=DEFAULT_BLOCK_ROWS,
-          feedback=None):
-    gdal.AllRegister()
-    start = time.time()  # was previously undefined at print-elapsed time (bug)
-
-    # -- Logging helpers: use QGIS feedback when available, print otherwise --
-    def _info(msg):
-        if feedback is not None:
-            feedback.pushInfo(msg)
+def _mad_chisqr(tile_ref, tile_tgt, means1, means2, A, B, sigMADs):
+    """MAD variates and their standardized chi-square statistic for a tile."""
+    mads = (tile_ref - means1[0]) @ A - (tile_tgt - means2[0]) @ B
+    chisqr = np.sum((mads / sigMADs[0]) ** 2, axis=1)
+    return mads, chisqr
+
+
+def _chisqr_weights(tile_ref, tile_tgt, means1, means2, A, B, sigMADs):
+    """No-change probability of every pixel, used as the IR-MAD weight."""
+    _mads, chisqr = _mad_chisqr(tile_ref, tile_tgt, means1, means2, A, B, sigMADs)
+    # chi-square survival function (scipy.stats.chi2.sf without importing
+    # scipy.stats): 1 - cdf, but stable in the upper tail
+    return chdtrc(A.shape[1], chisqr)
+
+
+# UInt8 change maps: the no-change probability is stored as code * (1 / NCP_CODES)
+CHANGE_MAP_KINDS = ('ncp', 'mask')
+NCP_CODES = 250
+CHANGE_NODATA = 255
+
+
+class ChangeMapWriter(object):
+    """UInt8 change map written block by block from the chi-square of the MAD variates.
+
+    kind 'ncp' stores the no-change probability (scale 1/NCP_CODES), 'mask'
+    1 for change and 0 for no change at ncp_threshold. dof is the number of
+    MAD variates; pixels flagged nodata are written as CHANGE_NODATA.
+    """
+
+    def __init__(self, path, cols, rows, dof, kind='ncp', ncp_threshold=0.95, geotransform=None,
+                 projection=None):
+        if kind not in CHANGE_MAP_KINDS:
+            raise ValueError('Unknown change map: {}'.format(kind))
+        self.path = path
+        self.dof = dof
+        self.kind = kind
+        self.ncp_threshold = ncp_threshold
+        self.dataset = gdal.GetDriverByName('GTiff').Create(
+            path, cols, rows, 1, gdal.GDT_Byte, ['COMPRESS=DEFLATE', 'TILED=YES'])
+        if geotransform is not None:
+            self.dataset.SetGeoTransform(geotransform)
+        if projection is not None:
+            self.dataset.SetProjection(projection)
+        self.band = self.dataset.GetRasterBand(1)
+        self.band.SetNoDataValue(CHANGE_NODATA)
+        if kind == 'ncp':
+            self.band.SetScale(1.0 / NCP_CODES)
+            self.band.SetOffset(0.0)
+            self.band.SetDescription('no-change probability')
         else:
-            print(msg)
-
-    def _error(msg):
-        if feedback is not None:
-            feedback.reportError(msg, fatalError=True)
-        raise QgsProcessingException(msg)
-
-    def _canceled():
-        return feedback is not None and feedback.isCanceled()
-
-    path = os.path.dirname(os.path.abspath(img_ref))
-    basename1 = os.path.basename(img_ref)
-    root1, ext1 = os.path.splitext(basename1)
-    basename2 = os.path.basename(img_target)
-    root2, _ext2 = os.path.splitext(basename2)
-    outfn = os.path.join(path, f'MAD({root1}&{basename2}){ext1}')
-
-    inDataset1 = gdal.Open(img_ref, GA_ReadOnly)
-    inDataset2 = gdal.Open(img_target, GA_ReadOnly)
-    if inDataset1 is None or inDataset2 is None:
-        _error("Error: input image(s) could not be opened.")
-
-    cols = inDataset1.RasterXSize
-    rows = inDataset1.RasterYSize
-    bands = inDataset1.RasterCount
-    cols2 = inDataset2.RasterXSize
-    rows2 = inDataset2.RasterYSize
-    bands2 = inDataset2.RasterCount
-
-    if bands != bands2:
-        _error(
-            f"Band count mismatch between reference ({bands}) "
-            f"and target ({bands2}).")
-
-    if band_pos is None:
-        band_pos = list(range(1, bands + 1))
-    else:
-        bands = len(band_pos)
-
-    if dims is None:
-        x0 = y0 = 0
-    else:
-        x0, y0, cols, rows = dims
-
-    # If the target was warped during registration we assume it is already
-    # aligned to the reference origin; otherwise use the same window.
-    if root2.find('_warp') != -1:
-        x2 = y2 = 0
-    else:
-        x2, y2 = x0, y0
-
-    # Dimension guard: after clipper() in bin/arrnorm, both images MUST share
-    # the same pixel grid. Pixel-for-pixel alignment is required for IR-MAD.
-    if cols != cols2 or rows != rows2:
-        _error(
-            f"\n ERROR: Reference clip ({cols}x{rows}) and target "
-            f"({cols2}x{rows2}) have different pixel dimensions.\n"
-            f" Pixel-for-pixel alignment is required for IR-MAD. Ensure both "
-            f"images share the same CRS, pixel size, and spatial extent "
-            f"before running the normalization.\n")
-
-    _info('------------IRMAD -------------')
-    rasterBands1 = [inDataset1.GetRasterBand(b) for b in band_pos]
-    rasterBands2 = [inDataset2.GetRasterBand(b) for b in band_pos]
-
-    # Sanity-check: any band that is entirely zero would make the algorithm
-    # degenerate (singular covariance). Bail out early with a clear message.
-    for k, rb in enumerate(rasterBands1):
-        if not rb.ReadAsArray().any():
-            _error(f"\nERROR: band {band_pos[k]} of '{basename1}' has only "
-                   f"zeros — please check it.\n")
-    for k, rb in enumerate(rasterBands2):
-        if not rb.ReadAsArray().any():
-            _error(f"\nERROR: band {band_pos[k]} of '{basename2}' has only "
-                   f"zeros — please check it.\n")
+            self.band.SetDescription('change (NCP <= {})'.format(ncp_threshold))
 
+    def write(self, chisqr, y0, nodata=None):
+        """Write the (rows, cols) chi-square block at row y0; nodata is a boolean mask."""
+        ncp = chdtrc(self.dof, chisqr)
+        if self.kind == 'ncp':
+            codes = np.rint(ncp * NCP_CODES).astype(np.uint8)
+        else:
+            codes = (ncp <= self.ncp_threshold).astype(np.uint8)
+        if nodata is not None:
+            codes[nodata] = CHANGE_NODATA
+        self.band.WriteArray(codes, 0, y0)
+
+    def close(self):
+        self.band.FlushCache()
+        self.band = self.dataset = None
+        return self.path
+
+
+def change_map(img_imad, output, kind='ncp', ncp_threshold=0.95, img_target=None, nodata=None,
+               block_rows=DEFAULT_BLOCK_ROWS):
+    """Change map of an existing IR-MAD output, from its chi-square band.
+
+    With img_target and nodata, pixels whose first target band is nodata
+    are marked as nodata.
+    """
+    imadDataset = gdal.Open(img_imad, GA_ReadOnly)
+    if imadDataset is None:
+        raise QgsProcessingException(f'Error: could not open iMAD file: {img_imad}')
+    cols, rows = imadDataset.RasterXSize, imadDataset.RasterYSize
+    chisqrBand = imadDataset.GetRasterBand(imadDataset.RasterCount)
+    targetBand = None
+    if img_target is not None and nodata is not None:
+        targetDataset = gdal.Open(img_target, GA_ReadOnly)
+        if targetDataset is None:
+            raise QgsProcessingException(f'Error: could not open target image: {img_target}')
+        targetBand = targetDataset.GetRasterBand(1)
+    writer = ChangeMapWriter(output, cols, rows, imadDataset.RasterCount - 1, kind, ncp_threshold,
+                             imadDataset.GetGeoTransform(), imadDataset.GetProjection())
+    for y0, n in _iter_row_blocks(rows, block_rows):
+        mask = None
+        if targetBand is not None:
+            mask = _is_nodata(np.asarray(targetBand.ReadAsArray(0, y0, cols, n), dtype=np.float64), nodata)
+        writer.write(chisqrBand.ReadAsArray(0, y0, cols, n), y0, mask)
+    return writer.close()
+
+
+def _is_nodata(values, nodata):
+    # the IR-MAD tiles hold NaN as 0 (see _read_block)
+    values = np.nan_to_num(values)
+    return values == (0.0 if np.isnan(nodata) else nodata)
+
+
+class IRMadModel(object):
+    """Canonical transform found by IR-MAD.
+
+    A and B are the canonical vectors of the reference and target bands,
+    means1/means2 and sigMADs the centring and the MAD standard deviations
+    (as (1, bands) rows); rho are the canonical correlations, delta and
+    iteration those of the kept iteration and rhos the correlations of
+    every iteration; trace is the IRMadTrace of the run, if kept.
+    """
+
+    def __init__(self, A, B, means1, means2, sigMADs, rho, delta, iteration, rhos):
+        self.A = A
+        self.B = B
+        self.means1 = means1
+        self.means2 = means2
+        self.sigMADs = sigMADs
+        self.rho = rho
+        self.delta = delta
+        self.iteration = iteration
+        self.rhos = rhos
+        self.trace = None
+
+    @property
+    def bands(self):
+        return self.A.shape[1]
+
+    def transform(self, ref, tgt):
+        """MAD variates (bands, ...) and chi-square (...) of (bands, ...) arrays."""
+        shape = np.shape(ref)[1:]
+        mads, chisqr = _mad_chisqr(_pixels(ref), _pixels(tgt), self.means1, self.means2,
+                                   self.A, self.B, self.sigMADs)
+        return mads.T.reshape((self.bands,) + shape), chisqr.reshape(shape)
+
+    def ncp(self, ref, tgt):
+        """No-change probability (...) of (bands, ...) arrays."""
+        _mads, chisqr = self.transform(ref, tgt)
+        return chdtrc(self.bands, chisqr)
+
+
+class IRMadTrace(object):
+    """Every IR-MAD iteration of a run, to select the result again without iterating.
+
+    iterations is a list of dicts with 'iter', 'delta', 'rho', 'A', 'B',
+    'means1', 'means2', 'sigMADs' and the 'wall_s'/'cpu_s' timings; stopped
+    is 'converged', 'max_iters' or 'error' (an iteration raised).
+    """
+
+    # arrays of the sidecar, one row per iteration
+    _FIELDS = ('iter', 'delta', 'rho', 'A', 'B', 'means1', 'means2', 'sigMADs', 'wall_s', 'cpu_s')
+
+    def __init__(self, iterations, max_iters, stopped):
+        self.iterations = iterations
+        self.max_iters = max_iters
+        self.stopped = stopped
+
+    @property
+    def bands(self):
+        return len(self.iterations[0]['rho'])
+
+    def _model(self, index, last):
+        it = self.iterations[index]
+        rhos = np.array([i['rho'] for i in self.iterations[:last + 1]])
+        model = IRMadModel(it['A'], it['B'], it['means1'], it['means2'], it['sigMADs'], it['rho'],
+                           it['delta'], it['iter'], rhos)
+        model.trace = self
+        return model
+
+    def select(self, conv_threshold=0.99, iteration=None):
+        """IRMadModel a run with this conv_threshold would keep, or that of iteration.
+
+        That is the first iteration after the first one with delta below
+        1 - conv_threshold, else the smallest delta of the run. Raises
+        ValueError if the run stopped earlier than this threshold would.
+        """
+        if iteration is not None:
+            if not 1 <= iteration <= len(self.iterations):
+                raise ValueError('The IR-MAD trace has iterations 1 to {}, not {}'.format(
+                    len(self.iterations), iteration))
+            return self._model(iteration - 1, iteration - 1)
+        delta_thres = 1.0 - conv_threshold
+        for index, it in enumerate(self.iterations):
+            if it['iter'] > 1 and it['delta'] < delta_thres:
+                return self._model(index, index)
+        if self.stopped == 'converged' and len(self.iterations) < self.max_iters:
+            raise ValueError('The IR-MAD trace converged at iteration {}, before reaching a delta '
+                             'below {}'.format(len(self.iterations), round(delta_thres, 5)))
+        best = sorted(range(len(self.iterations)), key=lambda i: self.iterations[i]['delta'])[0]
+        return self._model(best, len(self.iterations) - 1)
+
+    def save(self, path):
+        """Write the trace as a compressed .npz sidecar."""
+        arrays = {f: np.array([it[f] for it in self.iterations]) for f in self._FIELDS}
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, max_iters=self.max_iters, stopped=self.stopped, **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            fields = {f: data[f] for f in cls._FIELDS}
+            iterations = [{f: fields[f][i] for f in cls._FIELDS} for i in range(len(fields['iter']))]
+            for it in iterations:
+                it['iter'] = int(it['iter'])
+                for f in ('delta', 'wall_s', 'cpu_s'):
+                    it[f] = float(it[f])
+            return cls(iterations, int(data['max_iters']), str(data['stopped']))
+
+    def rows(self):
+        """One dict per iteration with the delta, timings and rho of every band."""
+        rows = []
+        for it in self.iterations:
+            row = {'iter': it['iter'], 'delta': it['delta'], 'wall_s': it['wall_s'], 'cpu_s': it['cpu_s']}
+            row.update(('rho_{}'.format(k + 1), float(r)) for k, r in enumerate(it['rho']))
+            rows.append(row)
+        return rows
+
+    def to_csv(self, path):
+        rows = self.rows()
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'max_iters': self.max_iters, 'stopped': self.stopped, 'iterations': self.rows()},
+                      f, indent=2)
+        return path
+
+
+def _pixels(arr):
+    """(n, bands) float64 pixel matrix of a (bands, ...) array, NaN as 0."""
+    arr = np.asarray(arr)
+    tile = arr.reshape(arr.shape[0], -1).T.astype(np.float64, order='C')
+    return np.nan_to_num(tile, copy=False)
+
+
+def _band_any(blocks, bands):
+    """Which bands of the reference and of the target have a non-zero pixel."""
+    ref_any = np.zeros(bands, dtype=bool)
+    tgt_any = np.zeros(bands, dtype=bool)
+    for tile_ref, tile_tgt, _valid in blocks():
+        ref_any |= tile_ref.any(axis=0)
+        tgt_any |= tile_tgt.any(axis=0)
+    return ref_any, tgt_any
+
+
+def _fit(blocks, bands, max_iters, conv_threshold, info, error, canceled,
+         ref_text='', iter_stats=None, feedback=None):
+    """IR-MAD iterations over the pixel blocks; the IRMadModel, None if canceled.
+
+    blocks() returns a fresh iterator of (tile_ref, tile_tgt, valid) with
+    (n, bands) float64 tiles and valid None or an (n,) boolean array; it is
+    called once per iteration.
+    """
     cpm = auxil.Cpm(2 * bands)
     oldrho = np.zeros(bands)
-    rhos = np.zeros((max_iters, bands))
     results = []
     sigMADs = means1 = means2 = A = B = None
+    stopped = 'max_iters'
+    if iter_stats is None:
+        iter_stats = []
 
     delta_thres = 1.0 - conv_threshold
-    _info(f'\nStop condition: max iterations ({max_iters}) or delta < {round(delta_thres, 5)}\n'
-          f'with auto selection of the best delta for the final result:')
-    _info(f' {ref_text + " ->"} iteration: 0, delta: 1.0 ({time.asctime()})')
+    info(f'\nStop condition: max iterations ({max_iters}) or delta < {round(delta_thres, 5)}\n'
+         f'with auto selection of the best delta for the final result:')
+    info(f' {ref_text + " ->"} iteration: 0, delta: 1.0 ({time.asctime()})')
 
     current_iter = 0
     while current_iter < max_iters:
-        if _canceled():
+        if canceled():
             return
 
+        iter_wall0 = time.perf_counter()
+        iter_cpu0 = time.process_time()
         try:
             # ---- pass 1: accumulate weighted covariance over the full image
-            for ry, nr in _iter_row_blocks(rows, block_rows):
-                tile_ref = _read_block(rasterBands1, x0, y0 + ry, cols, nr)
-                tile_tgt = _read_block(rasterBands2, x2, y2 + ry, cols, nr)
+            for tile_ref, tile_tgt, valid in blocks():
                 tile = np.concatenate((tile_ref, tile_tgt), axis=1)
 
                 # Exclude rows where any image has a fully-zero pixel
@@ -164,14 +339,12 @@ def main(img_ref, img_target, max_iters=30, conv_threshold=0.99, band_pos=None,
                 nz_ref = tile_ref.any(axis=1)
                 nz_tgt = tile_tgt.any(axis=1)
                 keep = nz_ref & nz_tgt
+                if valid is not None:
+                    keep &= valid
 
                 if current_iter > 0:
-                    # MAD variates and chi-square statistic for weighting
-                    mads = ((tile[:, 0:bands] - means1[0]) @ A
-                            - (tile[:, bands:] - means2[0]) @ B)
-                    chisqr = np.sum((mads / sigMADs[0]) ** 2, axis=1)
-                    # chi2.sf == 1 - chi2.cdf, but stable in the upper tail
-                    wts = stats.chi2.sf(chisqr, bands)
+                    # weight by the no-change probability of the previous iteration
+                    wts = _chisqr_weights(tile_ref, tile_tgt, means1, means2, A, B, sigMADs)
                     cpm.update(tile[keep], wts[keep])
                 else:
                     cpm.update(tile[keep])
@@ -213,7 +386,6 @@ def main(img_ref, img_target, max_iters=30, conv_threshold=0.99, band_pos=None,
             sigma = np.sqrt(2.0 * (1.0 - rho))  # std of each MAD variate
             delta = float(np.max(np.abs(rho - oldrho)))
 
-            rhos[current_iter, :] = rho
             oldrho = rho
 
             # Tile sigma and means to (1, ...) — broadcast over (n_pixels, bands)
@@ -233,62 +405,277 @@ def main(img_ref, img_target, max_iters=30, conv_threshold=0.99, band_pos=None,
             B = B * sgn_cov
 
             current_iter += 1
-            _info(f' {ref_text + " ->"} iteration: {current_iter}, '
-                  f'delta: {round(delta, 5)} ({time.asctime()})')
-            results.append((delta, {"iter": current_iter, "A": A, "B": B,
-                                    "means1": means1, "means2": means2,
-                                    "sigMADs": sigMADs, "rho": rho}))
+            iter_stats.append({'iter': current_iter, 'delta': delta,
+                               'wall_s': round(time.perf_counter() - iter_wall0, 6),
+                               'cpu_s': round(time.process_time() - iter_cpu0, 6)})
+            info(f' {ref_text + " ->"} iteration: {current_iter}, '
+                 f'delta: {round(delta, 5)} ({time.asctime()})')
+            results.append(dict(iter_stats[-1], A=A, B=B, means1=means1, means2=means2,
+                                sigMADs=sigMADs, rho=rho))
 
             # Convergence check: stop when the maximum change in canonical
             # correlations falls below the threshold derived from conv_threshold.
             # Skip on the first iteration because oldrho starts at zero,
             # making delta a magnitude estimate rather than a convergence measure.
             if current_iter > 1 and delta < delta_thres:
-                _info(f' Convergence reached at iteration {current_iter} '
-                      f'(delta={round(delta, 5)} < {round(delta_thres, 5)})')
+                info(f' Convergence reached at iteration {current_iter} '
+                     f'(delta={round(delta, 5)} < {round(delta_thres, 5)})')
+                stopped = 'converged'
                 break
 
             if feedback is not None:
-                # Report progress in the 10–90% range that arrnorm.py
-                # allocates for the IR-MAD step (0→10% = clipper, 90→100% = radcal+mask).
-                feedback.setProgress(10 + int(80 * current_iter / max_iters))
+                # Progress of this step alone; the arrnorm pipeline maps it
+                # into the share of the run weighted for IR-MAD.
+                feedback.setProgress(int(100 * current_iter / max_iters))
 
         except Exception as err:
-            _info(
+            info(
                 f"\n WARNING: exception at iteration {current_iter}: {err}\n"
                 f" Falling back to best-delta result computed so far. "
                 f"Verify the input bands.\n")
-            current_iter = max_iters  # exit the while-loop
-
-        if current_iter == max_iters:
-            # Guard: if every iteration failed, results is empty
-            if not results:
-                _error(
-                    f"\n ERROR: All {max_iters} iteration(s) failed without producing "
-                    f"any valid result.\n"
-                    f" Common causes:\n"
-                    f"  - Reference and target have different pixel dimensions or "
-                    f"extents after clipping\n"
-                    f"  - Mismatched coordinate reference systems\n"
-                    f"  - One or more bands contain only zeros or nodata\n"
-                    f" Check the warnings above for the specific error that occurred.\n")
-
-            # Pick the iteration with the smallest delta — the run with the
-            # most-converged canonical correlations.
-            best = sorted(results, key=itemgetter(0))[0]
-            _info(f"\n Best delta over all iterations: {round(best[0], 5)} "
-                  f"(iteration {best[1]['iter']}). "
-                  f"Final result computed with those parameters.")
-            delta = best[0]
-            A = best[1]["A"]
-            B = best[1]["B"]
-            means1 = best[1]["means1"]
-            means2 = best[1]["means2"]
-            sigMADs = best[1]["sigMADs"]
-            rho = best[1]["rho"]
-            del results
-
-    _info(f'\nRHO: {rho}')
+            stopped = 'error'
+            break
+
+    # Guard: if every iteration failed, results is empty
+    if not results:
+        error(
+            f"\n ERROR: All {max_iters} iteration(s) failed without producing "
+            f"any valid result.\n"
+            f" Common causes:\n"
+            f"  - Reference and target have different pixel dimensions or "
+            f"extents after clipping\n"
+            f"  - Mismatched coordinate reference systems\n"
+            f"  - One or more bands contain only zeros or nodata\n"
+            f" Check the warnings above for the specific error that occurred.\n")
+
+    # Without convergence the iteration with the smallest delta — the run
+    # with the most-converged canonical correlations — is kept.
+    model = IRMadTrace(results, max_iters, stopped).select(conv_threshold)
+    if stopped != 'converged':
+        info(f"\n Best delta over all iterations: {round(model.delta, 5)} "
+             f"(iteration {model.iteration}). "
+             f"Final result computed with those parameters.")
+
+    info(f'\nRHO: {model.rho}')
+    return model
+
+
+def irmad(ref, tgt, mask=None, max_iters=30, conv_threshold=0.99, block_rows=DEFAULT_BLOCK_ROWS,
+          perf_stats=None, feedback=None):
+    """IR-MAD of two co-registered (bands, rows, cols) arrays, without file I/O.
+
+    mask is an optional (rows, cols) boolean array of the pixels to use;
+    pixels that are zero in every band of either image are always left
+    out. Returns an IRMadModel, or None if feedback reports a cancel.
+    The iterations are those of main(), which runs on files.
+    """
+    ref = np.asarray(ref)
+    tgt = np.asarray(tgt)
+    if ref.ndim == 2:
+        ref, tgt = ref[None], tgt[None]
+    if ref.shape != tgt.shape:
+        raise ValueError(f'reference {ref.shape} and target {tgt.shape} arrays differ in shape')
+    bands, rows, cols = ref.shape
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (rows, cols):
+            raise ValueError(f'mask {mask.shape} does not match the images ({rows}, {cols})')
+
+    def blocks():
+        for ry, nr in _iter_row_blocks(rows, block_rows):
+            yield (_pixels(ref[:, ry:ry + nr]), _pixels(tgt[:, ry:ry + nr]),
+                   mask[ry:ry + nr].ravel() if mask is not None else None)
+
+    return _run(blocks, bands, max_iters, conv_threshold, perf_stats, feedback)
+
+
+def irmad_chunks(chunks, bands, max_iters=30, conv_threshold=0.99, perf_stats=None, feedback=None):
+    """IR-MAD over pixels supplied in chunks, for images that are not one array.
+
+    chunks() must return a new iterator over the whole image on every call
+    (one call per iteration), yielding (ref, tgt) or (ref, tgt, valid) with
+    (n, bands) pixel tiles and an optional (n,) boolean array.
+    """
+    def blocks():
+        for chunk in chunks():
+            tile_ref, tile_tgt = (np.nan_to_num(np.asarray(t, dtype=np.float64)) for t in chunk[:2])
+            yield tile_ref, tile_tgt, np.asarray(chunk[2], dtype=bool) if len(chunk) > 2 else None
+
+    return _run(blocks, bands, max_iters, conv_threshold, perf_stats, feedback)
+
+
+def _run(blocks, bands, max_iters, conv_threshold, perf_stats, feedback):
+    """_fit for the array API: messages only through feedback, never printed."""
+    def _info(msg):
+        if feedback is not None:
+            feedback.pushInfo(msg)
+
+    def _error(msg):
+        if feedback is not None:
+            feedback.reportError(msg, fatalError=True)
+        raise QgsProcessingException(msg)
+
+    def _canceled():
+        return feedback is not None and feedback.isCanceled()
+
+    ref_any, tgt_any = _band_any(blocks, bands)
+    for name, band_any in (('reference', ref_any), ('target', tgt_any)):
+        for k in np.flatnonzero(~band_any):
+            _error(f"\nERROR: band {k + 1} of the {name} has only zeros — please check it.\n")
+
+    iter_stats = []
+    model = _fit(blocks, bands, max_iters, conv_threshold, _info, _error, _canceled,
+                 iter_stats=iter_stats, feedback=feedback)
+    if perf_stats is not None:
+        # zero-band check + one pass per iteration
+        perf_stats.update(iterations=iter_stats, passes=len(iter_stats) + 1)
+    return model
+
+
+def main(img_ref, img_target, max_iters=30, conv_threshold=0.99, band_pos=None, dims=None,
+          graphics=False, ref_text='', block_rows=DEFAULT_BLOCK_ROWS,
+          output=None, perf_stats=None, feedback=None, cache_tiles=False,
+          trace=None, save_trace=None, iteration=None, change_map=None, change_kind='ncp',
+          ncp_threshold=0.95, nodata=None):
+    """Run IR-MAD and write the MAD variates + chi-square band to disk.
+
+    If *perf_stats* is a dict it is filled with instrumentation counters:
+    'iterations' (a list with the delta and wall/CPU seconds of every
+    iteration), 'passes' (full reads of both inputs) and 'pixels'.
+    With *cache_tiles* both images are read once and their float64 tiles
+    kept in RAM (cols * rows * 2*bands * 8 bytes) for every iteration.
+
+    *save_trace* writes the IRMadTrace of the run to that .npz file. Given a
+    *trace* (an IRMadTrace or its file) of a run on the same images, the
+    result for *conv_threshold*, or for *iteration*, is selected from it and
+    only the output pass runs.
+
+    *change_map* also writes a ChangeMapWriter raster of *change_kind* to
+    that path in the output pass; pixels whose first target band equals
+    *nodata* are marked nodata in it.
+    """
+    gdal.AllRegister()
+    start = time.time()  # was previously undefined at print-elapsed time (bug)
+
+    # -- Logging helpers: use QGIS feedback when available, print otherwise --
+    def _info(msg):
+        if feedback is not None:
+            feedback.pushInfo(msg)
+        else:
+            print(msg)
+
+    def _error(msg):
+        if feedback is not None:
+            feedback.reportError(msg, fatalError=True)
+        raise QgsProcessingException(msg)
+
+    def _canceled():
+        return feedback is not None and feedback.isCanceled()
+
+    path = os.path.dirname(os.path.abspath(img_ref))
+    basename1 = os.path.basename(img_ref)
+    root1, ext1 = os.path.splitext(basename1)
+    basename2 = os.path.basename(img_target)
+    root2, _ext2 = os.path.splitext(basename2)
+    outfn = output if output is not None else os.path.join(path, f'MAD({root1}&{basename2}){ext1}')
+
+    inDataset1 = gdal.Open(img_ref, GA_ReadOnly)
+    inDataset2 = gdal.Open(img_target, GA_ReadOnly)
+    if inDataset1 is None or inDataset2 is None:
+        _error("Error: input image(s) could not be opened.")
+
+    cols = inDataset1.RasterXSize
+    rows = inDataset1.RasterYSize
+    bands = inDataset1.RasterCount
+    cols2 = inDataset2.RasterXSize
+    rows2 = inDataset2.RasterYSize
+    bands2 = inDataset2.RasterCount
+
+    if bands != bands2:
+        _error(
+            f"Band count mismatch between reference ({bands}) "
+            f"and target ({bands2}).")
+
+    if band_pos is None:
+        band_pos = list(range(1, bands + 1))
+    else:
+        bands = len(band_pos)
+
+    if dims is None:
+        x0 = y0 = 0
+    else:
+        x0, y0, cols, rows = dims
+
+    # If the target was warped during registration we assume it is already
+    # aligned to the reference origin; otherwise use the same window.
+    if root2.find('_warp') != -1:
+        x2 = y2 = 0
+    else:
+        x2, y2 = x0, y0
+
+    # Dimension guard: after clipper() in bin/arrnorm, both images MUST share
+    # the same pixel grid. Pixel-for-pixel alignment is required for IR-MAD.
+    if cols != cols2 or rows != rows2:
+        _error(
+            f"\n ERROR: Reference clip ({cols}x{rows}) and target "
+            f"({cols2}x{rows2}) have different pixel dimensions.\n"
+            f" Pixel-for-pixel alignment is required for IR-MAD. Ensure both "
+            f"images share the same CRS, pixel size, and spatial extent "
+            f"before running the normalization.\n")
+
+    _info('------------IRMAD -------------')
+    rasterBands1 = [inDataset1.GetRasterBand(b) for b in band_pos]
+    rasterBands2 = [inDataset2.GetRasterBand(b) for b in band_pos]
+
+    def read_blocks():
+        for ry, nr in _iter_row_blocks(rows, block_rows):
+            yield (_read_block(rasterBands1, x0, y0 + ry, cols, nr),
+                   _read_block(rasterBands2, x2, y2 + ry, cols, nr), None)
+
+    if cache_tiles:
+        tiles = list(read_blocks())
+
+        def blocks():
+            return iter(tiles)
+    else:
+        blocks = read_blocks
+
+    iter_stats = []
+    if perf_stats is not None:
+        perf_stats['iterations'] = iter_stats
+        perf_stats['pixels'] = cols * rows
+
+    if trace is not None:
+        if not isinstance(trace, IRMadTrace):
+            trace = IRMadTrace.load(trace)
+        if trace.bands != bands:
+            _error(f"The IR-MAD trace has {trace.bands} bands, the images {bands}.")
+        try:
+            model = trace.select(conv_threshold, iteration)
+        except ValueError as e:
+            _error(str(e))
+        _info(f'Selected iteration {model.iteration} (delta {round(model.delta, 5)}) '
+              f'of the IR-MAD trace\nRHO: {model.rho}')
+    else:
+        # Sanity-check: any band that is entirely zero would make the algorithm
+        # degenerate (singular covariance). Bail out early with a clear message.
+        ref_any, tgt_any = _band_any(blocks, bands)
+        for basename, band_any in ((basename1, ref_any), (basename2, tgt_any)):
+            for k in np.flatnonzero(~band_any):
+                _error(f"\nERROR: band {band_pos[k]} of '{basename}' has only "
+                       f"zeros — please check it.\n")
+
+        model = _fit(blocks, bands, max_iters, conv_threshold, _info, _error, _canceled,
+                     ref_text=ref_text, iter_stats=iter_stats, feedback=feedback)
+        if model is None:
+            return
+        if iteration is not None:
+            try:
+                model = model.trace.select(iteration=iteration)
+            except ValueError as e:
+                _error(str(e))
+        if save_trace is not None:
+            model.trace.save(save_trace)
 
     # ---- write MAD variates + chi-square band to disk
     driver = inDataset1.GetDriver()
@@ -303,32 +690,43 @@ def main(img_ref, img_target, max_iters=30, conv_threshold=0.99, band_pos=None,
     if projection is not None:
         outDataset.SetProjection(projection)
     outBands = [outDataset.GetRasterBand(k + 1) for k in range(bands + 1)]
-
-    for ry, nr in _iter_row_blocks(rows, block_rows):
-        tile_ref = _read_block(rasterBands1, x0, y0 + ry, cols, nr)
-        tile_tgt = _read_block(rasterBands2, x2, y2 + ry, cols, nr)
-        mads = (tile_ref - means1[0]) @ A - (tile_tgt - means2[0]) @ B
-        chisqr = np.sum((mads / sigMADs[0]) ** 2, axis=1)
+    changeMap = None
+    if change_map is not None:
+        changeMap = ChangeMapWriter(change_map, cols, rows, model.bands, change_kind, ncp_threshold,
+                                    outDataset.GetGeoTransform(), projection)
+
+    for (ry, nr), (tile_ref, tile_tgt, _valid) in zip(_iter_row_blocks(rows, block_rows), blocks()):
+        mads, chisqr = _mad_chisqr(tile_ref, tile_tgt, model.means1, model.means2,
+                                   model.A, model.B, model.sigMADs)
         for k in range(bands):
             outBands[k].WriteArray(mads[:, k].reshape(nr, cols), 0, ry)
         outBands[bands].WriteArray(chisqr.reshape(nr, cols), 0, ry)
+        if changeMap is not None:
+            mask = _is_nodata(tile_tgt[:, 0], nodata).reshape(nr, cols) if nodata is not None else None
+            changeMap.write(chisqr.reshape(nr, cols), ry, mask)
     for outBand in outBands:
         outBand.FlushCache()
     outDataset = None
+    if changeMap is not None:
+        _info('change map written to: ' + changeMap.close())
     inDataset1 = None
     inDataset2 = None
 
     _info('result written to: ' + outfn)
     _info(f'elapsed time: {time.time() - start:.2f}s')
+    if perf_stats is not None:
+        # zero-band check + one pass per iteration + the output pass, or
+        # a single read when the tiles stay in RAM or come from a trace
+        perf_stats['passes'] = 1 if cache_tiles or trace is not None else len(iter_stats) + 2
 
     if graphics:
         try:
             import matplotlib.pyplot as plt
-            x = np.arange(current_iter)
-            plt.plot(x, rhos[:current_iter, :])
+            x = np.arange(len(model.rhos))
+            plt.plot(x, model.rhos)
             plt.title('Canonical correlations')
             plt.show()
         except ImportError:
             pass  # matplotlib not available; skip graphics
 
-    return outfn
\ No newline at end of file
+    return outfn
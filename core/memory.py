@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     memory.py
+#  Purpose:  Size blocks, caches and workers from a single memory budget.
+#
+#  MemoryBudget turns one number (bytes, or '512M' / '4G') into the settings
+#  the stages need, for a scene of given columns, rows and bands:
+#
+#    - block heights: every row of a block costs cols x bands x 8 bytes
+#      per float64 working copy (IR-MAD keeps about IMAD_COPIES of them,
+#      the raster_ops steps RASTER_OPS_COPIES of one band). A block may use
+#      BLOCK_SHARE of the budget, split between the stages running at once;
+#    - the IR-MAD tile cache: both images as float64 pixels are kept in RAM
+#      for all iterations when they fit in CACHE_SHARE of the budget, and
+#      re-read from disk on every iteration otherwise;
+#    - the number of concurrent stages, so every one still gets a block of
+#      at least MIN_BLOCK_ROWS rows.
+#
+#  Without a budget the stages keep their fixed defaults (256-row blocks,
+#  IR-MAD streamed from disk). A block height from the tuning profile (see
+#  autotune.py) replaces the default, and caps the budget-derived heights.
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import re
+
+# Block height (in rows) without a budget, used by iMad and raster_ops.
+# Reading 256 rows at a time amortizes the per-call GDAL overhead by ~256x
+# vs a row-by-row loop while keeping peak memory bounded
+# (256 * cols * 2*bands * 8 bytes for IR-MAD).
+DEFAULT_BLOCK_ROWS = 256
+MIN_BLOCK_ROWS = 16
+
+# float64 working copies per pixel and band: IR-MAD holds the reference and
+# target tiles, their concatenation (2 more) and the MAD variates; the
+# raster_ops steps hold input, mask, result and temporaries of one band.
+IMAD_COPIES = 5
+RASTER_OPS_COPIES = 6
+# RadCal holds the reference and target blocks, one being converted from the
+# file's data type and the temporaries of the NCP sweep
+RADCAL_COPIES = 4
+# a tiled-mode worker holds both images of its whole tile, the one being
+# converted from the file's data type and the chi-square (IR-MAD blocks extra)
+TILE_COPIES = 4
+
+BLOCK_SHARE = 0.25
+CACHE_SHARE = 0.5
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    """Bytes of 1073741824, '1G', '512M', '1.5GB' or '2GiB'; None stays None."""
+    if value is None or isinstance(value, (int, float)):
+        return None if value is None else int(value)
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)(i?B)?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid memory size: {!r}'.format(value))
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+def format_size(nbytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(nbytes) < 1024 or unit == 'GiB':
+            return '{:.0f} {}'.format(nbytes, unit) if unit == 'B' else '{:.1f} {}'.format(nbytes, unit)
+        nbytes /= 1024.0
+
+
+class MemoryBudget(object):
+    """Memory plan for a cols x rows x bands scene; budget None means no limit.
+
+    preferred_rows is the fastest block height measured on this machine, if known.
+    """
+
+    def __init__(self, budget, cols, rows, bands, preferred_rows=None):
+        self.budget = parse_size(budget)
+        self.cols = cols
+        self.rows = rows
+        self.bands = bands
+        self.preferred_rows = preferred_rows
+
+    @property
+    def limited(self):
+        return self.budget is not None
+
+    def _rows_for(self, nbytes, copies, bands):
+        per_row = max(1, self.cols * bands * copies * 8)
+        return int(nbytes // per_row)
+
+    def workers(self, requested):
+        """Concurrent stages that each still get a MIN_BLOCK_ROWS IR-MAD block."""
+        if not self.limited:
+            return requested
+        fit = self._rows_for(self.budget * BLOCK_SHARE, IMAD_COPIES, self.bands) // MIN_BLOCK_ROWS
+        return max(1, min(requested, fit))
+
+    def block_rows(self, copies=IMAD_COPIES, bands=None, workers=1):
+        """Block height for a stage with the given working copies per pixel and band."""
+        if not self.limited:
+            return self.preferred_rows or DEFAULT_BLOCK_ROWS
+        bands = self.bands if bands is None else bands
+        rows = self._rows_for(self.budget * BLOCK_SHARE / max(1, workers), copies, bands)
+        rows = max(MIN_BLOCK_ROWS, min(self.rows, rows))
+        return min(rows, self.preferred_rows) if self.preferred_rows else rows
+
+    def block_bytes(self, block_rows, copies=IMAD_COPIES, bands=None):
+        bands = self.bands if bands is None else bands
+        return block_rows * self.cols * bands * copies * 8
+
+    def imad_cache_bytes(self):
+        """RAM for both images as float64 pixels, the IR-MAD tile cache."""
+        return self.cols * self.rows * 2 * self.bands * 8
+
+    def cache_imad(self):
+        """Keep the IR-MAD tiles in RAM for all iterations instead of re-reading them."""
+        return self.limited and self.imad_cache_bytes() <= self.budget * CACHE_SHARE
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     perf.py
+#  Purpose:  Lightweight per-stage instrumentation for the normalization
+#            pipeline.
+#
+#  A PerfReport collects one record per stage (clipper, imad, radcal and the
+#  raster_ops steps) with wall/CPU time, bytes read and written, pixels
+#  processed, Mpix/s, peak RSS and any stage-specific counters such as the
+#  IR-MAD per-iteration timings. The report is written as JSON next to the
+#  normalized output.
+#
+#  With a memory budget, the resident memory is sampled while every stage
+#  runs (RSS of the whole process, so stages running side by side share it),
+#  also when the report itself is disabled: a stage peaking above the budget
+#  is reported through `warn`, and an enabled report records the peak next
+#  to the budget and the working set planned for the stage.
+#
+#  Setting the environment variable ARRNORM_CPROFILE to a directory (or to
+#  "1" to use the report directory) also dumps a cProfile file per stage,
+#  loadable with pstats / snakeviz.
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import contextlib
+import cProfile
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CPROFILE_ENV = 'ARRNORM_CPROFILE'
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def current_rss_bytes():
+    """Resident set size of this process now, or None where /proc is unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class _RssSampler(object):
+    """Background thread keeping the highest RSS seen by each running stage."""
+
+    INTERVAL_S = 0.05
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._peaks = {}
+        self._thread = None
+
+    def start(self, key):
+        rss = current_rss_bytes()
+        if rss is None:
+            return
+        with self._lock:
+            self._peaks[key] = rss
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='arrnorm-rss', daemon=True)
+                self._thread.start()
+
+    def stop(self, key):
+        rss = current_rss_bytes()
+        with self._lock:
+            peak = self._peaks.pop(key, None)
+        if peak is None:
+            return None
+        return max(peak, rss or 0)
+
+    def _run(self):
+        while True:
+            rss = current_rss_bytes()
+            with self._lock:
+                if not self._peaks:
+                    self._thread = None
+                    return
+                for key, peak in self._peaks.items():
+                    if rss > peak:
+                        self._peaks[key] = rss
+            time.sleep(self.INTERVAL_S)
+
+
+def _files_size(paths):
+    total = 0
+    for p in paths:
+        if p and os.path.isfile(p):
+            total += os.path.getsize(p)
+    return total
+
+
+class PerfReport(object):
+    """Collect per-stage performance records and write them as JSON.
+
+    A disabled report keeps the same interface but records nothing, so
+    callers never need to branch on whether instrumentation is on. With a
+    memory_budget it still calls warn(message) for a stage whose sampled
+    peak RSS exceeds the budget.
+    """
+
+    def __init__(self, enabled=True, output_dir=None, memory_budget=None, warn=None):
+        self.enabled = enabled
+        self.stages = []
+        self.started = time.time()
+        self.memory_budget = memory_budget
+        self.warn = warn
+        self._sampler = _RssSampler() if memory_budget else None
+        # ARRNORM_CPROFILE=1 dumps next to the report, any other value is a directory
+        env = os.environ.get(CPROFILE_ENV, '').strip()
+        self._profile = enabled and env not in ('', '0')
+        self.profile_dir = (output_dir if env == '1' else env) or os.getcwd()
+
+    @contextlib.contextmanager
+    def stage(self, name, inputs=(), pixels=None, passes=1):
+        """Time the enclosed block as a stage.
+
+        Yields a dict the caller can extend with counters ('iterations',
+        'outputs', ...). 'outputs' is a list of files whose size is summed
+        into bytes_written when the stage ends; bytes_read is the on-disk
+        size of the inputs times the number of passes over them.
+        """
+        record = {'stage': name}
+        if not self.enabled:
+            if self._sampler is None:
+                yield record
+                return
+            self._sampler.start(id(record))
+            try:
+                yield record
+            finally:
+                self._check_budget(name, self._sampler.stop(id(record)))
+            return
+
+        profiler = cProfile.Profile() if self._profile else None
+        if self._sampler is not None:
+            self._sampler.start(id(record))
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:  # another profiler is active (e.g. a concurrent stage)
+                profiler = None
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = time.perf_counter() - wall0
+            cpu = time.process_time() - cpu0
+            passes = record.pop('passes', passes)
+            pixels = record.pop('pixels', pixels)
+            record.update({
+                'wall_s': round(wall, 6),
+                'cpu_s': round(cpu, 6),
+                'bytes_read': _files_size(inputs) * passes,
+                'bytes_written': _files_size(record.pop('outputs', [])),
+                'passes': passes,
+                'peak_rss_bytes': peak_rss_bytes(),
+            })
+            if self._sampler is not None:
+                memory = record.setdefault('memory', {})
+                memory['budget_bytes'] = self.memory_budget
+                memory['stage_peak_rss_bytes'] = self._sampler.stop(id(record))
+                self._check_budget(name, memory['stage_peak_rss_bytes'])
+            if pixels is not None:
+                record['pixels'] = int(pixels)
+                record['mpix_per_s'] = round(pixels * passes / wall / 1e6, 3) if wall > 0 else None
+            if profiler is not None:
+                record['cprofile'] = self._dump_profile(profiler, name)
+            self.stages.append(record)
+
+    def _check_budget(self, name, peak):
+        if peak is not None and peak > self.memory_budget and self.warn is not None:
+            self.warn('WARNING: stage {} peaked at {:.0f} MiB resident, above the memory budget of '
+                      '{:.0f} MiB'.format(name, peak / 2 ** 20, self.memory_budget / 2 ** 20))
+
+    def _dump_profile(self, profiler, name):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, 'arrnorm_{}_{}.prof'.format(os.getpid(), name))
+        profiler.dump_stats(path)
+        return path
+
+    def as_dict(self):
+        return {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'total_wall_s': round(sum(s['wall_s'] for s in self.stages), 6),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'memory_budget_bytes': self.memory_budget,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'stages': self.stages,
+        }
+
+    def write(self, path):
+        if not self.enabled:
+            return None
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        return path
+
+    def summary_lines(self):
+        """Human-readable one line per stage, for the processing log."""
+        lines = []
+        for s in self.stages:
+            rate = ' {:.2f} Mpix/s'.format(s['mpix_per_s']) if s.get('mpix_per_s') else ''
+            memory = s.get('memory', {})
+            if memory.get('stage_peak_rss_bytes'):
+                rate += '  peak RSS {:.0f} MiB (budget {:.0f} MiB)'.format(
+                    memory['stage_peak_rss_bytes'] / 2 ** 20, memory['budget_bytes'] / 2 ** 20)
+            lines.append(' {:<18} wall {:8.2f}s  cpu {:8.2f}s{}'.format(
+                s['stage'], s['wall_s'], s['cpu_s'], rate))
+        return lines
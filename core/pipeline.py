@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     pipeline.py
+#  Purpose:  Small dependency-driven scheduler for the normalization stages.
+#
+#  Each Stage declares the artifacts it reads and writes (symbolic names such
+#  as 'ref_clip' or 'mask'). A stage is ready once every input produced by
+#  another stage is done; inputs nobody produces are external files. Ready
+#  stages run on a thread pool in declaration order, so independent work
+#  (e.g. the target nodata mask and the IR-MAD iterations) overlaps, and with
+#  one worker the stages run exactly in declaration order.
+#
+#  A fused stage replaces a chain of stages when the intermediate artifacts
+#  are read by nothing else, saving a full write and read of the image.
+#
+#  Progress is the weight of the finished stages plus the reported fraction
+#  of the running ones, over the total weight of the stages that run.
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Stage(object):
+    """One pipeline step.
+
+    func(feedback, record) does the work; feedback.setProgress takes the
+    stage's own 0-100 progress and record is the perf record of the stage.
+    replaces names the chain of stages a fused stage stands for.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), weight=1, replaces=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.weight = weight
+        self.replaces = tuple(replaces)
+
+    def __repr__(self):
+        return 'Stage({!r})'.format(self.name)
+
+
+class _StageFeedback(object):
+    """Feedback proxy mapping a stage's progress into the pipeline total."""
+
+    def __init__(self, pipeline, stage):
+        self._pipeline = pipeline
+        self._stage = stage
+
+    def setProgress(self, value):
+        self._pipeline._stage_progress(self._stage, value)
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline.feedback, name)
+
+
+class Pipeline(object):
+    """Run stages by their data dependencies on a small thread pool.
+
+    paths maps an artifact name to its file (for the perf report), keep
+    lists artifacts used after the pipeline so fusion never drops them.
+    """
+
+    def __init__(self, stages, feedback, perf=None, workers=2, fused=(), keep=(),
+                 paths=None, pixels=None):
+        self.stages = list(stages)
+        self.feedback = feedback
+        self.perf = perf
+        self.workers = max(1, int(workers))
+        self.fused = list(fused)
+        self.keep = set(keep)
+        self.paths = paths or (lambda name: None)
+        self.pixels = pixels
+        self._lock = threading.Lock()
+        self._fraction = {}
+        self._total = 0
+        self._reported = -1
+
+    def plan(self):
+        """The stages that will run, after fusion, in declaration order."""
+        stages = list(self.stages)
+        for fused in self.fused:
+            chain = [s for s in stages if s.name in fused.replaces]
+            if len(chain) != len(fused.replaces):
+                continue
+            inner = {o for s in chain for o in s.outputs} - set(fused.outputs)
+            others = [s for s in stages if s.name not in fused.replaces]
+            if inner & self.keep or any(i in inner for s in others for i in s.inputs):
+                continue
+            stages = [s for s in stages if s not in chain[:-1]]
+            stages[stages.index(chain[-1])] = fused
+        return stages
+
+    def run(self):
+        """Run every stage; False if canceled before the end."""
+        stages = self.plan()
+        producers = {}
+        for s in stages:
+            for o in s.outputs:
+                producers[o] = s
+        deps = {s.name: {producers[i].name for i in s.inputs
+                         if i in producers and producers[i] is not s}
+                for s in stages}
+        self._total = float(sum(s.weight for s in stages)) or 1.0
+        self._fraction = {}
+        self._reported = -1
+        self._set_progress(0)
+
+        pending = list(stages)
+        running = {}
+        done = set()
+        error = None
+        canceled = False
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                if error is None and not canceled:
+                    for s in [s for s in pending if deps[s.name] <= done]:
+                        if len(running) >= self.workers:
+                            break
+                        pending.remove(s)
+                        running[pool.submit(self._run_stage, s)] = s
+                if not running:
+                    if pending and error is None and not canceled:
+                        raise ValueError('Pipeline stages have circular dependencies: {}'.format(pending))
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    s = running.pop(future)
+                    try:
+                        future.result()
+                    except BaseException as e:
+                        if error is None:
+                            error = e
+                        continue
+                    done.add(s.name)
+                    self._stage_progress(s, 100)
+                if self.feedback.isCanceled():
+                    canceled = True
+        if error is not None:
+            raise error
+        return not canceled
+
+    def _run_stage(self, stage):
+        feedback = _StageFeedback(self, stage)
+        if self.perf is None:
+            stage.func(feedback, {})
+            return
+        inputs = [self.paths(i) for i in stage.inputs]
+        with self.perf.stage(stage.name, inputs=inputs, pixels=self.pixels) as record:
+            stage.func(feedback, record)
+            if 'outputs' not in record:
+                record['outputs'] = [self.paths(o) for o in stage.outputs]
+
+    def _stage_progress(self, stage, value):
+        with self._lock:
+            self._fraction[stage.name] = (stage.weight, min(max(value, 0), 100) / 100.0)
+            done = sum(w * f for w, f in self._fraction.values())
+            self._set_progress(int(100 * done / self._total))
+
+    def _set_progress(self, value):
+        # never step back, e.g. when a fast stage finishes next to a slow one
+        if value > self._reported:
+            self._reported = value
+            self.feedback.setProgress(value)
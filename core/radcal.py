@@ -9,6 +9,21 @@
 #    2. Fits a per-band orthogonal regression target -> reference on those.
 #    3. Applies the linear transform a + b*target to produce a normalized image.
 #
+#  With scaled_dtype (UInt16/Int16) the normalized values are stored as
+#  integer codes with per-band scale/offset metadata (value = code * scale +
+#  offset), chosen from the regression and the target's min/max so the
+#  whole output range fits the type; the lowest code is reserved as nodata.
+#
+#  NcpSweep accumulates the regression sums of every band bucketed by the
+#  no-change probability in one streaming pass, so the fit for any NCP
+#  threshold (to 1/NCP_BUCKETS) follows from the buckets above it without
+#  reading the images again.
+#
+#  The fitted coefficients (with the correlations, the no-change pixel count
+#  and the scale/offset of a scaled output) can be saved as a JSON sidecar;
+#  apply_coefficients re-applies them to any raster in one streaming pass,
+#  and apply_many to many rasters side by side, without IR-MAD.
+#
 #  Original implementation: Mort Canty, 2011. Refactored for numerical
 #  stability and to match the rest of the package style.
 #
@@ -16,39 +31,34 @@
 # ******************************************************************************
 
 import ast
+import csv
 import getopt
+import json
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly
-from scipy import stats
+from scipy.special import chdtrc
 
-from ArrNorm.core.auxil.auxil import orthoregress
+from ArrNorm.core import raster_ops
+from ArrNorm.core.auxil.auxil import orthoregress, orthoregress_moments
+from ArrNorm.core.memory import DEFAULT_BLOCK_ROWS
 
 try:
     from qgis.core import QgsProcessingException
 except ImportError:
     QgsProcessingException = Exception
 
-try:
-    import matplotlib
-    # 'Agg' is a non-interactive backend — required for safe use from
-    # multiprocessing workers and for headless servers. Must be set before
-    # importing pyplot.
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    _MPL_AVAILABLE = True
-except ImportError:
-    _MPL_AVAILABLE = False
-
 usage = '''
 Usage:
 --------------------------------------------------------
 python radcal.py [-p "bandPositions"] [-d "spatialDimensions"]
-                 [-t no-change prob threshold] imadFile [fullSceneFile]
+                 [-t no-change prob threshold] [-s UInt16|Int16]
+                 imadFile [fullSceneFile]
 --------------------------------------------------------
 '''
 
@@ -77,9 +87,359 @@ def _clip_for_dtype(arr, gdal_dtype):
     return np.clip(arr, rng[0], rng[1])
 
 
+# Scaled output types by name, as accepted by Normalization(scaled_output=...).
+SCALED_TYPES = {'UInt16': gdal.GDT_UInt16, 'Int16': gdal.GDT_Int16}
+
+# Integer types usable for scaled output: (lowest data code, highest data
+# code, nodata code). The nodata code is kept out of the data range.
+_SCALED_CODES = {
+    gdal.GDT_UInt16: (1, 65535, 0),
+    gdal.GDT_Int16:  (-32767, 32767, -32768),
+}
+
+
+def scaled_coefficients(a, b, tgt_min, tgt_max, gdal_dtype):
+    """Return (scale, offset) storing a + b*[tgt_min, tgt_max] in gdal_dtype codes.
+
+    The normalized range is spread over every data code, so the largest
+    quantization error is scale / 2.
+    """
+    code_lo, code_hi, _nodata = _SCALED_CODES[gdal_dtype]
+    lo, hi = sorted((a + b * tgt_min, a + b * tgt_max))
+    scale = (hi - lo) / (code_hi - code_lo) if hi > lo else 1.0
+    return scale, lo - code_lo * scale
+
+
+def _to_codes(values, scale, offset, gdal_dtype):
+    """Quantize physical values to the data codes of a scaled output."""
+    code_lo, code_hi, _nodata = _SCALED_CODES[gdal_dtype]
+    return np.clip(np.rint((values - offset) / scale), code_lo, code_hi)
+
+
+def _pyplot():
+    """matplotlib.pyplot for the RadCal plots, or None without matplotlib.
+
+    Imported on first use only: matplotlib is slow to load and only
+    needed with graphics=True.
+    """
+    try:
+        import matplotlib
+    except ImportError:
+        return None
+    # 'Agg' is a non-interactive backend — required for safe use from
+    # multiprocessing workers and for headless servers. Must be set before
+    # importing pyplot.
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def _nochange_index(chisqr, dof, ncp_threshold):
+    """Indices of the pixels whose no-change probability exceeds the threshold."""
+    # Under the null hypothesis (no change) the chi-square statistic over the
+    # MAD variates follows chi^2 with dof = # of MAD variates.
+    # NCP = P(X >= chisqr) = chi2.sf(chisqr) = chdtrc(dof, chisqr), which is
+    # numerically far more accurate than 1 - cdf() in the relevant upper tail.
+    return np.where(chdtrc(dof, chisqr) > ncp_threshold)
+
+
+def radcal_fit(ref, tgt, chisqr, ncp_threshold=0.95, dof=None):
+    """Fit target -> reference per band on the no-change pixels of in-memory arrays.
+
+    ref and tgt are (bands, ...) arrays, chisqr the (...) chi-square of the
+    MAD variates (IRMadModel.transform) with dof degrees of freedom, the
+    number of bands by default. Returns (intercepts, slopes, correlations)
+    arrays with one value per band.
+    """
+    ref = np.asarray(ref)
+    return radcal_fit_chunks([(ref, tgt, chisqr)], ref.shape[0], ncp_threshold=ncp_threshold, dof=dof)
+
+
+def radcal_fit_chunks(chunks, bands, ncp_threshold=0.95, dof=None, samples=None):
+    """radcal_fit over (ref, tgt, chisqr) chunks, read once in a single pass.
+
+    A list given as samples receives the (reference, target) values of the
+    no-change pixels of every band, e.g. to count or plot them.
+    """
+    dof = bands if dof is None else dof
+    xs = [[] for _ in range(bands)]
+    ys = [[] for _ in range(bands)]
+    for ref, tgt, chisqr in chunks:
+        idx = _nochange_index(np.asarray(chisqr).ravel(), dof, ncp_threshold)
+        ref = np.asarray(ref).reshape(bands, -1)
+        tgt = np.asarray(tgt).reshape(bands, -1)
+        for k in range(bands):
+            xs[k].append(ref[k][idx].astype(np.float64))
+            ys[k].append(tgt[k][idx].astype(np.float64))
+    for k in range(bands):
+        xs[k], ys[k] = np.concatenate(xs[k]), np.concatenate(ys[k])
+    n = len(xs[0])
+    if n < 2:
+        raise ValueError(f'only {n} no-change pixels selected (threshold={ncp_threshold})')
+    fits = [orthoregress(ys[k], xs[k]) for k in range(bands)]
+    if samples is not None:
+        samples.extend(zip(xs, ys))
+    slopes, intercepts, correlations = (np.array(v) for v in zip(*fits))
+    return intercepts, slopes, correlations
+
+
+# Resolution of the NCP threshold sweep: thresholds snap to multiples of 0.001
+NCP_BUCKETS = 1000
+
+
+class NcpSweep(object):
+    """Per-band regression sums of target (x) and reference (y) by NCP bucket.
+
+    Values are summed relative to the band means of the first chunk, which
+    keeps the sums of squares well conditioned.
+    """
+
+    _SUMS = ('x', 'y', 'xx', 'yy', 'xy')
+
+    def __init__(self, bands, dof=None, buckets=NCP_BUCKETS):
+        self.bands = bands
+        self.dof = bands if dof is None else dof
+        self.buckets = buckets
+        self.count = np.zeros(buckets)
+        self.sums = np.zeros((len(self._SUMS), bands, buckets))
+        self.center = None
+
+    def update(self, ref, tgt, chisqr):
+        """Add (bands, ...) reference and target pixels with their (...) chi-square."""
+        ncp = chdtrc(self.dof, np.asarray(chisqr, dtype=np.float64).ravel())
+        keep = ~np.isnan(ncp)
+        bucket = np.minimum((ncp[keep] * self.buckets).astype(np.intp), self.buckets - 1)
+        ref = np.asarray(ref, dtype=np.float64).reshape(self.bands, -1)[:, keep]
+        tgt = np.asarray(tgt, dtype=np.float64).reshape(self.bands, -1)[:, keep]
+        if not bucket.size:
+            return
+        if self.center is None:
+            self.center = (tgt.mean(axis=1), ref.mean(axis=1))
+        self.count += np.bincount(bucket, minlength=self.buckets)
+        for k in range(self.bands):
+            x = tgt[k] - self.center[0][k]
+            y = ref[k] - self.center[1][k]
+            for i, v in enumerate((x, y, x * x, y * y, x * y)):
+                self.sums[i, k] += np.bincount(bucket, weights=v, minlength=self.buckets)
+
+    def pixels(self, ncp_threshold):
+        """No-change pixels above the threshold."""
+        return int(self.count[self._first(ncp_threshold):].sum())
+
+    def _first(self, ncp_threshold):
+        return min(max(int(round(ncp_threshold * self.buckets)), 0), self.buckets)
+
+    def fit(self, ncp_threshold):
+        """(intercepts, slopes, correlations) as radcal_fit gives for this threshold."""
+        first = self._first(ncp_threshold)
+        n = self.count[first:].sum()
+        if n < 2:
+            raise ValueError(f'only {int(n)} no-change pixels selected (threshold={ncp_threshold})')
+        sx, sy, sxx, syy, sxy = self.sums[:, :, first:].sum(axis=2)
+        xm, ym = sx / n, sy / n
+        fits = [orthoregress_moments(xm[k] + self.center[0][k], ym[k] + self.center[1][k],
+                                     (sxx[k] - sx[k] * xm[k]) / (n - 1), (syy[k] - sy[k] * ym[k]) / (n - 1),
+                                     (sxy[k] - sx[k] * ym[k]) / (n - 1))
+                for k in range(self.bands)]
+        slopes, intercepts, correlations = (np.array(v) for v in zip(*fits))
+        return intercepts, slopes, correlations
+
+    def report(self, thresholds):
+        """One dict per threshold with the pixel count and the fit of every band."""
+        rows = []
+        for t in sorted(set(thresholds)):
+            row = {'ncp_threshold': t, 'pixels': self.pixels(t)}
+            try:
+                fit = self.fit(t)
+            except ValueError:
+                fit = (np.full(self.bands, np.nan),) * 3
+            for name, values in zip(('intercepts', 'slopes', 'correlations'), fit):
+                row[name] = [float(v) for v in values]
+            rows.append(row)
+        return rows
+
+    def report_lines(self, thresholds):
+        """The report as log lines, slope/intercept/correlation per band."""
+        lines = ['NCP threshold sweep (per band: slope / intercept / correlation):']
+        for row in self.report(thresholds):
+            bands = '  '.join('{:.4f}/{:.2f}/{:.4f}'.format(b, a, r) for a, b, r in
+                              zip(row['intercepts'], row['slopes'], row['correlations']))
+            lines.append(' > {:.3f}  pixels {:>10}  {}'.format(row['ncp_threshold'], row['pixels'], bands))
+        return lines
+
+    def to_csv(self, path, thresholds):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ncp_threshold', 'pixels', 'band', 'slope', 'intercept', 'correlation'])
+            for row in self.report(thresholds):
+                for k in range(self.bands):
+                    writer.writerow([row['ncp_threshold'], row['pixels'], k + 1, row['slopes'][k],
+                                     row['intercepts'][k], row['correlations'][k]])
+        return path
+
+    def to_json(self, path, thresholds):
+        with open(path, 'w') as f:
+            json.dump({'buckets': self.buckets, 'sweep': self.report(thresholds)}, f, indent=2)
+        return path
+
+
+def ncp_sweep(img_imad, img_ref, img_tgt, pos=None, block_rows=DEFAULT_BLOCK_ROWS):
+    """NcpSweep of an IR-MAD output and its reference/target, read once in row blocks."""
+    imadDataset = gdal.Open(img_imad, GA_ReadOnly)
+    referenceDataset = gdal.Open(img_ref, GA_ReadOnly)
+    targetDataset = gdal.Open(img_tgt, GA_ReadOnly)
+    if imadDataset is None or referenceDataset is None or targetDataset is None:
+        raise QgsProcessingException('Error: could not open the iMAD, reference or target image.')
+    imadbands = imadDataset.RasterCount
+    cols = imadDataset.RasterXSize
+    rows = imadDataset.RasterYSize
+    if pos is None:
+        pos = list(range(1, referenceDataset.RasterCount + 1))
+    chisqrBand = imadDataset.GetRasterBand(imadbands)
+    refBands = [referenceDataset.GetRasterBand(k) for k in pos]
+    tgtBands = [targetDataset.GetRasterBand(k) for k in pos]
+
+    sweep = NcpSweep(len(pos), dof=imadbands - 1)
+    for y0, n in raster_ops._iter_row_blocks(rows, block_rows):
+        sweep.update(np.array([b.ReadAsArray(0, y0, cols, n) for b in refBands]),
+                     np.array([b.ReadAsArray(0, y0, cols, n) for b in tgtBands]),
+                     chisqrBand.ReadAsArray(0, y0, cols, n))
+    return sweep
+
+
+def radcal_apply(tgt, intercepts, slopes, out_dtype=None):
+    """Normalized a + b * tgt of a (bands, ...) array, or of one band with scalars.
+
+    With a GDAL integer out_dtype the values are clipped to its range (not
+    rounded); the result is float64 either way.
+    """
+    tgt = np.asarray(tgt, dtype=np.float64)
+    shape = (-1,) + (1,) * (tgt.ndim - 1)
+    normalized = np.reshape(intercepts, shape) + np.reshape(slopes, shape) * tgt
+    return _clip_for_dtype(normalized, out_dtype)
+
+
+COEFFICIENTS_FORMAT = 'arrnorm-radcal'
+COEFFICIENTS_VERSION = 1
+
+
+def save_coefficients(path, coefficients):
+    """Write a coefficient sidecar (as built by main) to path."""
+    coefficients = dict(coefficients, format=COEFFICIENTS_FORMAT, version=COEFFICIENTS_VERSION)
+    with open(path, 'w') as f:
+        json.dump(coefficients, f, indent=2)
+    return path
+
+
+def load_coefficients(path):
+    """Read a coefficient sidecar; ValueError if it is not one."""
+    with open(path) as f:
+        coefficients = json.load(f)
+    if not isinstance(coefficients, dict) or coefficients.get('format') != COEFFICIENTS_FORMAT:
+        raise ValueError(f'not a RadCal coefficient file: {path}')
+    if coefficients.get('version', 0) > COEFFICIENTS_VERSION:
+        raise ValueError(f'RadCal coefficient file version {coefficients["version"]} is not supported: {path}')
+    return coefficients
+
+
+def apply_coefficients(input_path, output_path, coefficients, out_dtype=None, block_rows=DEFAULT_BLOCK_ROWS,
+                       creation_options=None, feedback=None):
+    """Write a + b * input for every band of a coefficient sidecar, in row blocks.
+
+    coefficients is a sidecar dict or its path. The output type is out_dtype,
+    else the one recorded in the sidecar, else the input's; a scaled sidecar
+    writes the same codes and scale/offset as the original output (values
+    outside its range saturate). Input nodata pixels stay nodata. Returns
+    output_path, or None if canceled.
+    """
+    if not isinstance(coefficients, dict):
+        coefficients = load_coefficients(coefficients)
+    src_ds = gdal.Open(input_path, GA_ReadOnly)
+    if src_ds is None:
+        raise QgsProcessingException(f'Error: could not open raster: {input_path}')
+    bands = coefficients['bands']
+    if max(band['band'] for band in bands) > src_ds.RasterCount:
+        raise QgsProcessingException(
+            f'Error: {input_path} has {src_ds.RasterCount} bands, the coefficients are for band(s) '
+            f'{", ".join(str(band["band"]) for band in bands)}')
+    scaled_dtype = SCALED_TYPES.get(coefficients.get('scaled_output'))
+    if scaled_dtype is not None:
+        out_dtype = scaled_dtype
+    elif out_dtype is None:
+        out_dtype = (gdal.GetDataTypeByName(coefficients['dtype']) if coefficients.get('dtype')
+                     else src_ds.GetRasterBand(1).DataType)
+    cols, rows = src_ds.RasterXSize, src_ds.RasterYSize
+
+    dst_ds = raster_ops.output_driver(src_ds).Create(output_path, cols, rows, len(bands), out_dtype,
+                                                     list(creation_options or []))
+    raster_ops._copy_spatial_metadata(src_ds, dst_ds)
+    for j, band in enumerate(bands, start=1):
+        src_band = src_ds.GetRasterBand(band['band'])
+        out_band = dst_ds.GetRasterBand(j)
+        src_nodata = src_band.GetNoDataValue()
+        is_float = raster_ops._is_float_dtype(src_band.DataType)
+        if scaled_dtype is not None:
+            out_nodata = _SCALED_CODES[scaled_dtype][2]
+            out_band.SetScale(band['scale'])
+            out_band.SetOffset(band['offset'])
+            out_band.SetNoDataValue(out_nodata)
+        elif src_nodata is not None:
+            out_nodata = src_nodata
+            out_band.SetNoDataValue(out_nodata)
+        for y0, n in raster_ops._iter_row_blocks(rows, block_rows):
+            if feedback is not None and feedback.isCanceled():
+                return None
+            y = src_band.ReadAsArray(0, y0, cols, n).astype(np.float64)
+            normalized = radcal_apply(y, band['intercept'], band['slope'],
+                                      out_dtype if scaled_dtype is None else None)
+            if scaled_dtype is not None:
+                normalized = _to_codes(normalized, band['scale'], band['offset'], scaled_dtype)
+            if src_nodata is not None:
+                normalized[~raster_ops._safe_neq(y, src_nodata, is_float)] = out_nodata
+            out_band.WriteArray(normalized, 0, y0)
+        out_band.FlushCache()
+    src_ds = dst_ds = None
+    return output_path
+
+
+def apply_many(pairs, coefficients, workers=1, feedback=None, **options):
+    """apply_coefficients to (input, output) pairs, `workers` rasters at a time.
+
+    Returns one record per pair, in order, with its status ('ok', 'canceled'
+    or 'error'), elapsed time and error; a failing raster does not stop the
+    others. Other options are passed to apply_coefficients.
+    """
+    if not isinstance(coefficients, dict):
+        coefficients = load_coefficients(coefficients)
+
+    def one(pair):
+        record = {'input': pair[0], 'output': pair[1]}
+        start = time.time()
+        try:
+            done = apply_coefficients(pair[0], pair[1], coefficients, feedback=feedback, **options)
+            record['status'] = 'ok' if done else 'canceled'
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = str(e).strip()
+        record['elapsed_s'] = round(time.time() - start, 3)
+        return record
+
+    # GDAL I/O and the numpy arithmetic release the GIL, so threads suffice
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(one, pairs))
+
+
 def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
          graphics=False, out_dtype=None, img_ref=None, img_tgt=None,
-         output=None, feedback=None):
+         output=None, scaled_dtype=None, feedback=None, coefficients_file=None, sweep=None,
+         block_rows=DEFAULT_BLOCK_ROWS):
+    """RadCal of the target against the reference on the no-change pixels of img_imad.
+
+    The files are read in row blocks of block_rows: one pass fits every
+    band with radcal_fit_chunks, a second writes radcal_apply of the
+    target. With an NcpSweep as sweep, its sums for every NCP threshold
+    are accumulated in the fit pass.
+    """
 
     # -- Logging helpers: use QGIS feedback when available, print otherwise --
     def _info(msg):
@@ -134,50 +494,77 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
     else:
         x0, y0, cols, rows = dims
 
-    # The last iMad band is the chi-square statistic over the MAD variates.
-    # Under the null hypothesis (no change), it follows chi^2 with
-    # (imadbands - 1) degrees of freedom — the # of MAD variates.
-    # NCP = P(X >= chisqr) = sf(chisqr), which is numerically far more
-    # accurate than 1 - cdf() in the relevant upper tail.
-    chisqr = imadDataset.GetRasterBand(imadbands).ReadAsArray(0, 0, cols, rows).ravel()
-    ncp = stats.chi2.sf(chisqr, imadbands - 1)
-    idx = np.where(ncp > ncp_threshold)
+    bands = len(pos)
+    refBands = [referenceDataset.GetRasterBand(k) for k in pos]
+    tgtBands = [targetDataset.GetRasterBand(k) for k in pos]
+    # The last iMad band is the chi-square statistic over the
+    # (imadbands - 1) MAD variates.
+    chisqrBand = imadDataset.GetRasterBand(imadbands)
+    if scaled_dtype is not None:
+        if scaled_dtype not in _SCALED_CODES:
+            _error(f'Error: scaled output must be UInt16 or Int16, got {gdal.GetDataTypeName(scaled_dtype)}')
+        out_dtype = scaled_dtype
+    tgt_nodata = [(band.GetNoDataValue(), raster_ops._is_float_dtype(band.DataType)) for band in tgtBands]
+
+    def _valid(j, y):
+        nodata, is_float = tgt_nodata[j]
+        return raster_ops._safe_neq(y, nodata, is_float) if nodata is not None else np.ones(y.shape, dtype=bool)
+
+    # range of the valid target pixels, for the scale/offset of scaled codes
+    tgt_min = np.full(bands, np.inf)
+    tgt_max = np.full(bands, -np.inf)
+
+    def chunks():
+        for ry, n in raster_ops._iter_row_blocks(rows, block_rows):
+            if _canceled():
+                return
+            ref = np.array([b.ReadAsArray(x0, y0 + ry, cols, n) for b in refBands], dtype=np.float64)
+            tgt = np.array([b.ReadAsArray(x0, y0 + ry, cols, n) for b in tgtBands], dtype=np.float64)
+            chisqr = chisqrBand.ReadAsArray(0, ry, cols, n)
+            if sweep is not None:
+                sweep.update(ref, tgt, chisqr)
+            if scaled_dtype is not None:
+                for j in range(bands):
+                    valid = tgt[j][_valid(j, tgt[j])]
+                    if valid.size:
+                        tgt_min[j] = min(tgt_min[j], valid.min())
+                        tgt_max[j] = max(tgt_max[j], valid.max())
+            yield ref, tgt, chisqr
+
     _info(time.asctime())
     _info(f'reference: {referencefn}')
     _info(f'target   : {targetfn}')
     _info(f'no-change probability threshold: {ncp_threshold}')
-    _info(f'no-change pixels: {len(idx[0])}')
-
-    if len(idx[0]) < 2:
-        _error(
-            f"Error: only {len(idx[0])} no-change pixels selected "
-            f"(threshold={ncp_threshold}). Lower -t to keep more pixels.")
 
     start = time.time()
-    driver = targetDataset.GetDriver()
-    outDataset = driver.Create(outfn, cols, rows, len(pos), out_dtype)
-    projection = imadDataset.GetProjection()
-    geotransform = imadDataset.GetGeoTransform()
-    if geotransform is not None:
-        outDataset.SetGeoTransform(geotransform)
-    if projection is not None:
-        outDataset.SetProjection(projection)
-
-    aa = []
-    bb = []
-    if graphics and not _MPL_AVAILABLE:
+    # the fit of the array API, fed one row block at a time
+    samples = []
+    try:
+        aa, bb, correlations = radcal_fit_chunks(chunks(), bands, ncp_threshold=ncp_threshold,
+                                                 dof=imadbands - 1, samples=samples)
+    except ValueError as e:
+        if _canceled():
+            return
+        _error(f'Error: {e}. Lower -t to keep more pixels.')
+    if _canceled():
+        return
+    n_nochange = len(samples[0][0])
+    _info(f'no-change pixels: {n_nochange}')
+    for j, k in enumerate(pos):
+        _info(f'band: {k}  slope: {bb[j]:.6f}  intercept: {aa[j]:.6f}  correlation: {correlations[j]:.6f}')
+
+    plt = _pyplot() if graphics else None
+    if graphics and plt is None:
         _info('Warning: matplotlib not available — graphics output disabled.')
         graphics = False
+    if not graphics:
+        samples = None
 
-    bands = len(pos)
-    fig = None
-    plot_nrows = plot_ncols = 0
     if graphics:
         # Lay out band scatters in a grid of at most 3 cols × 2 rows = 6 panels.
         plot_ncols = min(bands, 3)
         plot_nrows = 2 if bands > 3 else 1
         n_total = cols * rows
-        n_nochange = len(idx[0])
         pct_nochange = 100.0 * n_nochange / n_total if n_total else 0.0
         fig, axes = plt.subplots(
             nrows=plot_nrows,
@@ -194,21 +581,11 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
             f'NCP threshold: {ncp_threshold}',
             fontsize=10,
         )
-
-    for j, k in enumerate(pos, start=1):
-        if _canceled():
-            return
-
-        x = referenceDataset.GetRasterBand(k).ReadAsArray(x0, y0, cols, rows).astype(np.float64).ravel()
-        y = targetDataset.GetRasterBand(k).ReadAsArray(x0, y0, cols, rows).astype(np.float64).ravel()
-        b_slope, a_intercept, R = orthoregress(y[idx], x[idx])
-        _info(f'band: {k}  slope: {b_slope:.6f}  intercept: {a_intercept:.6f}  correlation: {R:.6f}')
-        if graphics and j <= 6:
-            row, col = divmod(j - 1, 3)
+        for j, k in enumerate(pos[:6]):
+            row, col = divmod(j, 3)
             ax = axes[row][col]
 
-            xt = y[idx]          # target values at no-change pixels (x-axis)
-            yr = x[idx]          # reference values at no-change pixels (y-axis)
+            yr, xt = samples[j]  # reference (y-axis) and target (x-axis) no-change values
 
             # Independent percentile-based axis limits — each axis is framed
             # tightly around its own data. Using one shared range for both
@@ -227,7 +604,7 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
             # Vertical-residual RMSE of the fit — informative even though
             # orthoregress minimizes perpendicular distance, because it's the
             # quantity actually applied to the target band on output.
-            residuals = yr - (a_intercept + b_slope * xt)
+            residuals = yr - (aa[j] + bb[j] * xt)
             rmse = float(np.sqrt(np.mean(residuals ** 2)))
 
             # 1:1 reference line: only draw the segment of y=x that actually
@@ -246,11 +623,11 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
             ax.scatter(xt, yr, s=1, alpha=0.25,
                        color='steelblue', rasterized=True, zorder=2)
             line_x = np.array([x_lo, x_hi])
-            ax.plot(line_x, a_intercept + b_slope * line_x,
+            ax.plot(line_x, aa[j] + bb[j] * line_x,
                     color='crimson', lw=1.6, zorder=3,
-                    label=f'fit: y = {a_intercept:.2f} + {b_slope:.3f}·x')
+                    label=f'fit: y = {aa[j]:.2f} + {bb[j]:.3f}·x')
 
-            ax.set_title(f'Band {k}   R²={R ** 2:.3f}   RMSE={rmse:.2f}',
+            ax.set_title(f'Band {k}   R²={correlations[j] ** 2:.3f}   RMSE={rmse:.2f}',
                          fontsize=10)
             ax.set_xlabel('Target')
             ax.set_ylabel('Reference')
@@ -261,15 +638,6 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
             # the aspect that fills each subplot.
             ax.grid(True, alpha=0.3)
             ax.legend(loc='upper left', fontsize=8, framealpha=0.85)
-        aa.append(a_intercept)
-        bb.append(b_slope)
-        outBand = outDataset.GetRasterBand(j)
-        normalized = a_intercept + b_slope * y
-        normalized = _clip_for_dtype(normalized, out_dtype)
-        outBand.WriteArray(normalized.reshape(rows, cols), 0, 0)
-        outBand.FlushCache()
-
-    if graphics and fig is not None:
         # Hide unused axes when bands < grid capacity (e.g. 4 bands → 2×3 = 6 slots, 2 empty)
         for idx_ax in range(bands, plot_nrows * plot_ncols):
             r, c = divmod(idx_ax, plot_ncols)
@@ -284,11 +652,74 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
         fig.savefig(plot_path, dpi=150, bbox_inches='tight')
         plt.close(fig)
         _info(f'radcal plot saved to: {plot_path}')
+        samples = None
+
+    driver = raster_ops.output_driver(targetDataset)
+    outDataset = driver.Create(outfn, cols, rows, bands, out_dtype)
+    projection = imadDataset.GetProjection()
+    geotransform = imadDataset.GetGeoTransform()
+    if geotransform is not None:
+        outDataset.SetGeoTransform(geotransform)
+    if projection is not None:
+        outDataset.SetProjection(projection)
+    outBands = [outDataset.GetRasterBand(j) for j in range(1, bands + 1)]
+
+    scales = []
+    offsets = []
+    if scaled_dtype is not None:
+        for j, k in enumerate(pos):
+            # scale/offset from the regression and the range of the valid target pixels
+            if tgt_min[j] <= tgt_max[j]:
+                scale, offset = scaled_coefficients(aa[j], bb[j], tgt_min[j], tgt_max[j], scaled_dtype)
+            else:
+                scale, offset = 1.0, 0.0
+            scales.append(scale)
+            offsets.append(offset)
+            _info(f'band: {k}  scale: {scale:.6g}  offset: {offset:.6g}  '
+                  f'max quantization error: {scale / 2:.3g}')
+            outBands[j].SetScale(scale)
+            outBands[j].SetOffset(offset)
+            outBands[j].SetNoDataValue(_SCALED_CODES[scaled_dtype][2])
+
+    # second pass over the target: the normalized bands, block by block
+    for ry, n in raster_ops._iter_row_blocks(rows, block_rows):
+        if _canceled():
+            return
+        for j in range(bands):
+            y = tgtBands[j].ReadAsArray(x0, y0 + ry, cols, n).astype(np.float64)
+            # scaled codes are clipped below, after quantization
+            normalized = radcal_apply(y, aa[j], bb[j], out_dtype if scaled_dtype is None else None)
+            if scaled_dtype is not None:
+                normalized = _to_codes(normalized, scales[j], offsets[j], scaled_dtype)
+                normalized[~_valid(j, y)] = _SCALED_CODES[scaled_dtype][2]
+            outBands[j].WriteArray(normalized, 0, ry)
+    for outBand in outBands:
+        outBand.FlushCache()
+    outBands = None
+
     referenceDataset = None
     targetDataset = None
     outDataset = None
     _info(f'result written to: {outfn}')
 
+    if coefficients_file is not None:
+        coefficients = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'reference': os.path.abspath(referencefn),
+            'target': os.path.abspath(targetfn),
+            'ncp_threshold': ncp_threshold,
+            'no_change_pixels': int(n_nochange),
+            'dtype': gdal.GetDataTypeName(out_dtype) if out_dtype is not None else None,
+            'scaled_output': gdal.GetDataTypeName(scaled_dtype) if scaled_dtype is not None else None,
+            'bands': [{'band': k, 'intercept': float(aa[j]), 'slope': float(bb[j]),
+                       'correlation': float(correlations[j])} for j, k in enumerate(pos)],
+        }
+        if scaled_dtype is not None:
+            for band, scale, offset in zip(coefficients['bands'], scales, offsets):
+                band.update(scale=float(scale), offset=float(offset))
+        save_coefficients(coefficients_file, coefficients)
+        _info(f'coefficients written to: {coefficients_file}')
+
     if img_target is not None:
         _info(f'normalizing {img_target}...')
         fsDataset = gdal.Open(img_target, GA_ReadOnly)
@@ -296,7 +727,7 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
             _error(f'Error: full-scene file could not be opened: {img_target}')
         fcols = fsDataset.RasterXSize
         frows = fsDataset.RasterYSize
-        driver = fsDataset.GetDriver()
+        driver = raster_ops.output_driver(fsDataset)
         outDataset = driver.Create(fsoutfn, fcols, frows, len(pos), out_dtype)
         projection = fsDataset.GetProjection()
         geotransform = fsDataset.GetGeoTransform()
@@ -307,10 +738,20 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
         for j, k in enumerate(pos, start=1):
             inBand = fsDataset.GetRasterBand(k)
             outBand = outDataset.GetRasterBand(j)
+            if scaled_dtype is not None:
+                outBand.SetScale(scales[j - 1])
+                outBand.SetOffset(offsets[j - 1])
+                outBand.SetNoDataValue(_SCALED_CODES[scaled_dtype][2])
+            fs_nodata = inBand.GetNoDataValue()
+            fs_float = raster_ops._is_float_dtype(inBand.DataType)
             for i in range(frows):
                 y = inBand.ReadAsArray(0, i, fcols, 1).astype(np.float64)
-                normalized = aa[j - 1] + bb[j - 1] * y
-                normalized = _clip_for_dtype(normalized, out_dtype)
+                normalized = radcal_apply(y, aa[j - 1], bb[j - 1], out_dtype if scaled_dtype is None else None)
+                if scaled_dtype is not None:
+                    # values outside the target's range saturate at the end codes
+                    normalized = _to_codes(normalized, scales[j - 1], offsets[j - 1], scaled_dtype)
+                    if fs_nodata is not None:
+                        normalized[~raster_ops._safe_neq(y, fs_nodata, fs_float)] = _SCALED_CODES[scaled_dtype][2]
                 outBand.WriteArray(normalized, 0, i)
             outBand.FlushCache()
         outDataset = None
@@ -323,12 +764,13 @@ def main(img_imad, ncp_threshold=0.95, pos=None, dims=None, img_target=None,
 
 
 if __name__ == '__main__':
-    options, args = getopt.getopt(sys.argv[1:], 'hnp:d:t:')
+    options, args = getopt.getopt(sys.argv[1:], 'hnp:d:t:s:')
     pos = None
     dims = None
     ncp_threshold = 0.95
     fsfn = None
     graphics = True
+    scaled_dtype = None
     for option, value in options:
         if option == '-h':
             print(usage)
@@ -341,6 +783,8 @@ if __name__ == '__main__':
             dims = ast.literal_eval(value)
         elif option == '-t':
             ncp_threshold = float(value)
+        elif option == '-s':
+            scaled_dtype = SCALED_TYPES[value]
     if (len(args) != 1) and (len(args) != 2):
         print('Incorrect number of arguments')
         print(usage)
@@ -349,4 +793,4 @@ if __name__ == '__main__':
     if len(args) == 2:
         fsfn = args[1]
 
-    main(imadfn, ncp_threshold, pos, dims, fsfn, graphics=graphics)
\ No newline at end of file
+    main(imadfn, ncp_threshold, pos, dims, fsfn, graphics=graphics, scaled_dtype=scaled_dtype)
\ No newline at end of file
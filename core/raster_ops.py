@@ -7,6 +7,15 @@
 #    1. no_negative_value — threshold negative pixels to zero
 #    2. make_mask         — create a binary valid/nodata mask
 #    3. apply_mask        — multiply image by a binary mask
+#  no_negative_and_mask runs 1 and 3 in a single pass when the pipeline
+#  fuses those stages.
+#
+#  Bands with scale/offset metadata (the scaled-integer output of radcal)
+#  are tested in physical units, keep their scale/offset, and mark removed
+#  pixels with the band's own nodata code.
+#
+#  write_cog converts a finished raster into a Cloud-Optimized GeoTIFF
+#  (tiled, compressed, with internal overviews) in a single gdal.Translate.
 #
 #  They use block-iterated NumPy + GDAL band I/O (the same pattern already
 #  used by iMad.py and radcal.py) so that peak memory is bounded and
@@ -19,7 +28,11 @@ import numpy as np
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly
 
-DEFAULT_BLOCK_ROWS = 256
+from ArrNorm.core.memory import DEFAULT_BLOCK_ROWS
+
+# Output formats accepted by Normalization / register: plain GeoTIFF, or
+# a Cloud-Optimized GeoTIFF produced by write_cog.
+OUTPUT_FORMATS = ('GTiff', 'COG')
 
 
 def _iter_row_blocks(rows, block_rows=DEFAULT_BLOCK_ROWS):
@@ -38,6 +51,19 @@ def _copy_spatial_metadata(src_ds, dst_ds):
         dst_ds.SetProjection(proj)
 
 
+def output_driver(src_ds):
+    """Driver for a raster derived from src_ds.
+
+    The source's own driver, except for VRT sources (e.g. the shifted
+    target of the register stage): a VRT created from scratch holds no
+    pixels, so those outputs are written as GeoTIFF.
+    """
+    driver = src_ds.GetDriver()
+    if driver is None or driver.ShortName == 'VRT':
+        return gdal.GetDriverByName('GTiff')
+    return driver
+
+
 def _is_float_dtype(gdal_dtype):
     """Return True if the GDAL data type is floating-point."""
     return gdal_dtype in (gdal.GDT_Float32, gdal.GDT_Float64)
@@ -56,6 +82,123 @@ def _safe_neq(data, nodata_value, is_float):
     return data != nodata_value
 
 
+def _band_scaling(band):
+    """Return (scale, offset) of a band, or None if it stores plain values."""
+    scale = band.GetScale()
+    offset = band.GetOffset()
+    scale = 1.0 if scale is None else scale
+    offset = 0.0 if offset is None else offset
+    if scale == 1.0 and offset == 0.0:
+        return None
+    return scale, offset
+
+
+def _copy_scaling(src_band, dst_band, scaling):
+    if scaling is not None:
+        dst_band.SetScale(scaling[0])
+        dst_band.SetOffset(scaling[1])
+
+
+def cog_creation_options(gdal_dtype, compress='DEFLATE', overview_resampling='AVERAGE',
+                         blocksize=512):
+    """COG driver creation options for a raster of the given GDAL data type.
+
+    The predictor follows the data type: floating-point prediction (3) for
+    float rasters, horizontal differencing (2) for multi-byte integers and
+    none for Byte rasters such as masks. Compression and overview building
+    use every CPU.
+    """
+    if _is_float_dtype(gdal_dtype):
+        predictor = 3
+    elif gdal_dtype == gdal.GDT_Byte:
+        predictor = 1
+    else:
+        predictor = 2
+    return [f'COMPRESS={compress}', f'PREDICTOR={predictor}', 'NUM_THREADS=ALL_CPUS',
+            f'BLOCKSIZE={blocksize}', 'OVERVIEWS=AUTO', f'OVERVIEW_RESAMPLING={overview_resampling}',
+            'BIGTIFF=IF_SAFER']
+
+
+def write_cog(input_path, output_path, compress='DEFLATE', overview_resampling='AVERAGE'):
+    """Write input_path as a Cloud-Optimized GeoTIFF at output_path.
+
+    The COG driver only supports CreateCopy, so this is one gdal.Translate
+    of the finished raster; tiling, compression and overviews all happen
+    in that pass. Use overview_resampling='NEAREST' for masks/categories.
+    """
+    if gdal.GetDriverByName('COG') is None:
+        raise RuntimeError("The GDAL COG driver is not available (GDAL >= 3.1 is required)")
+    src_ds = gdal.Open(input_path, GA_ReadOnly)
+    if src_ds is None:
+        raise RuntimeError(f"Cannot open raster: {input_path}")
+    options = cog_creation_options(src_ds.GetRasterBand(1).DataType, compress=compress,
+                                   overview_resampling=overview_resampling)
+    dst_ds = gdal.Translate(output_path, src_ds, format='COG', creationOptions=options)
+    if dst_ds is None:
+        raise RuntimeError(f"gdal.Translate failed to write COG: {output_path}")
+    dst_ds = None
+    src_ds = None
+    return output_path
+
+
+def _no_negative_nodata(src_nodata, scaling, nodata_value):
+    """Output nodata value of no_negative_value for one band."""
+    if scaling is not None and src_nodata is not None:
+        return src_nodata
+    return (nodata_value if nodata_value is not None
+            else (src_nodata if src_nodata is not None else 0))
+
+
+def _no_negative_block(data, src_nodata, out_nodata, is_float, scaling):
+    if scaling is not None:
+        negative = data * scaling[0] + scaling[1] < 0
+    else:
+        negative = data < 0
+
+    if src_nodata is not None:
+        valid = _safe_neq(data, src_nodata, is_float)
+        negative_valid = valid & negative
+        is_nodata = ~valid
+        return np.where(negative_valid | is_nodata, out_nodata, data)
+    return np.where(negative, out_nodata, data)
+
+
+def _apply_mask_block(img_data, mask_data, src_nodata, out_nodata, is_float, scaling):
+    if scaling is not None:
+        result = np.where(mask_data == 1, img_data, out_nodata)
+    else:
+        result = img_data * (mask_data == 1)
+    if src_nodata is not None:
+        valid = _safe_neq(img_data, src_nodata, is_float)
+        result = np.where(valid, result, out_nodata)
+    return result
+
+
+def _as_band_dtype(data, dtype):
+    """Cast block values the way a band write does: rounded and clamped for integers."""
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(dtype)
+        data = np.clip(np.rint(data), info.min, info.max)
+    return data.astype(dtype, copy=False)
+
+
+def _open_image_and_mask(image_path, mask_path):
+    img_ds = gdal.Open(image_path, GA_ReadOnly)
+    if img_ds is None:
+        raise RuntimeError(f"Cannot open raster: {image_path}")
+
+    mask_ds = gdal.Open(mask_path, GA_ReadOnly)
+    if mask_ds is None:
+        raise RuntimeError(f"Cannot open mask: {mask_path}")
+
+    if (mask_ds.RasterXSize != img_ds.RasterXSize or
+            mask_ds.RasterYSize != img_ds.RasterYSize):
+        raise RuntimeError(
+            f"Mask dimensions ({mask_ds.RasterXSize}x{mask_ds.RasterYSize}) "
+            f"don't match image ({img_ds.RasterXSize}x{img_ds.RasterYSize})")
+    return img_ds, mask_ds
+
+
 def no_negative_value(input_path, output_path, nodata_value=None,
                       creation_options=None, block_rows=DEFAULT_BLOCK_ROWS):
     """Convert negative pixel values to the output nodata value.
@@ -66,12 +209,14 @@ def no_negative_value(input_path, output_path, nodata_value=None,
     3. Zero as the ultimate fallback.
 
     Existing nodata pixels are propagated to the output nodata value.
+    Scaled bands are tested as ``code * scale + offset < 0`` and, when they
+    declare a nodata code, that code is used instead of *nodata_value*.
     """
     src_ds = gdal.Open(input_path, GA_ReadOnly)
     if src_ds is None:
         raise RuntimeError(f"Cannot open raster: {input_path}")
 
-    driver = src_ds.GetDriver()
+    driver = output_driver(src_ds)
     nbands = src_ds.RasterCount
     cols, rows = src_ds.RasterXSize, src_ds.RasterYSize
     dtype = src_ds.GetRasterBand(1).DataType
@@ -86,24 +231,15 @@ def no_negative_value(input_path, output_path, nodata_value=None,
 
         src_nodata = src_band.GetNoDataValue()
         is_float = _is_float_dtype(src_band.DataType)
+        scaling = _band_scaling(src_band)
+        _copy_scaling(src_band, out_band, scaling)
 
-        out_nodata = (
-            nodata_value if nodata_value is not None
-            else (src_nodata if src_nodata is not None else 0)
-        )
+        out_nodata = _no_negative_nodata(src_nodata, scaling, nodata_value)
         out_band.SetNoDataValue(float(out_nodata))
 
         for y_off, n_rows in _iter_row_blocks(rows, block_rows):
             data = src_band.ReadAsArray(0, y_off, cols, n_rows)
-
-            if src_nodata is not None:
-                valid = _safe_neq(data, src_nodata, is_float)
-                negative_valid = valid & (data < 0)
-                is_nodata = ~valid
-                result = np.where(negative_valid | is_nodata, out_nodata, data)
-            else:
-                result = np.where(data < 0, out_nodata, data)
-
+            result = _no_negative_block(data, src_nodata, out_nodata, is_float, scaling)
             out_band.WriteArray(result, 0, y_off)
 
         desc = src_band.GetDescription()
@@ -127,7 +263,7 @@ def make_mask(input_path, output_path, nodata_value,
     if src_ds is None:
         raise RuntimeError(f"Cannot open raster: {input_path}")
 
-    driver = src_ds.GetDriver()
+    driver = output_driver(src_ds)
     cols, rows = src_ds.RasterXSize, src_ds.RasterYSize
     src_band = src_ds.GetRasterBand(1)
     src_dtype = src_band.DataType
@@ -159,26 +295,16 @@ def apply_mask(image_path, mask_path, output_path, nodata_value,
 
     Equivalent to the gdal_calc expression ``A*(B==1)`` with
     ``allBands="A"``.  Input nodata pixels are propagated to the
-    output nodata value.
+    output nodata value. Masked pixels of a scaled band take its nodata
+    code rather than code 0, which may be a valid value.
     """
-    img_ds = gdal.Open(image_path, GA_ReadOnly)
-    if img_ds is None:
-        raise RuntimeError(f"Cannot open raster: {image_path}")
+    img_ds, mask_ds = _open_image_and_mask(image_path, mask_path)
 
-    mask_ds = gdal.Open(mask_path, GA_ReadOnly)
-    if mask_ds is None:
-        raise RuntimeError(f"Cannot open mask: {mask_path}")
-
-    driver = img_ds.GetDriver()
+    driver = output_driver(img_ds)
     nbands = img_ds.RasterCount
     cols, rows = img_ds.RasterXSize, img_ds.RasterYSize
     dtype = img_ds.GetRasterBand(1).DataType
 
-    if mask_ds.RasterXSize != cols or mask_ds.RasterYSize != rows:
-        raise RuntimeError(
-            f"Mask dimensions ({mask_ds.RasterXSize}x{mask_ds.RasterYSize}) "
-            f"don't match image ({cols}x{rows})")
-
     co = list(creation_options or [])
     dst_ds = driver.Create(output_path, cols, rows, nbands, dtype, co)
     _copy_spatial_metadata(img_ds, dst_ds)
@@ -188,18 +314,67 @@ def apply_mask(image_path, mask_path, output_path, nodata_value,
     for b in range(1, nbands + 1):
         src_band = img_ds.GetRasterBand(b)
         out_band = dst_ds.GetRasterBand(b)
-        out_band.SetNoDataValue(float(nodata_value))
 
         src_nodata = src_band.GetNoDataValue()
         is_float = _is_float_dtype(src_band.DataType)
+        scaling = _band_scaling(src_band)
+        _copy_scaling(src_band, out_band, scaling)
+        out_nodata = src_nodata if scaling is not None and src_nodata is not None else nodata_value
+        out_band.SetNoDataValue(float(out_nodata))
 
         for y_off, n_rows in _iter_row_blocks(rows, block_rows):
             img_data = src_band.ReadAsArray(0, y_off, cols, n_rows)
             mask_data = mask_band.ReadAsArray(0, y_off, cols, n_rows)
-            result = img_data * (mask_data == 1)
-            if src_nodata is not None:
-                valid = _safe_neq(img_data, src_nodata, is_float)
-                result = np.where(valid, result, nodata_value)
+            result = _apply_mask_block(img_data, mask_data, src_nodata, out_nodata, is_float, scaling)
+            out_band.WriteArray(result, 0, y_off)
+
+        desc = src_band.GetDescription()
+        if desc:
+            out_band.SetDescription(desc)
+        out_band.FlushCache()
+
+    img_ds = mask_ds = dst_ds = None
+
+
+def no_negative_and_mask(image_path, mask_path, output_path, nodata_value,
+                         creation_options=None, block_rows=DEFAULT_BLOCK_ROWS):
+    """no_negative_value followed by apply_mask in a single pass.
+
+    Gives the same pixels and metadata as the two calls chained through an
+    intermediate raster, without writing and reading that raster back.
+    """
+    img_ds, mask_ds = _open_image_and_mask(image_path, mask_path)
+
+    driver = output_driver(img_ds)
+    nbands = img_ds.RasterCount
+    cols, rows = img_ds.RasterXSize, img_ds.RasterYSize
+    dtype = img_ds.GetRasterBand(1).DataType
+
+    co = list(creation_options or [])
+    dst_ds = driver.Create(output_path, cols, rows, nbands, dtype, co)
+    _copy_spatial_metadata(img_ds, dst_ds)
+
+    mask_band = mask_ds.GetRasterBand(1)
+
+    for b in range(1, nbands + 1):
+        src_band = img_ds.GetRasterBand(b)
+        out_band = dst_ds.GetRasterBand(b)
+
+        src_nodata = src_band.GetNoDataValue()
+        is_float = _is_float_dtype(src_band.DataType)
+        scaling = _band_scaling(src_band)
+        _copy_scaling(src_band, out_band, scaling)
+        # the intermediate band of the chained calls declares this nodata value
+        mid_nodata = float(_no_negative_nodata(src_nodata, scaling, nodata_value))
+        out_nodata = mid_nodata if scaling is not None else nodata_value
+        out_band.SetNoDataValue(float(out_nodata))
+
+        for y_off, n_rows in _iter_row_blocks(rows, block_rows):
+            data = src_band.ReadAsArray(0, y_off, cols, n_rows)
+            mid = _as_band_dtype(_no_negative_block(data, src_nodata, mid_nodata, is_float, scaling),
+                                 data.dtype)
+            mask_data = mask_band.ReadAsArray(0, y_off, cols, n_rows)
+            result = _apply_mask_block(mid, mask_data, mid_nodata, out_nodata, is_float, scaling)
             out_band.WriteArray(result, 0, y_off)
 
         desc = src_band.GetDescription()
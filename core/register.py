@@ -7,25 +7,31 @@
 #  one band of the reference and target images using log-polar / Fourier
 #  cross-correlation (Reddy & Chatterji), then applies it to every band of
 #  the target. When chunksize is set, the estimation is repeated on a grid
-#  of blocks and the warped blocks are mosaicked back together.
+#  of blocks and each warped block is written into its window of a single
+#  full-size output (or, with virtual=True, into its own file referenced by
+#  a VRT). With overview set, the transform is estimated coarse-to-fine:
+#  once on a decimated overview, then only the residual shift is refined on
+#  small full-resolution windows, so the cost barely grows with scene size.
 #
-#  Original: M. Canty, 2013. Refactored: clearer variable names, mosaic via
-#  the gdal.Warp Python API instead of subprocess.
+#  Original: M. Canty, 2013. Refactored: clearer variable names, blocks
+#  written in place instead of per-block files mosaicked by gdalwarp.
 #
 #  License: GPLv2+
 # ******************************************************************************
 
 import ast
+import collections
 import getopt
 import os
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 import numpy as np
-import scipy.ndimage as ndii
 from osgeo import gdal
 from osgeo.gdalconst import GA_ReadOnly
 
+from ArrNorm.core import raster_ops
 from ArrNorm.core.auxil import auxil
 
 try:
@@ -36,18 +42,315 @@ except ImportError:
 usage = '''
 Usage:
 ------------------------------------------------
-python register.py [-h] [-b warpband] [-d "spatialDimensions"]
-                   reffname warpfname
+python register.py [-h] [-b warpband] [-c chunksize] [-w workers] [-p overview] [-v]
+                   [-f GTiff|COG] reffname warpfname
+
+  -p  coarse-to-fine: estimate on an overview of this size (pixels), then
+      refine the shift on small full-resolution windows
+  -w  estimate the block transforms with this many worker threads
+  -v  write per-block files assembled by a VRT instead of one GeoTIFF
+  -f  output format: GTiff (default) or COG (Cloud-Optimized GeoTIFF)
 ------------------------------------------------'''
 
 
+# Extra pixels read around a block, on top of the shift itself, so that the
+# cubic-spline prefilter of ndii.shift sees practically the same neighbourhood
+# as on the full image (its influence decays by ~0.27 per pixel).
+SPLINE_HALO = 16
+
+# Side of the full-resolution windows used to refine the coarse (overview)
+# estimate in pyramid mode.
+PYRAMID_WINDOW = 256
+
+# Longer side of the overview used by estimate_shift.
+REGISTER_OVERVIEW = 512
+
+
+def _shifted_window(band, x0, y0, cols_blk, rows_blk, shift):
+    """Return the [y0:y0+rows_blk, x0:x0+cols_blk] window of band shifted by shift.
+
+    Equivalent to ndii.shift(full_band, shift)[window] but only reads the
+    window plus a halo sized to the shift. Integer shifts are plain slicing
+    (zero fill outside the image) with no spline interpolation at all.
+    """
+    cols, rows = band.XSize, band.YSize
+    t0, t1 = float(shift[0]), float(shift[1])
+
+    if t0.is_integer() and t1.is_integer():
+        t0, t1 = int(t0), int(t1)
+        out = np.zeros((rows_blk, cols_blk), dtype=np.float32)
+        # output pixel (r, c) comes from input pixel (r - t0, c - t1)
+        src_y0 = max(0, y0 - t0)
+        src_y1 = min(rows, y0 + rows_blk - t0)
+        src_x0 = max(0, x0 - t1)
+        src_x1 = min(cols, x0 + cols_blk - t1)
+        if src_y1 > src_y0 and src_x1 > src_x0:
+            out[src_y0 + t0 - y0:src_y1 + t0 - y0, src_x0 + t1 - x0:src_x1 + t1 - x0] = \
+                band.ReadAsArray(src_x0, src_y0, src_x1 - src_x0, src_y1 - src_y0)
+        return out
+
+    halo_y = int(np.ceil(abs(t0))) + SPLINE_HALO
+    halo_x = int(np.ceil(abs(t1))) + SPLINE_HALO
+    reg_y0 = max(0, y0 - halo_y)
+    reg_y1 = min(rows, y0 + rows_blk + halo_y)
+    reg_x0 = max(0, x0 - halo_x)
+    reg_x1 = min(cols, x0 + cols_blk + halo_x)
+    region = band.ReadAsArray(reg_x0, reg_y0, reg_x1 - reg_x0, reg_y1 - reg_y0).astype(np.float32)
+    import scipy.ndimage as ndii  # only needed for sub-pixel shifts
+    shifted = ndii.shift(region, (t0, t1))
+    return shifted[y0 - reg_y0:y0 - reg_y0 + rows_blk, x0 - reg_x0:x0 - reg_x0 + cols_blk]
+
+
+def _pool_map(func, args_iter, workers=1, pool='thread', canceled=None):
+    """Return [func(*args) for args in args_iter], in order.
+
+    args_iter is consumed lazily in the calling thread (GDAL datasets are
+    not thread-safe), func runs in a thread pool (scipy.fft releases the
+    GIL) or a process pool. At most 2 * workers calls are in flight, so
+    memory stays bounded. Returns None if canceled() becomes true.
+    """
+    canceled = canceled or (lambda: False)
+    if workers <= 1:
+        results = []
+        for args in args_iter:
+            if canceled():
+                return None
+            results.append(func(*args))
+        return results
+
+    executor_cls = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+    executor = executor_cls(max_workers=workers)
+    pending = collections.deque()
+    results = []
+    try:
+        for args in args_iter:
+            while len(pending) >= 2 * workers:
+                results.append(pending.popleft().result())
+            if canceled():
+                return None
+            pending.append(executor.submit(func, *args))
+        while pending:
+            # poll so a cancel request is honored while the pool is busy
+            done, _ = wait([pending[0]], timeout=0.25)
+            if not done:
+                if canceled():
+                    return None
+                continue
+            results.append(pending.popleft().result())
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+    return results
+
+
+def _estimate_transforms(blocks, ref_band, tgt_band, workers=1, pool='thread', canceled=None):
+    """Estimate the similarity transform of every block, in block order.
+
+    blocks is a list of (x0, y0, cols, rows) windows. Returns None if
+    canceled() becomes true while waiting.
+    """
+    def read(blk):
+        x0, y0, cols_blk, rows_blk = blk
+        return (ref_band.ReadAsArray(x0, y0, cols_blk, rows_blk).astype(np.float32),
+                tgt_band.ReadAsArray(x0, y0, cols_blk, rows_blk).astype(np.float32))
+
+    return _pool_map(auxil.similarity, (read(blk) for blk in blocks),
+                     workers=workers, pool=pool, canceled=canceled)
+
+
+def _read_overview(band, cols, rows, size):
+    """Read the [0:rows, 0:cols] window of band decimated so its longer side is size.
+
+    GDAL averages the source pixels (GRIORA_Average). Returns the overview
+    and the (row, col) decimation factors.
+    """
+    factor = max(1.0, max(cols, rows) / float(size))
+    buf_x = max(1, int(round(cols / factor)))
+    buf_y = max(1, int(round(rows / factor)))
+    ov = band.ReadAsArray(0, 0, cols, rows, buf_xsize=buf_x, buf_ysize=buf_y,
+                          resample_alg=gdal.GRIORA_Average)
+    return ov.astype(np.float32), (rows / float(buf_y), cols / float(buf_x))
+
+
+def _residual_shift(ref_win, tgt_win, limit):
+    """Phase-correlation shift between two windows, or None.
+
+    None for missing or featureless windows, and for estimates larger
+    than limit (the coarse step cannot be that far off, so the peak is
+    spurious).
+    """
+    if ref_win is None or np.ptp(ref_win) == 0 or np.ptp(tgt_win) == 0:
+        return None
+    shift = auxil.translation(ref_win, tgt_win)
+    if max(abs(shift[0]), abs(shift[1])) > limit:
+        return None
+    return shift
+
+
+def _refine_windows(blocks, cols, rows, size, per_block):
+    """Full-resolution windows used to refine the coarse shift.
+
+    One window centered on each block with per_block=True, otherwise a
+    fixed 3x3 grid over the image, so the cost does not grow with the
+    scene size.
+    """
+    if per_block:
+        centers = [(x0 + cols_blk // 2, y0 + rows_blk // 2) for x0, y0, cols_blk, rows_blk in blocks]
+    else:
+        centers = [(int(cols * (i + 0.5) / 3), int(rows * (j + 0.5) / 3))
+                   for j in range(3) for i in range(3)]
+    return [(cx - size // 2, cy - size // 2, size, size) for cx, cy in centers]
+
+
+def _estimate_pyramid(blocks, ref_band, tgt_band, overview, window, per_block,
+                      workers=1, pool='thread', canceled=None, info=print):
+    """Coarse-to-fine transform estimate, one (scale, angle, shift) per block.
+
+    Scale, angle and shift are estimated once on decimated overviews of
+    the common extent, then only the residual integer translation is
+    refined on small full-resolution windows (one per block, or a 3x3 grid
+    combined by median). Returns None if canceled.
+    """
+    cols = min(ref_band.XSize, tgt_band.XSize)
+    rows = min(ref_band.YSize, tgt_band.YSize)
+    ov_ref, factor = _read_overview(ref_band, cols, rows, overview)
+    ov_tgt, _ = _read_overview(tgt_band, cols, rows, overview)
+    scale, angle, ov_shift = auxil.similarity(ov_ref, ov_tgt)
+    coarse = (int(round(ov_shift[0] * factor[0])), int(round(ov_shift[1] * factor[1])))
+    info(f'coarse estimate on {ov_ref.shape[1]}x{ov_ref.shape[0]} overview: '
+         f'scale {scale:.4f}, angle {angle:.3f}, shift {list(coarse)}')
+
+    # the coarse shift is off by at most about one overview pixel
+    limit = int(np.ceil(max(factor))) * 2 + 2
+    size = max(window, 4 * limit)
+
+    def read(win):
+        # ref window at (x, y) pairs with the target window at (x, y) - coarse,
+        # both clipped to their images
+        x, y, w, h = win
+        x_lo = max(x, 0, coarse[1])
+        x_hi = min(x + w, ref_band.XSize, tgt_band.XSize + coarse[1])
+        y_lo = max(y, 0, coarse[0])
+        y_hi = min(y + h, ref_band.YSize, tgt_band.YSize + coarse[0])
+        if x_hi - x_lo < 32 or y_hi - y_lo < 32:
+            return None, None, limit
+        ref_win = ref_band.ReadAsArray(x_lo, y_lo, x_hi - x_lo, y_hi - y_lo).astype(np.float32)
+        tgt_win = tgt_band.ReadAsArray(x_lo - coarse[1], y_lo - coarse[0],
+                                       x_hi - x_lo, y_hi - y_lo).astype(np.float32)
+        return ref_win, tgt_win, limit
+
+    windows = _refine_windows(blocks, cols, rows, size, per_block)
+    residuals = _pool_map(_residual_shift, (read(win) for win in windows),
+                          workers=workers, pool=pool, canceled=canceled)
+    if residuals is None:
+        return None
+    found = [r for r in residuals if r is not None]
+    info(f'residual shift refined on {len(found)} of {len(windows)} {size}px windows')
+
+    if not per_block:
+        if found:
+            residual = [int(round(np.median([r[0] for r in found]))),
+                        int(round(np.median([r[1] for r in found])))]
+        else:
+            residual = [0, 0]
+        residuals = [residual] * len(blocks)
+    return [(scale, angle, [coarse[0] + r[0], coarse[1] + r[1]] if r is not None else list(coarse))
+            for r in residuals]
+
+
 def _chunks(seq, n):
     """Split a sequence into consecutive chunks of size n (last may be smaller)."""
     n = max(1, n)
     return [seq[i:i + n] for i in range(0, len(seq), n)]
 
 
-def main(img_ref, img_target, warpband=2, chunksize=None, feedback=None):
+def estimate_shift(img_ref, img_target, warpband=1, overview=REGISTER_OVERVIEW,
+                   refine_window=PYRAMID_WINDOW, feedback=None):
+    """Estimate one (scale, angle, [t_row, t_col]) registering img_target onto img_ref.
+
+    Coarse-to-fine on an overview of the given size; overview=None runs
+    auxil.similarity on the full bands instead. Both images are expected
+    on the same pixel grid (e.g. after Normalization.clipper).
+    """
+    def _info(msg):
+        if feedback is not None:
+            feedback.pushInfo(msg)
+        else:
+            print(msg)
+
+    def _canceled():
+        return feedback is not None and feedback.isCanceled()
+
+    inDataset1 = gdal.Open(img_ref, GA_ReadOnly)
+    inDataset2 = gdal.Open(img_target, GA_ReadOnly)
+    if inDataset1 is None or inDataset2 is None:
+        raise QgsProcessingException('Error: input image(s) could not be opened.')
+    warpband = min(warpband, inDataset1.RasterCount, inDataset2.RasterCount)
+    ref_band = inDataset1.GetRasterBand(warpband)
+    tgt_band = inDataset2.GetRasterBand(warpband)
+    cols = min(ref_band.XSize, tgt_band.XSize)
+    rows = min(ref_band.YSize, tgt_band.YSize)
+
+    if overview:
+        transforms = _estimate_pyramid([(0, 0, cols, rows)], ref_band, tgt_band, overview,
+                                       refine_window, per_block=False, canceled=_canceled,
+                                       info=_info)
+        transform = transforms[0] if transforms else None
+    else:
+        transform = auxil.similarity(
+            ref_band.ReadAsArray(0, 0, cols, rows).astype(np.float32),
+            tgt_band.ReadAsArray(0, 0, cols, rows).astype(np.float32))
+    ref_band = tgt_band = inDataset1 = inDataset2 = None
+    if transform is None:
+        return None
+    scale, angle, shift = transform
+    return float(scale), float(angle), [int(shift[0]), int(shift[1])]
+
+
+def shift_virtual(img_target, shift, outfn=None):
+    """Write a VRT of img_target translated by an integer [t_row, t_col] shift.
+
+    Same result as the integer path of main() (output pixel (r, c) is input
+    pixel (r - t_row, c - t_col), zero outside the image) but no pixels are
+    copied: the VRT reads a shifted source window and keeps the target's
+    own geotransform. Returns the VRT path.
+    """
+    if outfn is None:
+        root, _ext = os.path.splitext(os.path.abspath(img_target))
+        outfn = root + '_warp.vrt'
+    t0, t1 = int(round(shift[0])), int(round(shift[1]))
+    src = gdal.Open(img_target, GA_ReadOnly)
+    geotransform = src.GetGeoTransform()
+    cols, rows = src.RasterXSize, src.RasterYSize
+    src = None
+    vrt = gdal.Translate(outfn, img_target, format='VRT', srcWin=[-t1, -t0, cols, rows])
+    if vrt is None:
+        raise QgsProcessingException('Error: gdal.Translate failed to build the shifted VRT.')
+    if geotransform is not None:
+        vrt.SetGeoTransform(geotransform)
+    vrt = None
+    return outfn
+
+
+def main(img_ref, img_target, warpband=2, chunksize=None, virtual=False, workers=1,
+         pool='thread', overview=None, refine_window=PYRAMID_WINDOW, output_format='GTiff',
+         feedback=None):
+    """Register img_target onto img_ref and return the registered file.
+
+    workers > 1 estimates the per-block transforms concurrently in a
+    thread pool, or in a process pool with pool='process'.
+
+    overview (pixels) switches to coarse-to-fine estimation: the transform
+    is estimated on an overview whose longer side is overview pixels and
+    the shift is refined on refine_window-sized full-resolution windows
+    (one per block when chunksize is set), instead of running the full
+    estimation on every full-resolution block.
+
+    output_format='COG' writes the registered image as a Cloud-Optimized
+    GeoTIFF (the block mosaic is converted in the same call; virtual is
+    ignored).
+    """
     gdal.AllRegister()
 
     # -- Logging helpers: use QGIS feedback when available, print otherwise --
@@ -109,69 +412,104 @@ def main(img_ref, img_target, warpband=2, chunksize=None, feedback=None):
 
     x_chunks = _chunks(list(range(cols2)), x_chunk_size)
     y_chunks = _chunks(list(range(rows2)), y_chunk_size)
-
+    block_ids = [(x_idx, y_idx) for y_idx in range(len(y_chunks)) for x_idx in range(len(x_chunks))]
+    blocks = [(x_chunks[x_idx][0], y_chunks[y_idx][0], len(x_chunks[x_idx]), len(y_chunks[y_idx]))
+              for x_idx, y_idx in block_ids]
+
+    # Estimate the similarity transform of every block (concurrently when
+    # workers > 1); the estimates come back in block order.
+    if overview:
+        transforms = _estimate_pyramid(blocks, ref_band, tgt_band, overview, refine_window,
+                                       per_block=chunksize is not None, workers=workers,
+                                       pool=pool, canceled=_canceled, info=_info)
+    else:
+        if workers > 1 and len(blocks) > 1:
+            _info(f'estimating {len(blocks)} block transforms with {workers} {pool} workers')
+        transforms = _estimate_transforms(blocks, ref_band, tgt_band, workers=workers,
+                                          pool=pool, canceled=_canceled)
+    if transforms is None:
+        return
+
+    projection = inDataset1.GetProjection()
+    geotransform = inDataset1.GetGeoTransform()
+
+    def _create(filename, driver, cols_out, rows_out, x_off, y_off, options=()):
+        ds = driver.Create(filename, cols_out, rows_out, bands2, tgt_band.DataType, list(options))
+        if geotransform is not None:
+            gt = list(geotransform)
+            gt[0] = gt[0] + x_off * gt[1]
+            gt[3] = gt[3] + y_off * gt[5]
+            ds.SetGeoTransform(tuple(gt))
+        if projection is not None:
+            ds.SetProjection(projection)
+        return ds
+
+    # Blocks are written straight into their window of one full-size output.
+    # With virtual=True each block goes to its own file instead and a VRT
+    # stitches them together without copying any pixels.
     blocks_files = []
-    for y_idx_block, y_block in enumerate(y_chunks):
-        for x_idx_block, x_block in enumerate(x_chunks):
-            if _canceled():
-                return
+    outDataset = None
+    cog_fn = None
+    if output_format == 'COG':
+        if virtual:
+            _info('COG output requested: writing a single mosaic instead of a VRT')
+            virtual = False
+        cog_fn = outfn
+        outfn = os.path.join(path, root2 + '_warp_mosaic.tif')
+    if virtual:
+        outfn = os.path.join(path, root2 + '_warp.vrt')
+    else:
+        outDataset = _create(outfn, gdal.GetDriverByName('GTiff'), cols2, rows2, 0, 0,
+                             ['BIGTIFF=IF_SAFER'])
 
-            x0 = x_block[0]
-            y0 = y_block[0]
-            cols_blk = len(x_block)
-            rows_blk = len(y_block)
+    for (x_idx_block, y_idx_block), (x0, y0, cols_blk, rows_blk), (scale, angle, shift) in \
+            zip(block_ids, blocks, transforms):
+        if _canceled():
+            outDataset = None
+            return
 
+        if virtual:
             block_filename = os.path.join(
                 path,
                 f'{root2}_warp_block_x{x_idx_block}y{y_idx_block}{ext2}')
-
-            # Estimate similarity transform on this block
-            ref_tile = ref_band.ReadAsArray(x0, y0, cols_blk, rows_blk).astype(np.float32)
-            warp_tile = tgt_band.ReadAsArray(x0, y0, cols_blk, rows_blk).astype(np.float32)
-            scale, angle, shift = auxil.similarity(ref_tile, warp_tile)
-
-            driver = inDataset2.GetDriver()
-            outDataset = driver.Create(block_filename, cols_blk, rows_blk,
-                                       bands2, tgt_band.DataType)
-            projection = inDataset1.GetProjection()
-            geotransform = inDataset1.GetGeoTransform()
-            if geotransform is not None:
-                gt = list(geotransform)
-                gt[0] = gt[0] + x0 * gt[1]
-                gt[3] = gt[3] + y0 * gt[5]
-                outDataset.SetGeoTransform(tuple(gt))
-            if projection is not None:
-                outDataset.SetProjection(projection)
-
-            # Apply the translation to every band (zoom/rotate intentionally
-            # disabled — for Landsat-scale shifts they introduce more
-            # interpolation noise than they remove)
-            for k in range(bands2):
-                in_band_full = inDataset2.GetRasterBand(k + 1)
-                out_band_blk = outDataset.GetRasterBand(k + 1)
-                bn1 = in_band_full.ReadAsArray(0, 0, cols2, rows2).astype(np.float32)
-                shifted = ndii.shift(bn1, shift)
-                out_band_blk.WriteArray(shifted[y0:y0 + rows_blk, x0:x0 + cols_blk])
-                out_band_blk.FlushCache()
-
+            blockDataset = _create(block_filename, inDataset2.GetDriver(),
+                                   cols_blk, rows_blk, x0, y0)
             blocks_files.append(block_filename)
-            outDataset = None
+            x_out, y_out = 0, 0
+        else:
+            blockDataset = outDataset
+            x_out, y_out = x0, y0
+
+        # Apply the translation to every band (zoom/rotate intentionally
+        # disabled — for Landsat-scale shifts they introduce more
+        # interpolation noise than they remove). Only the block window
+        # plus a halo is read, instead of the full band per block.
+        for k in range(bands2):
+            in_band = inDataset2.GetRasterBand(k + 1)
+            out_band = blockDataset.GetRasterBand(k + 1)
+            out_band.WriteArray(
+                _shifted_window(in_band, x0, y0, cols_blk, rows_blk, shift), x_out, y_out)
+
+        if virtual:
+            # bands keep their dataset alive: flush and drop both so the
+            # block file is complete before the VRT references it
+            blockDataset.FlushCache()
+            blockDataset = out_band = in_band = None
+
+    if virtual:
+        vrt = gdal.BuildVRT(outfn, blocks_files)
+        if vrt is None:
+            _error('Error: gdal.BuildVRT failed to assemble block files.')
+        vrt = None
+        _info(f'virtual mosaic of {len(blocks_files)} blocks created')
+    else:
+        outDataset.FlushCache()
+        outDataset = blockDataset = out_band = in_band = None
 
-    # Mosaic blocks via the in-process gdal.Warp API rather than spawning
-    # an external `gdalwarp` subprocess — same result, no PATH/version
-    # surprises, and we get the error message back as a Python exception.
-    warp_result = gdal.Warp(outfn, blocks_files, format='GTiff')
-    if warp_result is None:
-        _error('Error: gdal.Warp failed to mosaic block files.')
-    warp_result = None
-    _info('mosaic created successfully')
-
-    # delete the temporary block files
-    for chunk_file in blocks_files:
-        try:
-            os.remove(chunk_file)
-        except OSError:
-            pass
+    if cog_fn is not None:
+        raster_ops.write_cog(outfn, cog_fn)
+        os.remove(outfn)
+        outfn = cog_fn
 
     inDataset1 = None
     inDataset2 = None
@@ -182,20 +520,36 @@ def main(img_ref, img_target, warpband=2, chunksize=None, feedback=None):
 
 
 if __name__ == '__main__':
-    options, args = getopt.getopt(sys.argv[1:], 'hb:d:')
+    options, args = getopt.getopt(sys.argv[1:], 'hb:c:d:f:p:vw:')
     warpband = 1
     dims = None
+    chunksize = None
+    virtual = False
+    workers = 1
+    overview = None
+    output_format = 'GTiff'
     for option, value in options:
         if option == '-h':
             print(usage)
             sys.exit()
         elif option == '-b':
             warpband = int(value)
+        elif option == '-c':
+            chunksize = int(value)
         elif option == '-d':
             dims = ast.literal_eval(value)
+        elif option == '-f':
+            output_format = value
+        elif option == '-p':
+            overview = int(value)
+        elif option == '-v':
+            virtual = True
+        elif option == '-w':
+            workers = int(value)
     if len(args) != 2:
         print('Incorrect number of arguments')
         print(usage)
         sys.exit(1)
 
-    main(args[0], args[1], warpband=warpband)
+    main(args[0], args[1], warpband=warpband, chunksize=chunksize, virtual=virtual,
+         workers=workers, overview=overview, output_format=output_format)
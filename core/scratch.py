@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     scratch.py
+#  Purpose:  Per-run scratch directories for the normalization intermediates.
+#
+#  Every run writes its intermediate rasters (reference clip, MAD image,
+#  RadCal output, masks...) into its own directory, created next to the
+#  final output as '.arrnorm-<pid>-<random>'. Concurrent runs on the same
+#  target therefore never share a file name, and finished products are moved
+#  into place with os.replace, which is atomic on the same filesystem.
+#
+#  The directory is removed when the run ends, successfully or not. Runs
+#  killed outright leave theirs behind; those are swept by the next run in
+#  the same directory once their process is gone.
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import os
+import shutil
+import tempfile
+import time
+
+PREFIX = '.arrnorm-'
+
+# Without a reliable liveness check (Windows), only sweep directories this old
+STALE_AGE_S = 24 * 3600
+
+
+def _pid_alive(pid):
+    if os.name != 'posix':
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, owned by another user
+        return True
+    return True
+
+
+def sweep_stale(base_dir):
+    """Remove scratch directories left in base_dir by runs that no longer exist."""
+    try:
+        names = os.listdir(base_dir)
+    except OSError:
+        return []
+    removed = []
+    for name in names:
+        if not name.startswith(PREFIX):
+            continue
+        path = os.path.join(base_dir, name)
+        try:
+            pid = int(name[len(PREFIX):].split('-', 1)[0])
+            age = time.time() - os.path.getmtime(path)
+        except (ValueError, OSError):
+            continue
+        alive = _pid_alive(pid)
+        if pid == os.getpid() or alive or (alive is None and age < STALE_AGE_S):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed.append(path)
+    return removed
+
+
+class ScratchDir(object):
+    """A private directory for the intermediates of one run."""
+
+    def __init__(self, base_dir):
+        self.base_dir = os.path.abspath(base_dir)
+        self.path = tempfile.mkdtemp(prefix='{}{}-'.format(PREFIX, os.getpid()), dir=self.base_dir)
+
+    def file(self, name):
+        """Path of an intermediate named name inside the scratch directory."""
+        return os.path.join(self.path, name)
+
+    def publish(self, src, dst):
+        """Move a finished file from the scratch directory to dst.
+
+        The scratch directory is created next to the output, so this is a
+        same-filesystem rename: readers see the old file or the complete
+        new one, never a partial write.
+        """
+        os.replace(src, dst)
+        return dst
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     service.py
+#  Purpose:  Resident normalization worker with a job queue.
+#
+#  A long-lived process that accepts normalization jobs over HTTP, on a TCP
+#  port or a local Unix socket, so a job does not pay for interpreter,
+#  GDAL and SciPy startup. Between jobs the process keeps:
+#    - a stage cache (the service's own directory unless --cache-dir is
+#      given): aligned references are keyed by the reference and the target
+#      grid, so new targets on a known tile reuse them, and IR-MAD results
+#      are reused for repeated pairs;
+#    - the in-process registration transforms and FFT grids;
+#    - the GDAL block cache size set once with gdal_cache_mb.
+#  At most `workers` jobs run at once; the rest wait in a FIFO queue.
+#
+#    python -m ArrNorm --serve 127.0.0.1:8750 -j 2
+#    python -m ArrNorm --serve unix:/run/arrnorm.sock
+#
+#  Endpoints (JSON bodies, jobs as in a cli manifest):
+#    POST   /jobs            queue a job            -> 202 {"id": ...}
+#    POST   /run             queue and wait         -> 200 job record
+#    GET    /jobs/<id>       job record (?wait=S waits up to S seconds)
+#    DELETE /jobs/<id>       cancel a queued or running job
+#    GET    /health          queue and job counters
+#
+#  ServiceClient is a small client for both kinds of address.
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import http.client
+import json
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from ArrNorm.core import cli
+
+# finished job records kept for GET /jobs/<id>
+DEFAULT_HISTORY = 1000
+# longest ?wait= a GET /jobs/<id> may block a handler thread, in seconds
+MAX_WAIT = 3600
+
+
+class NormalizationService(object):
+    """Job queue and worker threads running Normalization in this process."""
+
+    def __init__(self, options=None, workers=1, history=DEFAULT_HISTORY, gdal_cache_mb=None, quiet=True):
+        self.options = dict(cli.DEFAULTS)
+        self.options.update(options or {})
+        self._own_cache = None
+        if not self.options.get('cache_dir'):
+            self._own_cache = tempfile.mkdtemp(prefix='arrnorm-service-cache-')
+            self.options['cache_dir'] = self._own_cache
+        if gdal_cache_mb:
+            from osgeo import gdal
+            gdal.SetCacheMax(int(gdal_cache_mb) * 1024 * 1024)
+        self.quiet = quiet
+        self.history = history
+        self.started = time.time()
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._feedback = {}
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._worker, name='arrnorm-worker-{}'.format(i), daemon=True)
+                         for i in range(max(1, int(workers)))]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, job):
+        """Queue a job; returns its id. Raises ValueError for an invalid job."""
+        cli.validate_job(job)
+        job_id = uuid.uuid4().hex[:12]
+        with self._cond:
+            self._jobs[job_id] = {'id': job_id, 'status': 'queued', 'job': job, 'submitted': time.time()}
+            self._trim()
+        self._queue.put(job_id)
+        return job_id
+
+    def get(self, job_id, wait=0):
+        """The job record, after waiting up to `wait` seconds (None: no limit) for it to finish."""
+        deadline = None if wait is None else time.time() + wait
+        with self._cond:
+            while True:
+                record = self._jobs.get(job_id)
+                if record is None or record['status'] not in ('queued', 'running'):
+                    return dict(record) if record else None
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return dict(record)
+                self._cond.wait(remaining)
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or ask a running one to stop; False if unknown or finished."""
+        with self._cond:
+            record = self._jobs.get(job_id)
+            if record is None or record['status'] not in ('queued', 'running'):
+                return False
+            if record['status'] == 'queued':
+                record['status'] = 'canceled'
+                self._cond.notify_all()
+            else:
+                self._feedback[job_id].canceled = True
+            return True
+
+    def stats(self):
+        with self._cond:
+            counts = {}
+            for record in self._jobs.values():
+                counts[record['status']] = counts.get(record['status'], 0) + 1
+        return {'uptime_s': round(time.time() - self.started, 3), 'workers': len(self._threads),
+                'queued': self._queue.qsize(), 'jobs': counts, 'cache_dir': self.options['cache_dir'],
+                'pid': os.getpid()}
+
+    def close(self):
+        """Stop the workers after the jobs already queued, and drop an own cache."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        if self._own_cache:
+            shutil.rmtree(self._own_cache, ignore_errors=True)
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                return
+            with self._cond:
+                record = self._jobs.get(job_id)
+                if record is None or record['status'] != 'queued':
+                    continue
+                record['status'] = 'running'
+                record['started'] = time.time()
+                job = record['job']
+                feedback = cli.ConsoleFeedback(prefix='[{}] '.format(job_id), quiet=self.quiet)
+                self._feedback[job_id] = feedback
+            result = cli.run_job(job, self.options, feedback=feedback)
+            with self._cond:
+                del self._feedback[job_id]
+                record.update(result)
+                record['finished'] = time.time()
+                self._cond.notify_all()
+
+    def _trim(self):
+        finished = [k for k, r in self._jobs.items() if r['status'] not in ('queued', 'running')]
+        for k in finished[:max(0, len(self._jobs) - self.history)]:
+            del self._jobs[k]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'ArrNorm'
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def _job_id(self, path):
+        parts = path.strip('/').split('/')
+        return parts[1] if len(parts) == 2 and parts[0] == 'jobs' else None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self._reply(200, self.server.service.stats())
+        job_id = self._job_id(url.path)
+        if job_id is None:
+            return self._reply(404, {'error': 'not found'})
+        try:
+            wait = float(parse_qs(url.query).get('wait', ['0'])[0])
+        except ValueError:
+            return self._reply(400, {'error': 'invalid wait: expected seconds'})
+        # also turns nan into 0
+        wait = min(max(wait, 0.0), MAX_WAIT) if wait == wait else 0.0
+        record = self.server.service.get(job_id, wait=wait)
+        if record is None:
+            return self._reply(404, {'error': 'unknown job {}'.format(job_id)})
+        self._reply(200, record)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path not in ('/jobs', '/run'):
+            return self._reply(404, {'error': 'not found'})
+        try:
+            job_id = self.server.service.submit(self._body())
+        except ValueError as e:
+            return self._reply(400, {'error': 'invalid job: {}'.format(e)})
+        if path == '/jobs':
+            return self._reply(202, {'id': job_id})
+        self._reply(200, self.server.service.get(job_id, wait=None))
+
+    def do_DELETE(self):
+        job_id = self._job_id(urlparse(self.path).path)
+        if job_id is None or not self.server.service.cancel(job_id):
+            return self._reply(404, {'error': 'no queued or running job {}'.format(job_id)})
+        self._reply(200, {'id': job_id, 'canceled': True})
+
+    def address_string(self):
+        # Unix socket peers have no host/port
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.service.quiet:
+            super(_Handler, self).log_message(format, *args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        super(_UnixHTTPServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def _parse_address(address):
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+def make_server(address, service):
+    """HTTP server for the service on 'host:port' or 'unix:/path/to/socket'."""
+    kind, addr = _parse_address(address)
+    if kind == 'unix':
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = _UnixHTTPServer(addr, _Handler)
+    else:
+        server = ThreadingHTTPServer(addr, _Handler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(address, options=None, workers=1, gdal_cache_mb=None, quiet=False):
+    """Run the service until interrupted."""
+    service = NormalizationService(options, workers=workers, gdal_cache_mb=gdal_cache_mb, quiet=quiet)
+    server = make_server(address, service)
+    print('ArrNorm service on {} ({} workers, cache {})'.format(
+        address, workers, service.options['cache_dir']), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class ServiceClient(object):
+    """Minimal client: ServiceClient('127.0.0.1:8750') or ServiceClient('unix:/path')."""
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None):
+        kind, addr = _parse_address(self.address)
+        conn = (_UnixHTTPConnection(addr, self.timeout) if kind == 'unix'
+                else http.client.HTTPConnection(addr[0], addr[1], timeout=self.timeout))
+        try:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            conn.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            result = json.loads(response.read() or b'null')
+        finally:
+            conn.close()
+        if response.status >= 400:
+            raise RuntimeError('{} {}: {}'.format(response.status, path, result.get('error')))
+        return result
+
+    def submit(self, job):
+        return self._request('POST', '/jobs', job)['id']
+
+    def status(self, job_id, wait=0):
+        return self._request('GET', '/jobs/{}?wait={}'.format(job_id, wait))
+
+    def run(self, job):
+        return self._request('POST', '/run', job)
+
+    def cancel(self, job_id):
+        return self._request('DELETE', '/jobs/{}'.format(job_id))
+
+    def health(self):
+        return self._request('GET', '/health')
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# ******************************************************************************
+#  Name:     tiled.py
+#  Purpose:  Spatially adaptive normalization: IR-MAD and RadCal per tile,
+#            applied with smoothly interpolated per-pixel coefficients.
+#
+#  One global gain/offset per band cannot follow illumination gradients
+#  across a large mosaic. Here the co-registered reference and target are
+#  cut into a grid of tiles and every tile gets its own IR-MAD and RadCal
+#  fit, the tiles running side by side in a thread pool (NumPy, LAPACK and
+#  GDAL release the GIL for the heavy work).
+#
+#  A tile with fewer than min_pixels no-change pixels (or whose IR-MAD
+#  fails, e.g. a tile that is all nodata) takes the pixel-weighted mean
+#  coefficients of the nearest ring of usable tiles.
+#
+#  The output is written in one streaming pass: the intercept and slope of
+#  every pixel are bilinearly interpolated between the tile centres (and
+#  held constant beyond the outer centres), so there are no seams at the
+#  tile borders as with splitting the scene by hand. Target nodata pixels
+#  (nodata, or else each band's own nodata value) stay nodata.
+#
+#  License: GPLv2+
+# ******************************************************************************
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from osgeo import gdal
+from osgeo.gdalconst import GA_ReadOnly
+
+from ArrNorm.core import iMad, radcal, raster_ops
+from ArrNorm.core.memory import DEFAULT_BLOCK_ROWS, TILE_COPIES
+
+try:
+    from qgis.core import QgsProcessingException
+except ImportError:
+    QgsProcessingException = Exception
+
+# No-change pixels a tile needs for its own fit; others borrow from neighbors
+MIN_TILE_PIXELS = 500
+
+
+def parse_tiles(value):
+    """(rows, cols) of the tile grid from 4, '4', '3x5' or (3, 5); None stays None."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        parts = value.lower().replace('*', 'x').split('x')
+        try:
+            value = tuple(int(p) for p in parts)
+        except ValueError:
+            raise ValueError('Invalid tile grid: {!r}'.format(value))
+    if isinstance(value, int):
+        value = (value, value)
+    if len(value) == 1:
+        value = (value[0], value[0])
+    if len(value) != 2 or min(value) < 1:
+        raise ValueError('Invalid tile grid: {!r}'.format(value))
+    return int(value[0]), int(value[1])
+
+
+def tile_edges(size, n):
+    """n + 1 edges splitting [0, size) into n near-equal parts."""
+    return [size * i // n for i in range(n + 1)]
+
+
+class TileFit(object):
+    """RadCal fit of one tile; usable is False when it borrowed from neighbors."""
+
+    def __init__(self, row, col, window, intercepts=None, slopes=None, correlations=None, pixels=0,
+                 error=None):
+        self.row = row
+        self.col = col
+        self.window = window  # (x0, y0, cols, rows)
+        self.intercepts = intercepts
+        self.slopes = slopes
+        self.correlations = correlations
+        self.pixels = pixels
+        self.error = error
+        self.usable = False
+        self.elapsed_s = 0.0
+
+    def as_dict(self):
+        return {'row': self.row, 'col': self.col, 'window': list(self.window), 'pixels': self.pixels,
+                'usable': self.usable, 'error': self.error, 'elapsed_s': round(self.elapsed_s, 3),
+                'intercepts': [float(v) for v in self.intercepts] if self.intercepts is not None else None,
+                'slopes': [float(v) for v in self.slopes] if self.slopes is not None else None}
+
+
+def fit_tile(img_ref, img_target, tile, max_iters=30, conv_threshold=0.99, ncp_threshold=0.95, nodata=None,
+             block_rows=DEFAULT_BLOCK_ROWS):
+    """IR-MAD and RadCal on the window of a TileFit, filled in place.
+
+    Only both images of the tile and its chi-square are held whole
+    (TILE_COPIES); IR-MAD and the MAD transform work in row blocks.
+    """
+    start = time.perf_counter()
+    x0, y0, cols, rows = tile.window
+    try:
+        ref = gdal.Open(img_ref, GA_ReadOnly).ReadAsArray(x0, y0, cols, rows).astype(np.float64)
+        tgt = gdal.Open(img_target, GA_ReadOnly).ReadAsArray(x0, y0, cols, rows).astype(np.float64)
+        if ref.ndim == 2:
+            ref, tgt = ref[None], tgt[None]
+        valid = None
+        if nodata is not None:
+            valid = ~iMad._is_nodata(tgt[0], nodata)
+        model = iMad.irmad(ref, tgt, mask=valid, max_iters=max_iters, conv_threshold=conv_threshold,
+                           block_rows=block_rows)
+        chisqr = np.empty((rows, cols))
+        for ry, nr in raster_ops._iter_row_blocks(rows, block_rows):
+            chisqr[ry:ry + nr] = model.transform(ref[:, ry:ry + nr], tgt[:, ry:ry + nr])[1]
+        if valid is not None:
+            # a no-change probability of 0 leaves nodata out of the fit without copying the tile
+            chisqr[~valid] = np.inf
+        tile.pixels = len(radcal._nochange_index(chisqr.ravel(), model.bands, ncp_threshold)[0])
+        tile.intercepts, tile.slopes, tile.correlations = radcal.radcal_fit(
+            ref, tgt, chisqr, ncp_threshold=ncp_threshold, dof=model.bands)
+    except Exception as e:
+        tile.error = str(e).strip()
+    tile.elapsed_s = time.perf_counter() - start
+    return tile
+
+
+def fill_from_neighbors(grid, min_pixels=MIN_TILE_PIXELS):
+    """Mark usable tiles and give the others the coefficients of the nearest usable ring.
+
+    grid is a list of rows of TileFit. Raises ValueError if no tile is usable.
+    """
+    tiles = [t for row in grid for t in row]
+    for t in tiles:
+        t.usable = t.error is None and t.pixels >= min_pixels
+    usable = [t for t in tiles if t.usable]
+    if not usable:
+        raise ValueError('no tile has {} no-change pixels; use fewer tiles or lower the minimum'.format(
+            min_pixels))
+    for t in tiles:
+        if t.usable:
+            continue
+        ring = min(max(abs(u.row - t.row), abs(u.col - t.col)) for u in usable)
+        near = [u for u in usable if max(abs(u.row - t.row), abs(u.col - t.col)) == ring]
+        weights = np.array([u.pixels for u in near], dtype=np.float64)
+        t.intercepts = np.average([u.intercepts for u in near], axis=0, weights=weights)
+        t.slopes = np.average([u.slopes for u in near], axis=0, weights=weights)
+    return grid
+
+
+def _axis_weights(positions, centers):
+    """(lower index, upper index, upper weight) of linear interpolation between centers."""
+    frac = np.interp(positions, centers, np.arange(len(centers), dtype=np.float64))
+    lo = np.floor(frac).astype(np.intp)
+    hi = np.minimum(lo + 1, len(centers) - 1)
+    return lo, hi, frac - lo
+
+
+class CoefficientField(object):
+    """Per-pixel intercepts and slopes bilinearly interpolated between tile centres."""
+
+    def __init__(self, grid, x_edges, y_edges, cols):
+        self.intercepts = np.array([[t.intercepts for t in row] for row in grid]).transpose(2, 0, 1)
+        self.slopes = np.array([[t.slopes for t in row] for row in grid]).transpose(2, 0, 1)
+        self.y_centers = (np.array(y_edges[:-1]) + np.array(y_edges[1:])) / 2.0
+        x_centers = (np.array(x_edges[:-1]) + np.array(x_edges[1:])) / 2.0
+        # interpolate along x once: (bands, tile rows, cols)
+        lo, hi, w = _axis_weights(np.arange(cols) + 0.5, x_centers)
+        self._a = self.intercepts[:, :, lo] * (1 - w) + self.intercepts[:, :, hi] * w
+        self._b = self.slopes[:, :, lo] * (1 - w) + self.slopes[:, :, hi] * w
+
+    def block(self, y0, n):
+        """(intercepts, slopes) as (bands, n, cols) arrays for rows y0 .. y0 + n."""
+        lo, hi, w = _axis_weights(np.arange(y0, y0 + n) + 0.5, self.y_centers)
+        w = w[None, :, None]
+        return (self._a[:, lo] * (1 - w) + self._a[:, hi] * w,
+                self._b[:, lo] * (1 - w) + self._b[:, hi] * w)
+
+
+def main(img_ref, img_target, output, tiles, max_iters=30, conv_threshold=0.99, ncp_threshold=0.95,
+         out_dtype=None, nodata=None, min_pixels=MIN_TILE_PIXELS, workers=None,
+         block_rows=DEFAULT_BLOCK_ROWS, feedback=None):
+    """Tiled IR-MAD + RadCal of a co-registered pair, written to output.
+
+    tiles is the (rows, cols) grid (see parse_tiles), clamped to the raster
+    size. Pixels whose first target band is nodata are left out of the tile
+    fits; target pixels equal to nodata (or else to the band's own nodata
+    value) keep that value in the output. Returns (output, grid) with grid
+    the rows of TileFit, or None if canceled.
+    """
+
+    def _info(msg):
+        if feedback is not None:
+            feedback.pushInfo(msg)
+        else:
+            print(msg)
+
+    def _error(msg):
+        if feedback is not None:
+            feedback.reportError(msg, fatalError=True)
+        raise QgsProcessingException(msg)
+
+    def _canceled():
+        return feedback is not None and feedback.isCanceled()
+
+    tile_rows, tile_cols = parse_tiles(tiles)
+    refDataset = gdal.Open(img_ref, GA_ReadOnly)
+    targetDataset = gdal.Open(img_target, GA_ReadOnly)
+    if refDataset is None or targetDataset is None:
+        _error('Error: could not open reference/target image.')
+    cols, rows, bands = targetDataset.RasterXSize, targetDataset.RasterYSize, targetDataset.RasterCount
+    if (refDataset.RasterXSize, refDataset.RasterYSize) != (cols, rows):
+        _error('Error: the reference and target do not share the same pixel grid.')
+    if out_dtype is None:
+        out_dtype = targetDataset.GetRasterBand(1).DataType
+    tile_rows, tile_cols = min(tile_rows, rows), min(tile_cols, cols)
+    x_edges, y_edges = tile_edges(cols, tile_cols), tile_edges(rows, tile_rows)
+    grid = [[TileFit(i, j, (x_edges[j], y_edges[i], x_edges[j + 1] - x_edges[j], y_edges[i + 1] - y_edges[i]))
+             for j in range(tile_cols)] for i in range(tile_rows)]
+    tiles = [t for row in grid for t in row]
+    workers = max(1, min(workers or 1, len(tiles)))
+
+    _info(f'Tiled normalization: {tile_rows} x {tile_cols} tiles, {workers} worker(s)')
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fit_tile, img_ref, img_target, t, max_iters, conv_threshold, ncp_threshold,
+                               nodata, block_rows) for t in tiles]
+        for done, future in enumerate(futures, start=1):
+            if _canceled():
+                for f in futures:
+                    f.cancel()
+                return None
+            future.result()
+            if feedback is not None:
+                feedback.setProgress(int(90 * done / len(futures)))
+
+    try:
+        fill_from_neighbors(grid, min_pixels)
+    except ValueError as e:
+        _error(f'Error: {e}')
+    for t in tiles:
+        note = '' if t.usable else '  (from neighbors: {})'.format(
+            t.error or 'only {} no-change pixels'.format(t.pixels))
+        _info(' tile {},{}  no-change pixels {:>8}  slopes {}  {:.1f}s{}'.format(
+            t.row, t.col, t.pixels, ' '.join('{:.4f}'.format(b) for b in t.slopes), t.elapsed_s, note))
+    _info(f'tiles fitted in {time.time() - start:.2f}s')
+
+    field = CoefficientField(grid, x_edges, y_edges, cols)
+    outDataset = raster_ops.output_driver(targetDataset).Create(output, cols, rows, bands, out_dtype)
+    raster_ops._copy_spatial_metadata(targetDataset, outDataset)
+    outBands = [outDataset.GetRasterBand(k + 1) for k in range(bands)]
+    tgtBands = [targetDataset.GetRasterBand(k + 1) for k in range(bands)]
+    tgtNodata = [nodata if nodata is not None else tgtBand.GetNoDataValue() for tgtBand in tgtBands]
+    isFloat = [raster_ops._is_float_dtype(tgtBand.DataType) for tgtBand in tgtBands]
+    for outBand, value in zip(outBands, tgtNodata):
+        if value is not None:
+            outBand.SetNoDataValue(value)
+    for y0, n in raster_ops._iter_row_blocks(rows, block_rows):
+        if _canceled():
+            return None
+        a, b = field.block(y0, n)
+        for k in range(bands):
+            y = tgtBands[k].ReadAsArray(0, y0, cols, n).astype(np.float64)
+            normalized = radcal._clip_for_dtype(a[k] + b[k] * y, out_dtype)
+            if tgtNodata[k] is not None:
+                normalized[~raster_ops._safe_neq(y, tgtNodata[k], isFloat[k])] = tgtNodata[k]
+            outBands[k].WriteArray(normalized, 0, y0)
+    for outBand in outBands:
+        outBand.FlushCache()
+    outDataset = targetDataset = refDataset = None
+    _info(f'result written to: {output}')
+    return output, grid
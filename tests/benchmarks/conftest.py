@@ -0,0 +1,20 @@
+"""
+Shared fixtures for the micro-benchmark suite (pytest-benchmark).
+
+The benchmarks import the core modules directly, so they run headless
+without QGIS through the ``QgsProcessingException = Exception`` fallback.
+They are excluded from ``make test``; use ``make bench`` to run them,
+``make bench-save`` to record a baseline and ``make bench-compare`` to
+compare the current tree against the saved baseline.
+"""
+import pytest
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+    collect_ignore_glob = ["test_*.py"]
+
+
+@pytest.fixture(scope="session")
+def bench_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp("bench")
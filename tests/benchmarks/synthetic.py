@@ -0,0 +1,38 @@
+"""Synthetic inputs for the micro-benchmarks."""
+import numpy as np
+
+
+def synthetic_pair(rows, cols, bands, seed=0, change_fraction=0.1):
+    """Return (ref, target) float64 (rows*cols, bands) pixel matrices.
+
+    The target is a noisy linear transform of the reference with a
+    fraction of pixels replaced by unrelated values ("change").
+    """
+    rng = np.random.default_rng(seed)
+    ref = rng.uniform(100.0, 3000.0, (rows * cols, bands))
+    tgt = 0.8 * ref + 50.0 + rng.normal(0.0, 15.0, ref.shape)
+    changed = rng.random(rows * cols) < change_fraction
+    tgt[changed] = rng.uniform(100.0, 3000.0, (changed.sum(), bands))
+    return ref, tgt
+
+
+def write_raster(path, data, dtype=None, nodata=None):
+    """Write a (bands, rows, cols) array as a GeoTIFF."""
+    from osgeo import gdal
+    from osgeo import gdal_array
+
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[None]
+    bands, rows, cols = data.shape
+    if dtype is None:
+        dtype = gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype)
+    ds = gdal.GetDriverByName("GTiff").Create(str(path), cols, rows, bands, dtype)
+    ds.SetGeoTransform((0, 1, 0, 0, 0, -1))
+    for b in range(bands):
+        band = ds.GetRasterBand(b + 1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(data[b])
+    ds = None
+    return str(path)
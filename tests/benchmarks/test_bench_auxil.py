@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from ArrNorm.core.auxil import auxil
+
+from .synthetic import synthetic_pair
+
+
+@pytest.mark.parametrize("pixels", [65536, 262144])
+@pytest.mark.parametrize("bands", [4, 8])
+def test_cpm_update(benchmark, pixels, bands):
+    ref, tgt = synthetic_pair(pixels, 1, bands)
+    tile = np.concatenate((ref, tgt), axis=1)
+    weights = np.random.default_rng(1).random(pixels)
+    cpm = auxil.Cpm(2 * bands)
+
+    def run():
+        cpm.reset()
+        cpm.update(tile, weights)
+        return cpm.covariance()
+
+    benchmark(run)
+
+
+@pytest.mark.parametrize("bands", [4, 12, 200])
+def test_geneiv(benchmark, bands):
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(4 * bands, bands))
+    a = x.T @ x
+    b = a + bands * np.eye(bands)
+    benchmark(auxil.geneiv, a, b)
+
+
+@pytest.mark.parametrize("pixels", [10000, 1000000])
+def test_orthoregress(benchmark, pixels):
+    ref, tgt = synthetic_pair(pixels, 1, 1)
+    benchmark(auxil.orthoregress, tgt[:, 0], ref[:, 0])
+
+
+@pytest.mark.parametrize("size", [128, 256, 512])
+def test_similarity(benchmark, size):
+    rng = np.random.default_rng(0)
+    img = rng.random((size + 16, size + 16)).astype(np.float32)
+    ref = img[8:8 + size, 8:8 + size]
+    warp = img[5:5 + size, 11:11 + size]
+    benchmark(auxil.similarity, ref, warp)
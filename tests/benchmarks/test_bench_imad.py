@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from osgeo import gdal
+
+from ArrNorm.core import iMad
+
+from .synthetic import synthetic_pair, write_raster
+
+
+@pytest.mark.parametrize("cols", [1024, 4096])
+@pytest.mark.parametrize("bands", [4, 8])
+def test_read_block(benchmark, bench_dir, cols, bands):
+    rows = iMad.DEFAULT_BLOCK_ROWS
+    data = np.random.default_rng(0).integers(0, 10000, (bands, rows, cols), dtype=np.uint16)
+    path = write_raster(bench_dir / f"read_{cols}_{bands}.tif", data)
+    ds = gdal.Open(path)
+    raster_bands = [ds.GetRasterBand(b + 1) for b in range(bands)]
+    benchmark(iMad._read_block, raster_bands, 0, 0, cols, rows)
+
+
+@pytest.mark.parametrize("pixels", [65536, 262144])
+@pytest.mark.parametrize("bands", [4, 8])
+def test_chisqr_weights(benchmark, pixels, bands):
+    ref, tgt = synthetic_pair(pixels, 1, bands)
+    rng = np.random.default_rng(1)
+    A = rng.normal(size=(bands, bands)) * 1e-3
+    B = rng.normal(size=(bands, bands)) * 1e-3
+    means1 = ref.mean(axis=0)[None]
+    means2 = tgt.mean(axis=0)[None]
+    sigMADs = np.full((1, bands), 0.5)
+    benchmark(iMad._chisqr_weights, ref, tgt, means1, means2, A, B, sigMADs)
@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import ArrNorm
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(ArrNorm.__file__)))
+
+
+@pytest.mark.parametrize("module", ["ArrNorm.core.arrnorm", "ArrNorm.core.cli", "ArrNorm.ArrNorm_provider"])
+def test_import_time(benchmark, module):
+    """Cold import of a module in a fresh interpreter (plugin load / worker spin-up cost)."""
+    if module == "ArrNorm.ArrNorm_provider":
+        pytest.importorskip("qgis.core")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PACKAGE_PARENT, os.environ.get("PYTHONPATH")])))
+    cmd = [sys.executable, "-c", "import " + module]
+    benchmark.pedantic(subprocess.run, args=(cmd,), kwargs={"env": env, "check": True}, rounds=5, iterations=1)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from ArrNorm.core import raster_ops
+
+from .synthetic import write_raster
+
+SIZES = [1024, 2048]
+
+
+def _image(bench_dir, size, bands=4):
+    path = bench_dir / f"img_{size}_{bands}.tif"
+    if not path.exists():
+        rng = np.random.default_rng(0)
+        data = rng.integers(-500, 10000, (bands, size, size)).astype(np.int16)
+        data[:, :, :32] = 0
+        write_raster(path, data, nodata=0)
+    return str(path)
+
+
+def _mask(bench_dir, size):
+    path = bench_dir / f"mask_{size}.tif"
+    if not path.exists():
+        raster_ops.make_mask(_image(bench_dir, size), str(path), nodata_value=0)
+    return str(path)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_no_negative_value(benchmark, bench_dir, size):
+    src = _image(bench_dir, size)
+    benchmark(raster_ops.no_negative_value, src, str(bench_dir / f"noneg_{size}.tif"),
+              nodata_value=0)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_make_mask(benchmark, bench_dir, size):
+    src = _image(bench_dir, size)
+    benchmark(raster_ops.make_mask, src, str(bench_dir / f"mk_{size}.tif"), nodata_value=0)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_apply_mask(benchmark, bench_dir, size):
+    src = _image(bench_dir, size)
+    mask = _mask(bench_dir, size)
+    benchmark(raster_ops.apply_mask, src, mask, str(bench_dir / f"masked_{size}.tif"),
+              nodata_value=0)
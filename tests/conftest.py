@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from osgeo import gdal
+
+
+def _write_raster(path, bands, nodata=None, dtype=gdal.GDT_Float32, geotransform=(0, 1, 0, 0, 0, -1)):
+    """Write a (bands, rows, cols) array as a GeoTIFF and return its path."""
+    bands = np.asarray(bands)
+    ds = gdal.GetDriverByName("GTiff").Create(str(path), bands.shape[2], bands.shape[1], bands.shape[0], dtype)
+    ds.SetGeoTransform(geotransform)
+    for b, data in enumerate(bands, start=1):
+        band = ds.GetRasterBand(b)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(data)
+    ds = None
+    return str(path)
+
+
+def _scene(rows=120, cols=90, bands=3, seed=0, gain=0.8, offset=120, ripple=0, changed=0.1):
+    """Reference and target arrays with target = gain * reference + offset + noise.
+
+    gain may vary per column (an array of cols values); ripple adds a
+    sine texture across the columns of the reference. A `changed` fraction
+    of the pixels gets unrelated target values. Returns (ref, tgt, changed mask).
+    """
+    rng = np.random.default_rng(seed)
+    ref = rng.uniform(200, 3000, (bands, rows, cols))
+    if ripple:
+        ref += ripple * np.sin(np.arange(cols) / 11.0)
+    tgt = gain * ref + offset + rng.normal(0, 5, ref.shape)
+    mask = rng.random((rows, cols)) < changed
+    tgt[:, mask] = rng.uniform(200, 3000, (bands, mask.sum()))
+    return ref, tgt, mask
+
+
+@pytest.fixture
+def write_raster():
+    """write_raster(path, (bands, rows, cols) array, nodata=None, dtype=GDT_Float32, geotransform=...)."""
+    return _write_raster
+
+
+@pytest.fixture
+def scene():
+    """scene(rows, cols, bands, seed, gain, offset, ripple, changed) -> (ref, tgt, changed)."""
+    return _scene
@@ -0,0 +1,104 @@
+"""
+End-to-end scaling harness for the normalization pipeline.
+
+Each run generates a synthetic scene pair and executes Normalization in a
+fresh subprocess with perf_report=True, so the per-stage peak RSS in the
+report belongs to that run alone. Results are returned as dicts and can
+be printed as a table:
+
+    python -m tests.scaling.harness --sizes 1000 4000 10000 --bands 4 --workdir /scratch
+
+(run from the directory above the plugin so ``ArrNorm`` is importable).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from .scenes import make_scene_pair
+
+_PLUGIN_PARENT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+_CHILD = '''
+import json, sys
+from ArrNorm.core.arrnorm import Normalization
+
+class Feedback:
+    def pushInfo(self, msg): pass
+    def reportError(self, msg, fatalError=False): print(msg, file=sys.stderr)
+    def setProgress(self, value): pass
+    def isCanceled(self): return False
+
+kw = json.loads(sys.argv[1])
+norm = Normalization(feedback=Feedback(), perf_report=True, **kw)
+norm.run()
+print(norm.perf_file)
+'''
+
+
+def run_pipeline(ref, target, output, **options):
+    """Run Normalization in a subprocess and return its perf report dict."""
+    kw = dict(img_ref=ref, img_target=target, max_iters=10, conv_threshold=0.99,
+              ncp_threshold=0.95, neg_to_nodata=False, mask_ref=False, mask_ref_nodata=None,
+              nodata_mask=True, nodata_mask_value=None, keep_mask_layer=False,
+              output_file=output)
+    kw.update(options)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [_PLUGIN_PARENT, env.get('PYTHONPATH')]))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', _CHILD, json.dumps(kw)], env=env,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError('normalization failed:\n' + proc.stderr)
+    with open(proc.stdout.strip().splitlines()[-1]) as f:
+        report = json.load(f)
+    report['process_wall_s'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def sweep(sizes, workdir, bands=4, dtype='uint16', nodata_border=16, offset=(0, 0),
+          change_fraction=0.1, **options):
+    """Generate and normalize one scene per size; yield (size, report)."""
+    for size in sizes:
+        scene_dir = os.path.join(workdir, 'scene_{}x{}x{}'.format(size, size, bands))
+        ref, target = make_scene_pair(scene_dir, size, size, bands=bands, dtype=dtype,
+                                      nodata_border=nodata_border, offset=offset,
+                                      change_fraction=change_fraction)
+        report = run_pipeline(ref, target, os.path.join(scene_dir, 'output.tif'), **options)
+        yield size, report
+
+
+def stage_peaks_mb(report):
+    """{stage: peak RSS in MiB} from a perf report."""
+    return {s['stage']: (s['peak_rss_bytes'] or 0) / 2 ** 20 for s in report['stages']}
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000])
+    parser.add_argument('--bands', type=int, default=4)
+    parser.add_argument('--dtype', default='uint16')
+    parser.add_argument('--offset', type=int, nargs=2, default=(0, 0))
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--json', help='write all reports to this file')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='arrnorm-scaling-')
+    results = {}
+    for size, report in sweep(args.sizes, workdir, bands=args.bands, dtype=args.dtype,
+                              offset=tuple(args.offset)):
+        results[size] = report
+        peaks = stage_peaks_mb(report)
+        print('{0}x{0}x{1}: {2:.1f}s'.format(size, args.bands, report['total_wall_s']))
+        for s in report['stages']:
+            print('   {:<18} {:8.2f}s  peak {:8.1f} MiB'.format(s['stage'], s['wall_s'], peaks[s['stage']]))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,94 @@
+"""
+Synthetic reference/target scene generator for the scaling harness.
+
+Scenes are written block by block, so a 10k x 10k x 100-band pair can be
+generated without holding a full band in memory. Both images sample the
+same procedural "ground" field in map coordinates, which means a target
+with an offset still lines up with the reference after clipper().
+"""
+import os
+
+import numpy as np
+from osgeo import gdal
+from osgeo import gdal_array
+
+PIXEL_SIZE = 30.0
+ORIGIN = (500000.0, 1000000.0)
+EPSG = 'EPSG:32618'
+
+
+def _ground(rows_idx, cols_idx, band):
+    """Smooth multi-band surface evaluated at absolute pixel positions."""
+    yy = rows_idx[:, None].astype(np.float64)
+    xx = cols_idx[None, :].astype(np.float64)
+    phase = 0.7 * band
+    return (1500.0 + 400.0 * np.sin(xx / (37.0 + band) + phase)
+            + 300.0 * np.cos(yy / (53.0 + 2 * band) - phase)
+            + 150.0 * np.sin((xx + yy) / 211.0))
+
+
+def _write(path, rows, cols, bands, dtype, origin, fill_block, nodata, block_rows):
+    gdal_dtype = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))
+    ds = gdal.GetDriverByName('GTiff').Create(
+        path, cols, rows, bands, gdal_dtype, ['BIGTIFF=IF_SAFER', 'TILED=YES'])
+    ds.SetGeoTransform((origin[0], PIXEL_SIZE, 0.0, origin[1], 0.0, -PIXEL_SIZE))
+    ds.SetProjection(EPSG)
+    info = np.iinfo(dtype) if np.issubdtype(np.dtype(dtype), np.integer) else None
+    for b in range(bands):
+        out_band = ds.GetRasterBand(b + 1)
+        if nodata is not None:
+            out_band.SetNoDataValue(nodata)
+        for y in range(0, rows, block_rows):
+            n = min(block_rows, rows - y)
+            block = fill_block(b, y, n)
+            if info is not None:
+                block = np.clip(np.round(block), info.min, info.max)
+            out_band.WriteArray(block.astype(dtype), 0, y)
+        out_band.FlushCache()
+    ds = None
+    return path
+
+
+def make_scene_pair(directory, rows, cols, bands=4, dtype='uint16', nodata_border=0,
+                    offset=(0, 0), change_fraction=0.1, gain=0.8, bias=120.0,
+                    noise=15.0, nodata=0, seed=0, block_rows=512):
+    """Write ref.tif / target.tif into *directory* and return their paths.
+
+    rows, cols, bands, dtype -- size and numpy dtype of both images
+    nodata_border            -- width in pixels of a nodata frame around the target
+    offset                   -- (rows, cols) shift of the reference grid origin; a
+                                non-zero offset forces clipper() to warp
+    change_fraction          -- fraction of target pixels replaced by unrelated values
+    gain, bias, noise        -- radiometric difference target = gain * ref + bias + N(0, noise)
+    """
+    os.makedirs(directory, exist_ok=True)
+    dy, dx = offset
+    ref_origin = (ORIGIN[0] + dx * PIXEL_SIZE, ORIGIN[1] - dy * PIXEL_SIZE)
+
+    def ref_block(b, y, n):
+        rows_idx = np.arange(y + dy, y + dy + n)
+        cols_idx = np.arange(dx, dx + cols)
+        return _ground(rows_idx, cols_idx, b)
+
+    def tgt_block(b, y, n):
+        # the random stream depends only on (seed, block) so every band of a
+        # pixel agrees on whether it changed
+        rng_change = np.random.default_rng([seed, y])
+        changed = rng_change.random((n, cols)) < change_fraction
+        rng = np.random.default_rng([seed, y, b])
+        block = gain * _ground(np.arange(y, y + n), np.arange(cols), b) + bias
+        block += rng.normal(0.0, noise, block.shape)
+        block[changed] = rng.uniform(200.0, 3000.0, int(changed.sum()))
+        if nodata_border:
+            rows_idx = np.arange(y, y + n)[:, None]
+            cols_idx = np.arange(cols)[None, :]
+            border = ((rows_idx < nodata_border) | (rows_idx >= rows - nodata_border)
+                      | (cols_idx < nodata_border) | (cols_idx >= cols - nodata_border))
+            block[np.broadcast_to(border, block.shape)] = nodata
+        return block
+
+    ref = _write(os.path.join(directory, 'ref.tif'), rows, cols, bands, dtype,
+                 ref_origin, ref_block, None, block_rows)
+    target = _write(os.path.join(directory, 'target.tif'), rows, cols, bands, dtype,
+                    ORIGIN, tgt_block, nodata if nodata_border else None, block_rows)
+    return ref, target
@@ -0,0 +1,41 @@
+"""
+Scaling checks for the full pipeline (slow; opt-in).
+
+Enable with ARRNORM_SCALING=1. The sweep and the memory ceiling are set
+through the environment:
+
+  ARRNORM_SCALING_SIZES    square sizes in pixels      (default "1000 2000")
+  ARRNORM_SCALING_BANDS    band counts                 (default "4")
+  ARRNORM_SCALING_MAX_RSS  peak RSS ceiling in MiB     (default 1024)
+
+The ceiling applies to every stage, so a stage that reads a full band
+into memory shows up as soon as the sweep reaches a large enough size.
+"""
+import os
+
+import pytest
+
+from .harness import stage_peaks_mb, sweep
+
+pytestmark = pytest.mark.skipif(os.environ.get('ARRNORM_SCALING') != '1',
+                                reason='set ARRNORM_SCALING=1 to run the scaling sweep')
+
+SIZES = [int(s) for s in os.environ.get('ARRNORM_SCALING_SIZES', '1000 2000').split()]
+BANDS = [int(b) for b in os.environ.get('ARRNORM_SCALING_BANDS', '4').split()]
+MAX_RSS_MB = float(os.environ.get('ARRNORM_SCALING_MAX_RSS', '1024'))
+
+
+@pytest.mark.parametrize('bands', BANDS)
+def test_peak_memory_bounded(tmp_path, bands):
+    for size, report in sweep(SIZES, str(tmp_path), bands=bands):
+        peaks = stage_peaks_mb(report)
+        over = {stage: round(mb) for stage, mb in peaks.items() if mb > MAX_RSS_MB}
+        assert not over, (f'{size}x{size}x{bands}: stages over the {MAX_RSS_MB:.0f} MiB '
+                          f'ceiling: {over}')
+
+
+def test_offset_scene_runs(tmp_path):
+    """A shifted reference grid goes through the clipper warp."""
+    (size, report), = sweep(SIZES[:1], str(tmp_path), offset=(7, -5))
+    assert [s['stage'] for s in report['stages']][:2] == ['clipper', 'imad']
+    assert report['stages'][0]['bytes_written'] > 0
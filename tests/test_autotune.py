@@ -0,0 +1,42 @@
+import numpy as np
+
+from ArrNorm.core import autotune
+from ArrNorm.core.memory import MemoryBudget
+
+
+def test_profiles_are_kept_per_host(tmp_path):
+    path = str(tmp_path / "conf" / "tuning.json")
+    assert autotune.load_profile(path) == {}
+    autotune.save_profile({"block_rows": 512}, path, host="node-a")
+    autotune.save_profile({"block_rows": 128}, path, host="node-b")
+    assert autotune.load_profile(path, host="node-a") == {"block_rows": 512}
+    assert autotune.load_profile(path, host="node-b") == {"block_rows": 128}
+    assert autotune.load_profile(path, host="node-c") == {}
+
+
+def test_default_path_from_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv(autotune.PROFILE_ENV, str(tmp_path / "p.json"))
+    assert autotune.default_profile_path() == str(tmp_path / "p.json")
+    monkeypatch.delenv(autotune.PROFILE_ENV)
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path))
+    assert autotune.default_profile_path() == str(tmp_path / "ArrNorm" / "tuning.json")
+
+
+def test_autotune_picks_from_the_grid(tmp_path, write_raster):
+    rng = np.random.default_rng(0)
+    ref = rng.uniform(100, 2000, (3, 200, 80))
+    tgt = 0.9 * ref + rng.normal(0, 5, ref.shape)
+    profile = autotune.autotune(write_raster(tmp_path / "ref.tif", ref), write_raster(tmp_path / "tgt.tif", tgt),
+                                block_rows=(32, 64), workers=(1, 2), gdal_cache_mb=(64,), sample_rows=128,
+                                repeat=1, feedback=None)
+    assert profile["block_rows"] in (32, 64)
+    assert profile["stage_workers"] in (1, 2)
+    assert profile["gdal_cache_mb"] == 64
+    assert profile["sample"]["rows"] == 128
+    assert set(profile["timings"]["block_rows"]) == {32, 64}
+
+
+def test_profile_block_rows_cap_the_budget():
+    assert MemoryBudget(None, 8000, 8000, 6, preferred_rows=512).block_rows() == 512
+    assert MemoryBudget("64G", 8000, 8000, 6, preferred_rows=512).block_rows() == 512
+    assert MemoryBudget("256M", 8000, 8000, 6, preferred_rows=512).block_rows() < 512
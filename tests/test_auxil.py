@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import scipy.ndimage as ndii
+
+from ArrNorm.core.auxil import auxil
+
+
+@pytest.mark.parametrize("shape", [(64, 64), (63, 80), (97, 131)])
+def test_magnitude_spectrum_matches_full_fft(shape):
+    img = np.random.default_rng(0).random(shape)
+    np.testing.assert_allclose(auxil._magnitude_spectrum(img),
+                               np.abs(np.fft.fft2(img)), rtol=1e-10, atol=1e-9)
+
+
+def test_grids_are_cached_and_read_only():
+    h = auxil._highpass((40, 50))
+    assert auxil._highpass((40, 50)) is h
+    assert not h.flags.writeable
+    coords, _ = auxil._logpolar_grid((40, 50), 40, 50)
+    assert not coords.flags.writeable
+
+
+def test_full_scene_grids_are_not_cached(monkeypatch):
+    monkeypatch.setattr(auxil, "GRID_CACHE_MAX_PIXELS", 40 * 50 - 1)
+    auxil._highpass.cache_clear()
+    assert auxil._highpass((40, 50)) is not auxil._highpass((40, 50))
+    assert auxil._highpass.cache_info().currsize == 0
+
+
+@pytest.mark.parametrize("shape", [(120, 94), (97, 131)])
+def test_similarity_recovers_translation(shape):
+    rows, cols = shape
+    big = ndii.gaussian_filter(np.random.default_rng(1).random((rows + 20, cols + 20)) * 1000, 0.6)
+    ref = big[10:10 + rows, 10:10 + cols].astype(np.float32)
+    warp = big[7:7 + rows, 14:14 + cols].astype(np.float32)
+    scale, angle, shift = auxil.similarity(ref, warp)
+    assert scale == pytest.approx(1.0)
+    assert angle == pytest.approx(0.0)
+    assert [int(s) for s in shift] == [-3, 4]
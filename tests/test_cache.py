@@ -0,0 +1,82 @@
+import os
+import time
+
+from ArrNorm.core.cache import StageCache
+
+
+def _write(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    return str(path)
+
+
+class TestFingerprint:
+    def test_same_inputs_same_key(self, tmp_path):
+        src = _write(tmp_path / "a.tif", b"abc")
+        cache = StageCache(tmp_path / "cache")
+        assert (cache.fingerprint([src], {"x": 1, "y": 2}) ==
+                cache.fingerprint([src], {"y": 2, "x": 1}))
+
+    def test_params_change_key(self, tmp_path):
+        src = _write(tmp_path / "a.tif", b"abc")
+        cache = StageCache(tmp_path / "cache")
+        assert cache.fingerprint([src], {"x": 1}) != cache.fingerprint([src], {"x": 2})
+
+    def test_modified_file_changes_key(self, tmp_path):
+        src = _write(tmp_path / "a.tif", b"abc")
+        cache = StageCache(tmp_path / "cache")
+        key = cache.fingerprint([src])
+        _write(src, b"abcd")
+        assert cache.fingerprint([src]) != key
+
+    def test_content_hash_ignores_path(self, tmp_path):
+        a = _write(tmp_path / "a.tif", b"same")
+        b = _write(tmp_path / "b.tif", b"same")
+        cache = StageCache(tmp_path / "cache", content_hash=True)
+        assert cache.fingerprint([a]) == cache.fingerprint([b])
+
+
+class TestEntries:
+    def test_put_then_get(self, tmp_path):
+        cache = StageCache(tmp_path / "cache")
+        src = _write(tmp_path / "clip.tif", b"data")
+        stored = cache.put("k1", {"ref_clip": src})
+        assert not os.path.exists(src)
+        assert cache.get("k1") == stored
+        assert cache.owns(stored["ref_clip"])
+
+    def test_first_put_wins(self, tmp_path):
+        cache = StageCache(tmp_path / "cache")
+        first = cache.put("k1", {"f": _write(tmp_path / "a.bin", b"first")})
+        second_src = _write(tmp_path / "b.bin", b"second")
+        assert cache.put("k1", {"f": second_src}) == first
+        assert not os.path.exists(second_src)
+        with open(first["f"], "rb") as f:
+            assert f.read() == b"first"
+
+    def test_replace(self, tmp_path):
+        cache = StageCache(tmp_path / "cache")
+        cache.put("k1", {"f": _write(tmp_path / "a.bin", b"first")})
+        second = cache.put("k1", {"f": _write(tmp_path / "b.bin", b"second")}, replace=True)
+        assert cache.get("k1") == second
+        with open(second["f"], "rb") as f:
+            assert f.read() == b"second"
+
+    def test_miss(self, tmp_path):
+        cache = StageCache(tmp_path / "cache")
+        assert cache.get("missing") is None
+
+    def test_lru_eviction(self, tmp_path):
+        cache = StageCache(tmp_path / "cache", max_bytes=None)
+        for i, key in enumerate(("old", "used", "new")):
+            cache.put(key, {"f": _write(tmp_path / f"{key}.bin", b"x" * 1000)})
+            # entry.json mtime is the LRU clock; keep the entries apart
+            stamp = time.time() - 100 + i
+            os.utime(os.path.join(cache.cache_dir, key, "entry.json"), (stamp, stamp))
+        cache.max_bytes = 2500
+        # touching "old" makes "used" the least recently used entry
+        assert cache.get("old") is not None
+        cache.put("newest", {"f": _write(tmp_path / "newest.bin", b"x" * 1000)})
+        assert cache.get("used") is None
+        assert cache.get("old") is not None
+        assert cache.get("newest") is not None
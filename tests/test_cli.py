@@ -0,0 +1,59 @@
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from osgeo import gdal
+
+from ArrNorm.core import cli
+
+DATA_DIR = Path(__file__).parent / "data"
+EXPECTED_DIR = DATA_DIR / "expected"
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    for name in ("ref_adjusted2target.tif", "target.tif"):
+        shutil.copy(str(DATA_DIR / name), str(tmp_path / name))
+    return tmp_path
+
+
+def test_manifest_validation(tmp_path):
+    manifest = tmp_path / "jobs.jsonl"
+    manifest.write_text('{"ref": "a.tif", "target": "b.tif"}\n{"ref": "a.tif", "target": "c.tif", "ncp": 1}\n')
+    with pytest.raises(ValueError, match="unknown options: ncp"):
+        cli.load_manifest(str(manifest))
+    manifest.write_text('[{"ref": "a.tif"}]')
+    with pytest.raises(ValueError, match="lacks target"):
+        cli.load_manifest(str(manifest))
+
+
+def test_manifest_batch_with_summary(workdir):
+    jobs = [
+        {"ref": str(workdir / "ref_adjusted2target.tif"), "target": str(workdir / "target.tif"),
+         "output": str(workdir / "out_a.tif"), "nodata_mask": False, "max_iters": 30},
+        {"ref": str(workdir / "ref_adjusted2target.tif"), "target": str(workdir / "target.tif"),
+         "output": str(workdir / "out_b.tif"), "nodata_mask": False, "max_iters": 30},
+        {"ref": str(workdir / "missing.tif"), "target": str(workdir / "target.tif"),
+         "output": str(workdir / "out_c.tif")},
+    ]
+    manifest = workdir / "jobs.json"
+    manifest.write_text(json.dumps(jobs))
+    summary = workdir / "summary.json"
+
+    assert cli.main(["-m", str(manifest), "-j", "2", "-s", str(summary), "-q"]) == 1
+
+    report = json.loads(summary.read_text())
+    assert (report["jobs"], report["ok"], report["failed"]) == (3, 2, 1)
+    assert [r["status"] for r in report["results"]] == ["ok", "ok", "error"]
+    expected = gdal.Open(str(EXPECTED_DIR / "target_norm_prealigned.tif")).ReadAsArray()
+    for name in ("out_a.tif", "out_b.tif"):
+        np.testing.assert_array_equal(gdal.Open(str(workdir / name)).ReadAsArray(), expected)
+    assert not (workdir / "out_c.tif").exists()
+
+
+def test_single_pair_default_output(workdir):
+    args = [str(workdir / "ref_adjusted2target.tif"), str(workdir / "target.tif"), "--no-nodata-mask", "-q"]
+    assert cli.main(args) == 0
+    assert (workdir / "target_norm.tif").exists()
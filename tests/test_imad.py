@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+from osgeo import gdal
+
+from ArrNorm.core import iMad, radcal
+
+
+def test_array_api_recovers_the_radiometric_change(scene):
+    ref, tgt, changed = scene(ripple=400)
+    model = iMad.irmad(ref, tgt)
+    mads, chisqr = model.transform(ref, tgt)
+    assert mads.shape == ref.shape and chisqr.shape == ref.shape[1:]
+    # changed pixels stand out in the chi-square statistic
+    assert np.median(chisqr[changed]) > 10 * np.median(chisqr[~changed])
+
+    a, b, r = radcal.radcal_fit(ref, tgt, chisqr)
+    np.testing.assert_allclose(b, 1.25, rtol=0.01)
+    np.testing.assert_allclose(a, -150, atol=5)
+    assert (r > 0.99).all()
+    normalized = radcal.radcal_apply(tgt, a, b)
+    assert np.abs(normalized - ref)[:, ~changed].mean() < 10
+
+
+def test_array_api_matches_file_path(tmp_path, scene, write_raster):
+    ref, tgt, _changed = scene(ripple=400)
+    ref, tgt = ref.astype(np.float32), tgt.astype(np.float32)
+    write_raster(tmp_path / "ref.tif", ref)
+    write_raster(tmp_path / "tgt.tif", tgt)
+    outfn = iMad.main(str(tmp_path / "ref.tif"), str(tmp_path / "tgt.tif"), output=str(tmp_path / "mad.tif"),
+                      feedback=None)
+    on_disk = gdal.Open(outfn).ReadAsArray()
+
+    model = iMad.irmad(ref, tgt)
+    mads, chisqr = model.transform(ref, tgt)
+    np.testing.assert_allclose(on_disk[:-1], mads, rtol=1e-5, atol=1e-4)
+    np.testing.assert_allclose(on_disk[-1], chisqr, rtol=1e-5, atol=1e-4)
+
+
+def test_chunks_and_mask(scene):
+    ref, tgt, changed = scene(ripple=400)
+    bands = ref.shape[0]
+
+    def chunks():
+        for ry in range(0, ref.shape[1], 50):
+            yield (ref[:, ry:ry + 50].reshape(bands, -1).T, tgt[:, ry:ry + 50].reshape(bands, -1).T,
+                   ~changed[ry:ry + 50].ravel())
+
+    from_chunks = iMad.irmad_chunks(chunks, bands)
+    from_array = iMad.irmad(ref, tgt, mask=~changed)
+    np.testing.assert_allclose(from_chunks.rho, from_array.rho, rtol=1e-9)
+    assert from_chunks.iteration == from_array.iteration
+
+    with pytest.raises(ValueError, match="mask"):
+        iMad.irmad(ref, tgt, mask=changed[:10])
+    with pytest.raises(ValueError, match="no-change pixels"):
+        radcal.radcal_fit(ref, tgt, np.full(ref.shape[1:], 1e6))
+
+
+def test_cached_tiles_match_streaming(tmp_path, scene, write_raster):
+    ref, tgt, _changed = scene(ripple=400)
+    write_raster(tmp_path / "ref.tif", ref.astype(np.float32))
+    write_raster(tmp_path / "tgt.tif", tgt.astype(np.float32))
+    outputs = []
+    for cache_tiles in (False, True):
+        stats = {}
+        outfn = iMad.main(str(tmp_path / "ref.tif"), str(tmp_path / "tgt.tif"), block_rows=32,
+                          output=str(tmp_path / "mad_{}.tif".format(cache_tiles)), perf_stats=stats,
+                          feedback=None, cache_tiles=cache_tiles)
+        outputs.append(gdal.Open(outfn).ReadAsArray())
+    np.testing.assert_array_equal(outputs[0], outputs[1])
+    assert stats["passes"] == 1
+
+
+def test_trace_reselects_like_a_new_run(tmp_path, scene):
+    ref, tgt, _changed = scene(ripple=400)
+    loose = iMad.irmad(ref, tgt, conv_threshold=0.9)
+    strict = iMad.irmad(ref, tgt, conv_threshold=0.9999, max_iters=12)
+
+    trace = iMad.IRMadTrace.load(strict.trace.save(str(tmp_path / "trace.npz")))
+    again = trace.select(0.9)
+    assert again.iteration == loose.iteration
+    np.testing.assert_array_equal(again.A, loose.A)
+    np.testing.assert_array_equal(again.rhos, loose.rhos)
+    assert trace.select(iteration=3).iteration == 3
+
+    # a run that converged early cannot answer a stricter threshold
+    with pytest.raises(ValueError, match="converged at iteration"):
+        loose.trace.select(0.9999999)
+
+    trace.to_csv(str(tmp_path / "trace.csv"))
+    header = (tmp_path / "trace.csv").read_text().splitlines()[0]
+    assert header == "iter,delta,wall_s,cpu_s,rho_1,rho_2,rho_3"
+
+
+def test_change_map_from_the_output_pass(tmp_path, scene, write_raster):
+    ref, tgt, changed = scene(ripple=400)
+    tgt[:, :4, :] = 0  # nodata rows
+    write_raster(tmp_path / "ref.tif", ref.astype(np.float32))
+    write_raster(tmp_path / "tgt.tif", tgt.astype(np.float32))
+    maps = {}
+    for kind in iMad.CHANGE_MAP_KINDS:
+        path = str(tmp_path / "change_{}.tif".format(kind))
+        iMad.main(str(tmp_path / "ref.tif"), str(tmp_path / "tgt.tif"), output=str(tmp_path / "mad.tif"),
+                  block_rows=32, change_map=path, change_kind=kind, nodata=0)
+        maps[kind] = gdal.Open(path).GetRasterBand(1).ReadAsArray()
+        assert gdal.Open(path).GetRasterBand(1).DataType == gdal.GDT_Byte
+        # the same map from the chi-square band of the MAD file
+        again = iMad.change_map(str(tmp_path / "mad.tif"), str(tmp_path / "again.tif"), kind,
+                                img_target=str(tmp_path / "tgt.tif"), nodata=0)
+        assert (np.abs(gdal.Open(again).GetRasterBand(1).ReadAsArray().astype(int) - maps[kind]) <= 1).all()
+
+    chisqr = gdal.Open(str(tmp_path / "mad.tif")).ReadAsArray()[-1]
+    ncp = iMad.chdtrc(ref.shape[0], chisqr)
+    valid = np.ones(changed.shape, dtype=bool)
+    valid[:4] = False
+    assert (maps["ncp"][~valid] == iMad.CHANGE_NODATA).all()
+    np.testing.assert_allclose(maps["ncp"][valid] / iMad.NCP_CODES, ncp[valid], atol=0.5 / iMad.NCP_CODES + 1e-6)
+    assert (maps["mask"][~valid] == iMad.CHANGE_NODATA).all()
+    assert (maps["mask"][valid] == (ncp[valid] <= 0.95)).all()
+    assert maps["mask"][valid & changed].mean() > 0.9
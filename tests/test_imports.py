@@ -0,0 +1,37 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import ArrNorm
+
+# Directory holding the ArrNorm package, for the fresh interpreters below
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(ArrNorm.__file__)))
+
+HEAVY = ("matplotlib", "scipy.stats", "scipy.ndimage", "scipy.fft")
+
+
+def loaded_after_import(module, candidates):
+    """Which of candidates a fresh interpreter has loaded after importing module."""
+    code = ("import json, sys; import {}; "
+            "print(json.dumps([m for m in {!r} if m in sys.modules]))").format(module, list(candidates))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PACKAGE_PARENT, os.environ.get("PYTHONPATH")])))
+    out = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", ["ArrNorm.core.arrnorm", "ArrNorm.core.iMad", "ArrNorm.core.radcal"])
+def test_core_defers_heavy_imports(module):
+    assert loaded_after_import(module, HEAVY) == []
+
+
+def test_cli_and_service_load_no_scientific_stack():
+    for module in ("ArrNorm.core.cli", "ArrNorm.core.service"):
+        assert loaded_after_import(module, ("numpy", "osgeo", "scipy")) == []
+
+
+def test_provider_does_not_load_the_pipeline():
+    pytest.importorskip("qgis.core")
+    assert loaded_after_import("ArrNorm.ArrNorm_provider", ("ArrNorm.core.arrnorm", "scipy")) == []
@@ -13,6 +13,7 @@ temporary directory and checks:
 Fast-path tests additionally verify that the clipper() step is skipped when
 the reference is already aligned to the target grid.
 """
+import json
 import shutil
 
 import numpy as np
@@ -90,8 +91,14 @@ def _run(workdir, ref_name, target_name="target.tif", **kw):
         nodata_mask=kw.get("nodata_mask", False),
         nodata_mask_value=kw.get("nodata_mask_value", None),
         keep_mask_layer=kw.get("keep_mask_layer", False),
-        output_file=str(workdir / "output.tif"),
+        output_file=str(workdir / kw.get("output_name", "output.tif")),
         feedback=feedback,
+        cache_dir=kw.get("cache_dir", None),
+        perf_report=kw.get("perf_report", False),
+        register_target=kw.get("register_target", False),
+        output_format=kw.get("output_format", "GTiff"),
+        scaled_output=kw.get("scaled_output", None),
+        stage_workers=kw.get("stage_workers", 2),
     )
     norm.run()
     return norm
@@ -246,3 +253,116 @@ class TestMask:
         actual   = _read_bands(Path(norm.mask_file))
         expected = _read_bands(EXPECTED_DIR / "target_mask.tif")
         np.testing.assert_array_equal(actual, expected)
+
+
+class TestCache:
+    def test_rerun_reuses_clip_and_imad(self, workdir):
+        cache_dir = workdir / "cache"
+        first = _run(workdir, "ref.tif", cache_dir=str(cache_dir))
+        second = _run(workdir, "ref.tif", cache_dir=str(cache_dir),
+                      ncp_threshold=0.90, output_name="output2.tif")
+        reused = [m for m in second.feedback.messages if m.strip().startswith("Reusing cached")]
+        assert len(reused) == 2
+        # cached artifacts survive clean(); the first run's output is unchanged
+        assert Path(second.img_ref_clip).exists()
+        assert Path(second.img_imad).exists()
+        _regression(first, "target_norm_full_ref.tif")
+
+    def test_cached_result_matches_uncached(self, workdir):
+        cache_dir = workdir / "cache"
+        _run(workdir, "ref.tif", cache_dir=str(cache_dir))
+        norm = _run(workdir, "ref.tif", cache_dir=str(cache_dir), output_name="output2.tif")
+        _regression(norm, "target_norm_full_ref.tif")
+
+
+def test_perf_report(workdir):
+    norm = _run(workdir, "ref.tif", perf_report=True, nodata_mask=True, stage_workers=1)
+    report = json.loads(Path(norm.perf_file).read_text())
+    stages = [s["stage"] for s in report["stages"]]
+    assert stages == ["clipper", "imad", "radcal", "make_mask", "apply_mask"]
+    imad = report["stages"][1]
+    assert len(imad["iterations"]) == imad["passes"] - 2
+    assert imad["pixels"] == TARGET_COLS * TARGET_ROWS
+
+
+def test_fused_negative_and_mask_matches_baseline(workdir):
+    norm = _run(workdir, "ref_adjusted2target.tif", perf_report=True, neg_to_nodata=True,
+                nodata_mask=True)
+    report = json.loads(Path(norm.perf_file).read_text())
+    stages = [s["stage"] for s in report["stages"]]
+    assert sorted(stages) == ["clipper", "imad", "make_mask", "no_negative_value+apply_mask", "radcal"]
+    assert stages.index("radcal") < stages.index("no_negative_value+apply_mask")
+    assert norm.no_neg is None
+    _regression(norm, "target_norm_masked.tif")
+
+
+def test_intermediates_stay_in_scratch(workdir):
+    norm = _run(workdir, "ref.tif", neg_to_nodata=True, nodata_mask=True, keep_mask_layer=True)
+    assert sorted(p.name for p in workdir.iterdir()) == [
+        "output.tif", "output_Mask.tif", "ref.tif", "ref_adjusted2target.tif", "target.tif"]
+    assert norm.scratch is None
+
+
+def test_scratch_removed_after_failure(workdir):
+    with pytest.raises(Exception):
+        _run(workdir, "ref_adjusted2target.tif", ncp_threshold=1.0)
+    assert not list(workdir.glob(".arrnorm-*"))
+    assert not (workdir / "output.tif").exists()
+
+
+def test_cog_output(workdir):
+    norm = _run(workdir, "ref_adjusted2target.tif", output_format="COG",
+                nodata_mask=True, keep_mask_layer=True)
+    _check_properties(norm)
+    _regression(norm, "target_norm_masked.tif")
+    for path in (norm.output_file, norm.mask_file):
+        ds = gdal.Open(str(path), GA_ReadOnly)
+        assert ds.GetMetadata("IMAGE_STRUCTURE").get("LAYOUT") == "COG"
+        ds = None
+
+
+@pytest.mark.parametrize("scaled_output, gdal_dtype", [("UInt16", gdal.GDT_UInt16), ("Int16", gdal.GDT_Int16)])
+def test_scaled_output(workdir, scaled_output, gdal_dtype):
+    norm = _run(workdir, "ref_adjusted2target.tif", scaled_output=scaled_output)
+    expected = _read_bands(EXPECTED_DIR / "target_norm_prealigned.tif").astype(np.float64)
+    target_nodata = _raster_info(workdir / "target.tif")["nodata"]
+    ds = gdal.Open(norm.output_file, GA_ReadOnly)
+    for b in range(ds.RasterCount):
+        band = ds.GetRasterBand(b + 1)
+        assert band.DataType == gdal_dtype
+        codes = band.ReadAsArray()
+        valid = codes != band.GetNoDataValue()
+        if target_nodata is None:
+            assert valid.all()
+        # the baseline is clipped to UInt16 and rounded to integers, the scaled output to scale / 2
+        values = np.clip(codes * band.GetScale() + band.GetOffset(), 0, 65535)
+        np.testing.assert_allclose(values[valid], expected[b][valid], atol=0.5 + band.GetScale())
+    ds = None
+
+
+class TestRegister:
+    def _shifted_target(self, workdir, shift):
+        """Write target.tif shifted by (rows, cols) as target_shifted.tif."""
+        src = gdal.Open(str(workdir / "target.tif"), GA_ReadOnly)
+        path = workdir / "target_shifted.tif"
+        dst = gdal.GetDriverByName("GTiff").CreateCopy(str(path), src)
+        for b in range(src.RasterCount):
+            dst.GetRasterBand(b + 1).WriteArray(
+                np.roll(src.GetRasterBand(b + 1).ReadAsArray(), shift, axis=(0, 1)))
+        dst = src = None
+        return path.name
+
+    def test_unshifted_target_matches_baseline(self, workdir):
+        norm = _run(workdir, "ref_adjusted2target.tif", register_target=True)
+        assert norm.target_shift == [0, 0]
+        _regression(norm, "target_norm_prealigned.tif")
+
+    def test_recovers_shift_and_reuses_transform(self, workdir):
+        target = self._shifted_target(workdir, (4, -6))
+        norm = _run(workdir, "ref_adjusted2target.tif", target_name=target, register_target=True)
+        assert norm.target_shift == [-4, 6]
+        _check_properties(norm)
+        assert not Path(norm.img_target_reg).exists()  # the shifted VRT is removed by clean()
+        again = _run(workdir, "ref_adjusted2target.tif", target_name=target, register_target=True,
+                     output_name="output2.tif")
+        assert any(m.strip().startswith("Reusing registration transform") for m in again.feedback.messages)
@@ -0,0 +1,55 @@
+import pytest
+
+from ArrNorm.core.memory import (DEFAULT_BLOCK_ROWS, MIN_BLOCK_ROWS, RASTER_OPS_COPIES, MemoryBudget,
+                                 format_size, parse_size)
+
+
+class TestParseSize:
+    def test_units(self):
+        assert parse_size("512M") == 512 * 1024 ** 2
+        assert parse_size("1.5GB") == int(1.5 * 1024 ** 3)
+        assert parse_size("2GiB") == 2 * 1024 ** 3
+        assert parse_size(" 4 g ") == 4 * 1024 ** 3
+        assert parse_size(1000) == 1000
+        assert parse_size(None) is None
+
+    def test_invalid(self):
+        with pytest.raises(ValueError, match="Invalid memory size"):
+            parse_size("lots")
+
+    def test_format(self):
+        assert format_size(512) == "512 B"
+        assert format_size(3 * 1024 ** 2) == "3.0 MiB"
+
+
+class TestMemoryBudget:
+    def test_no_budget_keeps_defaults(self):
+        memory = MemoryBudget(None, 8000, 8000, 6)
+        assert not memory.limited
+        assert memory.block_rows() == DEFAULT_BLOCK_ROWS
+        assert memory.workers(4) == 4
+        assert not memory.cache_imad()
+
+    def test_block_rows_scale_with_budget_and_scene(self):
+        small = MemoryBudget("256M", 8000, 8000, 6)
+        large = MemoryBudget("1G", 8000, 8000, 6)
+        assert abs(large.block_rows() - 4 * small.block_rows()) <= 4
+        assert abs(MemoryBudget("256M", 8000, 8000, 3).block_rows() - 2 * small.block_rows()) <= 2
+        # a block fits its share of the budget
+        assert small.block_bytes(small.block_rows()) <= small.budget / 4
+        # side-by-side stages split the block share, single-band steps get taller blocks
+        assert abs(small.block_rows(workers=2) - small.block_rows() / 2) <= 1
+        assert small.block_rows(RASTER_OPS_COPIES, bands=1) > small.block_rows()
+
+    def test_block_rows_clamped(self):
+        assert MemoryBudget("1M", 8000, 8000, 6).block_rows() == MIN_BLOCK_ROWS
+        assert MemoryBudget("64G", 500, 300, 4).block_rows() == 300
+
+    def test_imad_cache_only_when_it_fits(self):
+        # 2000 x 2000 x 4 bands x 2 images as float64 = 244 MiB
+        assert MemoryBudget("1G", 2000, 2000, 4).cache_imad()
+        assert not MemoryBudget("256M", 2000, 2000, 4).cache_imad()
+
+    def test_workers_capped_by_budget(self):
+        assert MemoryBudget("8G", 8000, 8000, 6).workers(2) == 2
+        assert MemoryBudget("16M", 8000, 8000, 6).workers(4) == 1
@@ -0,0 +1,58 @@
+import json
+
+from ArrNorm.core.perf import CPROFILE_ENV, PerfReport, current_rss_bytes
+
+
+def test_stage_records_timing_and_io(tmp_path):
+    src = tmp_path / "in.bin"
+    src.write_bytes(b"x" * 1000)
+    out = tmp_path / "out.bin"
+    report = PerfReport()
+    with report.stage("step", inputs=[str(src)], pixels=2_000_000, passes=3) as rec:
+        out.write_bytes(b"y" * 500)
+        rec["outputs"] = [str(out)]
+        rec["iterations"] = [{"iter": 1}]
+    (stage,) = report.stages
+    assert stage["stage"] == "step"
+    assert stage["bytes_read"] == 3000
+    assert stage["bytes_written"] == 500
+    assert stage["pixels"] == 2_000_000
+    assert stage["mpix_per_s"] > 0
+    assert stage["iterations"] == [{"iter": 1}]
+    assert stage["wall_s"] >= 0 and stage["cpu_s"] >= 0
+
+
+def test_disabled_report_records_nothing(tmp_path):
+    report = PerfReport(enabled=False)
+    with report.stage("step") as rec:
+        rec["outputs"] = []
+    assert report.stages == []
+    assert report.write(str(tmp_path / "perf.json")) is None
+
+
+def test_write_json(tmp_path):
+    report = PerfReport()
+    with report.stage("a"):
+        pass
+    path = report.write(str(tmp_path / "perf.json"))
+    data = json.loads(open(path).read())
+    assert [s["stage"] for s in data["stages"]] == ["a"]
+
+
+def test_cprofile_dump(tmp_path, monkeypatch):
+    monkeypatch.setenv(CPROFILE_ENV, str(tmp_path / "prof"))
+    report = PerfReport()
+    with report.stage("a"):
+        sum(range(1000))
+    assert (tmp_path / "prof").exists()
+    assert report.stages[0]["cprofile"].endswith("_a.prof")
+
+
+def test_disabled_report_still_warns_over_the_memory_budget():
+    messages = []
+    report = PerfReport(enabled=False, memory_budget=1, warn=messages.append)
+    with report.stage("imad"):
+        pass
+    assert report.stages == []
+    if current_rss_bytes() is not None:
+        assert len(messages) == 1 and "stage imad peaked at" in messages[0]
@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+from ArrNorm.core.pipeline import Pipeline, Stage
+
+
+class Feedback:
+    def __init__(self, cancel_after=None):
+        self.progress = []
+        self.cancel_after = cancel_after
+        self.finished = 0
+
+    def pushInfo(self, msg):
+        pass
+
+    def setProgress(self, value):
+        self.progress.append(value)
+
+    def isCanceled(self):
+        return self.cancel_after is not None and self.finished >= self.cancel_after
+
+
+def _recorder(log, name, feedback=None, event=None, wait_for=None):
+    def func(fb, rec):
+        if wait_for is not None:
+            assert wait_for.wait(5), "stages did not overlap"
+        if event is not None:
+            event.set()
+        fb.setProgress(50)
+        log.append(name)
+        if feedback is not None:
+            feedback.finished += 1
+    return func
+
+
+def test_dependency_order_with_one_worker():
+    log = []
+    fb = Feedback()
+    stages = [Stage("a", _recorder(log, "a"), outputs=["x"]),
+              Stage("b", _recorder(log, "b"), inputs=["x"], outputs=["y"]),
+              Stage("c", _recorder(log, "c"), inputs=["ext"], outputs=["z"]),
+              Stage("d", _recorder(log, "d"), inputs=["y", "z"])]
+    assert Pipeline(stages, fb, workers=1).run()
+    assert log == ["a", "b", "c", "d"]
+    assert fb.progress == sorted(fb.progress) and fb.progress[-1] == 100
+
+
+def test_independent_stages_overlap():
+    log = []
+    started = threading.Event()
+    # 'b' only finishes once 'a' has started, so this deadlocks unless both run at once
+    stages = [Stage("b", _recorder(log, "b", wait_for=started), outputs=["y"]),
+              Stage("a", _recorder(log, "a", event=started), outputs=["x"])]
+    assert Pipeline(stages, Feedback(), workers=2).run()
+    assert sorted(log) == ["a", "b"]
+
+
+def test_fusion_only_when_intermediate_unused():
+    fused = Stage("b+c", lambda fb, rec: None, inputs=["x"], outputs=["z"], replaces=("b", "c"))
+    stages = [Stage("a", None, outputs=["x"]),
+              Stage("b", None, inputs=["x"], outputs=["y"]),
+              Stage("c", None, inputs=["y"], outputs=["z"])]
+    plan = Pipeline(stages, Feedback(), fused=[fused]).plan()
+    assert [s.name for s in plan] == ["a", "b+c"]
+    plan = Pipeline(stages, Feedback(), fused=[fused], keep=["y"]).plan()
+    assert [s.name for s in plan] == ["a", "b", "c"]
+
+
+def test_cancel_stops_scheduling():
+    log = []
+    fb = Feedback(cancel_after=1)
+    stages = [Stage("a", _recorder(log, "a", feedback=fb), outputs=["x"]),
+              Stage("b", _recorder(log, "b", feedback=fb), inputs=["x"])]
+    assert not Pipeline(stages, fb, workers=1).run()
+    assert log == ["a"]
+
+
+def test_error_is_raised_after_running_stages_finish():
+    log = []
+
+    def fail(fb, rec):
+        raise RuntimeError("boom")
+
+    stages = [Stage("a", fail, outputs=["x"]),
+              Stage("b", _recorder(log, "b"), outputs=["y"]),
+              Stage("c", _recorder(log, "c"), inputs=["x"])]
+    with pytest.raises(RuntimeError, match="boom"):
+        Pipeline(stages, Feedback(), workers=2).run()
+    assert log == ["b"]
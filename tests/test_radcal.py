@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+from osgeo import gdal
+
+from ArrNorm.core import radcal
+
+
+@pytest.mark.parametrize("dtype", [gdal.GDT_UInt16, gdal.GDT_Int16])
+@pytest.mark.parametrize("a, b", [(12.5, 0.8), (-3.0, -1.7)])
+def test_scaled_coefficients_cover_output_range(dtype, a, b):
+    target = np.linspace(0.02, 0.61, 1000)
+    values = a + b * target
+    scale, offset = radcal.scaled_coefficients(a, b, target.min(), target.max(), dtype)
+    codes = radcal._to_codes(values, scale, offset, dtype)
+    code_lo, code_hi, nodata = radcal._SCALED_CODES[dtype]
+    assert codes.min() == code_lo and codes.max() == code_hi
+    assert nodata not in codes
+    np.testing.assert_allclose(codes * scale + offset, values, atol=scale / 2 + 1e-12)
+
+
+def test_scaled_coefficients_constant_band():
+    scale, offset = radcal.scaled_coefficients(5.0, 0.0, 1.0, 9.0, gdal.GDT_UInt16)
+    assert scale == 1.0
+    assert radcal._to_codes(np.array([5.0]), scale, offset, gdal.GDT_UInt16)[0] * scale + offset == 5.0
+
+
+def test_ncp_sweep_matches_radcal_fit():
+    rng = np.random.default_rng(1)
+    bands, n = 3, 20000
+    ref = rng.uniform(200, 3000, (bands, n))
+    tgt = 0.8 * ref + 120 + rng.normal(0, 5, ref.shape)
+    chisqr = rng.chisquare(bands, n)
+    chisqr[:2000] *= 20  # changed pixels
+
+    sweep = radcal.NcpSweep(bands)
+    for s in range(0, n, 3000):  # streamed in chunks
+        sweep.update(ref[:, s:s + 3000], tgt[:, s:s + 3000], chisqr[s:s + 3000])
+    for t in (0.5, 0.9, 0.95, 0.99):
+        expected = radcal.radcal_fit(ref, tgt, chisqr, ncp_threshold=t)
+        np.testing.assert_allclose(sweep.fit(t), expected, rtol=1e-9)
+        assert sweep.pixels(t) == len(radcal._nochange_index(chisqr, bands, t)[0])
+
+    report = sweep.report([0.95, 0.5, 1.0])
+    assert [r["ncp_threshold"] for r in report] == [0.5, 0.95, 1.0]
+    assert report[-1]["pixels"] == 0 and np.isnan(report[-1]["slopes"]).all()
+    with pytest.raises(ValueError, match="no-change pixels"):
+        sweep.fit(1.0)
+
+
+def test_main_fits_in_row_blocks_with_the_sweep(tmp_path, scene, write_raster):
+    ref, tgt, _changed = scene(rows=40, cols=30, seed=2, changed=0)
+    rng = np.random.default_rng(2)
+    mad = np.concatenate([rng.normal(0, 1, (2, 40, 30)), rng.chisquare(2, (1, 40, 30))])
+    paths = [str(tmp_path / name) for name in ("ref.tif", "tgt.tif", "MAD(ref&tgt.tif).tif")]
+    for path, data in zip(paths, (ref, tgt, mad)):
+        write_raster(path, data)
+
+    sweep = radcal.NcpSweep(3, dof=2)
+    radcal.main(paths[2], img_ref=paths[0], img_tgt=paths[1], output=str(tmp_path / "out.tif"),
+                out_dtype=gdal.GDT_Float32, feedback=None, sweep=sweep, block_rows=9)
+    # the file entry point is the array API read in row blocks
+    ref32, tgt32 = ref.astype(np.float32), tgt.astype(np.float32)
+    intercepts, slopes, _r = radcal.radcal_fit(ref32, tgt32, mad[-1].astype(np.float32), dof=2)
+    np.testing.assert_allclose(gdal.Open(str(tmp_path / "out.tif")).ReadAsArray(),
+                               radcal.radcal_apply(tgt32, intercepts, slopes, gdal.GDT_Float32), rtol=1e-6)
+    # the same sums as a separate blocked read
+    expected = radcal.ncp_sweep(paths[2], paths[0], paths[1], block_rows=7)
+    assert sweep.pixels(0.9) == expected.pixels(0.9)
+    np.testing.assert_allclose(sweep.fit(0.9), expected.fit(0.9), rtol=1e-9)
+
+
+def test_scaled_output_with_nan_nodata_target(tmp_path, scene, write_raster):
+    ref, tgt, _changed = scene(rows=30, cols=20, bands=2, seed=3, changed=0)
+    tgt[:, :4] = np.nan
+    rng = np.random.default_rng(3)
+    mad = np.concatenate([rng.normal(0, 1, (1, 30, 20)), rng.chisquare(1, (1, 30, 20))])
+    mad[:, :4] = np.nan
+    paths = [str(tmp_path / name) for name in ("ref.tif", "tgt.tif", "MAD(ref&tgt.tif).tif")]
+    for path, data, nodata in zip(paths, (ref, tgt, mad), (None, np.nan, None)):
+        write_raster(path, data, nodata=nodata)
+
+    # the normalized output and the full-scene one (the target itself here)
+    full = radcal.main(paths[2], img_ref=paths[0], img_tgt=paths[1], output=str(tmp_path / "out.tif"),
+                       img_target=paths[1], scaled_dtype=gdal.GDT_UInt16, feedback=None)
+    nodata = radcal._SCALED_CODES[gdal.GDT_UInt16][2]
+    for path in (str(tmp_path / "out.tif"), full):
+        band = gdal.Open(path).GetRasterBand(1)
+        assert np.isfinite(band.GetScale()) and np.isfinite(band.GetOffset())
+        codes = band.ReadAsArray()
+        assert (codes[:4] == nodata).all() and (codes[4:] != nodata).all()
+        values = codes[4:] * band.GetScale() + band.GetOffset()
+        assert np.abs(values - ref[0, 4:]).mean() < 20
+
+
+def _coefficients(**extra):
+    coefficients = {"ncp_threshold": 0.95, "no_change_pixels": 100, "dtype": "Float32", "scaled_output": None,
+                    "bands": [{"band": 1, "intercept": 10.0, "slope": 0.5, "correlation": 0.99},
+                              {"band": 2, "intercept": -2.0, "slope": 1.5, "correlation": 0.98}]}
+    coefficients.update(extra)
+    return coefficients
+
+
+def test_apply_coefficients_streams_every_band(tmp_path, write_raster):
+    data = np.arange(2 * 37 * 5, dtype=np.float32).reshape(2, 37, 5)
+    data[0, 3, 2] = -9999
+    src = str(tmp_path / "scene.tif")
+    write_raster(src, data, nodata=-9999)
+    sidecar = radcal.save_coefficients(str(tmp_path / "c_radcal.json"), _coefficients())
+    assert radcal.load_coefficients(sidecar)["format"] == radcal.COEFFICIENTS_FORMAT
+
+    out = radcal.apply_coefficients(src, str(tmp_path / "out.tif"), sidecar, block_rows=8)
+    ds = gdal.Open(out)
+    expected = radcal.radcal_apply(data, [10.0, -2.0], [0.5, 1.5])
+    expected[0, 3, 2] = -9999
+    np.testing.assert_allclose(ds.ReadAsArray(), expected)
+    assert ds.GetRasterBand(1).GetNoDataValue() == -9999
+
+
+def test_apply_coefficients_scaled_codes(tmp_path, write_raster):
+    data = np.linspace(0.0, 1.0, 2 * 10 * 4, dtype=np.float32).reshape(2, 10, 4)
+    src = str(tmp_path / "scene.tif")
+    write_raster(src, data)
+    coefficients = _coefficients(scaled_output="UInt16")
+    for band in coefficients["bands"]:
+        band["scale"], band["offset"] = radcal.scaled_coefficients(
+            band["intercept"], band["slope"], 0.0, 1.0, gdal.GDT_UInt16)
+
+    ds = gdal.Open(radcal.apply_coefficients(src, str(tmp_path / "out.tif"), coefficients))
+    for k, band in enumerate(coefficients["bands"]):
+        out = ds.GetRasterBand(k + 1)
+        assert out.DataType == gdal.GDT_UInt16 and out.GetScale() == band["scale"]
+        values = out.ReadAsArray() * band["scale"] + band["offset"]
+        np.testing.assert_allclose(values, band["intercept"] + band["slope"] * data[k], atol=band["scale"])
+
+
+def test_apply_many_reports_each_raster(tmp_path, write_raster):
+    src = str(tmp_path / "scene.tif")
+    write_raster(src, np.ones((2, 4, 4), dtype=np.float32))
+    pairs = [(src, str(tmp_path / "a.tif")), (str(tmp_path / "missing.tif"), str(tmp_path / "b.tif")),
+             (src, str(tmp_path / "c.tif"))]
+    records = radcal.apply_many(pairs, _coefficients(), workers=2)
+    assert [r["status"] for r in records] == ["ok", "error", "ok"]
+    assert "missing.tif" in records[1]["error"]
+
+    (tmp_path / "other.json").write_text("{}")
+    with pytest.raises(ValueError, match="not a RadCal"):
+        radcal.load_coefficients(str(tmp_path / "other.json"))
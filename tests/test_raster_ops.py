@@ -169,6 +169,18 @@ class TestMakeMask:
         np.testing.assert_array_equal(result, expected)
         ds = None
 
+    def test_vrt_input_writes_geotiff(self, tmp_path):
+        arr = np.array([[0, 5], [7, 0]], dtype=np.float32)
+        inp = str(tmp_path / "in.tif")
+        _create_test_raster(inp, arr)
+        vrt = str(tmp_path / "in.vrt")
+        gdal.Translate(vrt, inp, format="VRT")
+        out = str(tmp_path / "mask.tif")
+        raster_ops.make_mask(vrt, out, nodata_value=0)
+        ds = gdal.Open(out)
+        assert ds.GetDriver().ShortName == "GTiff"
+        np.testing.assert_array_equal(ds.GetRasterBand(1).ReadAsArray(), [[0, 1], [1, 0]])
+
 
 class TestApplyMask:
     def test_basic_application(self, tmp_path):
@@ -236,3 +248,61 @@ class TestApplyMask:
         result = ds.GetRasterBand(1).ReadAsArray()
         np.testing.assert_array_equal(result, arr)
         ds = None
+
+
+def _create_scaled_raster(path, codes, scale, offset, nodata):
+    """Create a single-band Int16 raster storing value = code * scale + offset."""
+    _create_test_raster(path, codes, nodata=nodata, dtype=gdal.GDT_Int16)
+    ds = gdal.Open(path, gdal.GA_Update)
+    ds.GetRasterBand(1).SetScale(scale)
+    ds.GetRasterBand(1).SetOffset(offset)
+    ds = None
+
+
+class TestScaledBands:
+    def test_negative_tested_in_physical_units(self, tmp_path):
+        # values: -1.5, 0.5, 4.5, nodata
+        codes = np.array([[-100, 100, 500, -32768]], dtype=np.int16)
+        inp = str(tmp_path / "in.tif")
+        out = str(tmp_path / "out.tif")
+        _create_scaled_raster(inp, codes, 0.01, -0.5, -32768)
+        raster_ops.no_negative_value(inp, out, nodata_value=0)
+        band = gdal.Open(out).GetRasterBand(1)
+        assert (band.GetScale(), band.GetOffset(), band.GetNoDataValue()) == (0.01, -0.5, -32768)
+        np.testing.assert_array_equal(band.ReadAsArray(), [[-32768, 100, 500, -32768]])
+
+    def test_apply_mask_uses_nodata_code(self, tmp_path):
+        codes = np.array([[0, 10], [20, 30]], dtype=np.int16)
+        inp = str(tmp_path / "in.tif")
+        mask = str(tmp_path / "mask.tif")
+        out = str(tmp_path / "out.tif")
+        _create_scaled_raster(inp, codes, 0.5, 100.0, -32768)
+        _create_test_raster(mask, np.array([[1, 0], [1, 1]]), dtype=gdal.GDT_Byte)
+        raster_ops.apply_mask(inp, mask, out, nodata_value=0)
+        band = gdal.Open(out).GetRasterBand(1)
+        assert (band.GetScale(), band.GetOffset(), band.GetNoDataValue()) == (0.5, 100.0, -32768)
+        # code 0 is a valid value (100.0) and is kept
+        np.testing.assert_array_equal(band.ReadAsArray(), [[0, -32768], [20, 30]])
+
+
+class TestWriteCog:
+    @pytest.mark.parametrize("dtype,predictor", [
+        (gdal.GDT_Float32, "3"), (gdal.GDT_UInt16, "2"), (gdal.GDT_Byte, "1")])
+    def test_predictor_follows_dtype(self, dtype, predictor):
+        options = raster_ops.cog_creation_options(dtype)
+        assert f"PREDICTOR={predictor}" in options
+        assert "NUM_THREADS=ALL_CPUS" in options
+
+    def test_cog_pixels_and_layout(self, tmp_path):
+        arr = np.arange(600 * 700, dtype=np.uint16).reshape(600, 700)
+        inp = str(tmp_path / "in.tif")
+        out = str(tmp_path / "out.tif")
+        _create_test_raster(inp, arr, dtype=gdal.GDT_UInt16)
+        raster_ops.write_cog(inp, out)
+        ds = gdal.Open(out)
+        np.testing.assert_array_equal(ds.GetRasterBand(1).ReadAsArray(), arr)
+        assert ds.GetGeoTransform() == (0, 1, 0, 0, 0, -1)
+        structure = ds.GetMetadata("IMAGE_STRUCTURE")
+        assert structure.get("LAYOUT") == "COG"
+        assert structure.get("COMPRESSION") == "DEFLATE"
+        assert ds.GetRasterBand(1).GetOverviewCount() >= 1
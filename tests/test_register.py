@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+import scipy.ndimage as ndii
+from osgeo import gdal
+
+from ArrNorm.core import register
+
+
+# projected grid with 30 m pixels
+GEOTRANSFORM = (1000, 30, 0, 5000, 0, -30)
+
+
+def _smooth_image(rows, cols, seed=0):
+    rng = np.random.default_rng(seed)
+    return ndii.gaussian_filter(rng.random((rows, cols)) * 1000, 2).astype(np.float32)
+
+
+def _textured_image(rows, cols, seed=0):
+    # fine texture on top of smooth structure, so phase correlation has a clear peak
+    rng = np.random.default_rng(seed)
+    return (ndii.gaussian_filter(rng.random((rows, cols)) * 4000, 6) +
+            ndii.gaussian_filter(rng.random((rows, cols)) * 800, 0.7)).astype(np.float32)
+
+
+class TestShiftedWindow:
+    @pytest.mark.parametrize("shift", [(3, -4), (0, 0), (-7, 2), (2.5, -1.3), (-6.7, 4.2)])
+    @pytest.mark.parametrize("window", [(0, 0, 50, 40), (50, 40, 50, 40), (100, 80, 50, 40)])
+    def test_matches_full_band_shift(self, tmp_path, shift, window, write_raster):
+        img = _smooth_image(120, 150)
+        path = write_raster(tmp_path / "img.tif", [img], geotransform=GEOTRANSFORM)
+        band = gdal.Open(path).GetRasterBand(1)
+        x0, y0, cols, rows = window
+        expected = ndii.shift(img, shift)[y0:y0 + rows, x0:x0 + cols]
+        actual = register._shifted_window(band, x0, y0, cols, rows, shift)
+        np.testing.assert_allclose(actual, expected, atol=1e-3)
+
+    def test_integer_shift_is_exact_slice(self, tmp_path, write_raster):
+        img = _smooth_image(60, 70)
+        path = write_raster(tmp_path / "img.tif", [img], geotransform=GEOTRANSFORM)
+        band = gdal.Open(path).GetRasterBand(1)
+        actual = register._shifted_window(band, 10, 10, 30, 30, (2, -3))
+        np.testing.assert_array_equal(actual, img[8:38, 13:43])
+
+
+class TestMain:
+    def _pair(self, tmp_path, write_raster):
+        big = np.stack([_textured_image(260, 300, seed=b) for b in range(3)])
+        ref = write_raster(tmp_path / "ref.tif", big[:, 10:250, 10:290], geotransform=GEOTRANSFORM)
+        tgt = write_raster(tmp_path / "tgt.tif", big[:, 7:247, 14:294], geotransform=GEOTRANSFORM)
+        return ref, tgt, big[:, 10:250, 10:290]
+
+    def test_single_output_recovers_reference(self, tmp_path, write_raster):
+        ref, tgt, expected = self._pair(tmp_path, write_raster)
+        out = register.main(ref, tgt, warpband=1, chunksize=100)
+        assert out.endswith("tgt_warp.tif")
+        actual = gdal.Open(out).ReadAsArray()
+        # away from the borders the shifted target is the reference
+        np.testing.assert_allclose(actual[:, 10:-10, 10:-10], expected[:, 10:-10, 10:-10], atol=1e-3)
+        assert not list(tmp_path.glob("*_warp_block_*"))
+
+    def test_virtual_matches_single_output(self, tmp_path, write_raster):
+        ref, tgt, _ = self._pair(tmp_path, write_raster)
+        out = register.main(ref, tgt, warpband=1, chunksize=100)
+        single = gdal.Open(out).ReadAsArray()
+        vrt = register.main(ref, tgt, warpband=1, chunksize=100, virtual=True)
+        assert vrt.endswith(".vrt")
+        np.testing.assert_array_equal(gdal.Open(vrt).ReadAsArray(), single)
+
+    def test_thread_pool_matches_serial(self, tmp_path, write_raster):
+        ref, tgt, _ = self._pair(tmp_path, write_raster)
+        serial = gdal.Open(register.main(ref, tgt, warpband=1, chunksize=60)).ReadAsArray()
+        pooled = gdal.Open(register.main(ref, tgt, warpband=1, chunksize=60, workers=3)).ReadAsArray()
+        np.testing.assert_array_equal(pooled, serial)
+
+    def test_cancel_during_estimation(self, tmp_path, write_raster):
+        ref, tgt, _ = self._pair(tmp_path, write_raster)
+
+        class CancelingFeedback:
+            calls = 0
+
+            def pushInfo(self, msg):
+                pass
+
+            def isCanceled(self):
+                self.calls += 1
+                return self.calls > 2
+
+        assert register.main(ref, tgt, warpband=1, chunksize=60, workers=2,
+                             feedback=CancelingFeedback()) is None
+
+
+class TestPyramid:
+    def _pair(self, tmp_path, write_raster):
+        # offset larger than a refinement window's correlation range
+        big = _textured_image(480, 520)
+        ref = write_raster(tmp_path / "ref.tif", [big[40:440, 60:460]], geotransform=GEOTRANSFORM)
+        tgt = write_raster(tmp_path / "tgt.tif", [big[3:403, 95:495]], geotransform=GEOTRANSFORM)
+        return ref, tgt, big[40:440, 60:460]
+
+    @pytest.mark.parametrize("chunksize", [None, 200])
+    def test_recovers_large_offset(self, tmp_path, chunksize, write_raster):
+        ref, tgt, expected = self._pair(tmp_path, write_raster)
+        out = register.main(ref, tgt, warpband=1, chunksize=chunksize,
+                            overview=128, refine_window=96)
+        actual = gdal.Open(out).GetRasterBand(1).ReadAsArray()
+        np.testing.assert_array_equal(actual[40:-40, 40:-40], expected[40:-40, 40:-40])
+
+
+def test_remembered_transforms_are_bounded(monkeypatch):
+    from ArrNorm.core import arrnorm
+
+    monkeypatch.setattr(arrnorm, "REGISTER_TRANSFORMS_MAX", 2)
+    monkeypatch.setattr(arrnorm, "_REGISTER_TRANSFORMS", arrnorm.OrderedDict())
+    for key in ("a", "b"):
+        arrnorm._remembered_transform(key, {"shift": key})
+    assert arrnorm._remembered_transform("a") == {"shift": "a"}
+    arrnorm._remembered_transform("c", {"shift": "c"})
+    # "b" was the least recently used
+    assert list(arrnorm._REGISTER_TRANSFORMS) == ["a", "c"]
+    assert arrnorm._remembered_transform("b") is None
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from ArrNorm.core import scratch
+
+
+def test_runs_get_distinct_directories(tmp_path):
+    a = scratch.ScratchDir(str(tmp_path))
+    b = scratch.ScratchDir(str(tmp_path))
+    assert a.path != b.path
+    assert os.path.basename(a.path).startswith("{}{}-".format(scratch.PREFIX, os.getpid()))
+    a.cleanup()
+    assert not os.path.exists(a.path) and os.path.isdir(b.path)
+
+
+def test_publish_replaces_destination(tmp_path):
+    run = scratch.ScratchDir(str(tmp_path))
+    dst = tmp_path / "out.tif"
+    dst.write_text("old")
+    src = run.file("out.tif")
+    with open(src, "w") as f:
+        f.write("new")
+    assert run.publish(src, str(dst)) == str(dst)
+    assert dst.read_text() == "new" and not os.path.exists(src)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="liveness check needs POSIX")
+def test_sweep_removes_only_dead_runs(tmp_path):
+    live = scratch.ScratchDir(str(tmp_path))
+    dead = tmp_path / "{}999999999-x1".format(scratch.PREFIX)
+    dead.mkdir()
+    (tmp_path / "{}notapid".format(scratch.PREFIX)).mkdir()
+    assert scratch.sweep_stale(str(tmp_path)) == [str(dead)]
+    assert os.path.isdir(live.path)
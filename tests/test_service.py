@@ -0,0 +1,83 @@
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+import pytest
+from osgeo import gdal
+
+from ArrNorm.core import cli
+from ArrNorm.core.service import NormalizationService, ServiceClient, make_server
+
+DATA_DIR = Path(__file__).parent / "data"
+EXPECTED_DIR = DATA_DIR / "expected"
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    for name in ("ref_adjusted2target.tif", "target.tif"):
+        shutil.copy(str(DATA_DIR / name), str(tmp_path / name))
+    return tmp_path
+
+
+def _start(address, **kwargs):
+    service = NormalizationService(quiet=True, **kwargs)
+    server = make_server(address, service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if isinstance(server.server_address, tuple):
+        address = "{}:{}".format(*server.server_address[:2])
+    return service, server, ServiceClient(address, timeout=600)
+
+
+def _stop(service, server):
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def test_jobs_over_tcp_share_the_warm_cache(workdir):
+    service, server, client = _start("127.0.0.1:0", workers=2)
+    try:
+        job = {"ref": str(workdir / "ref_adjusted2target.tif"), "target": str(workdir / "target.tif"),
+               "nodata_mask": False, "max_iters": 30}
+        ids = [client.submit(dict(job, output=str(workdir / name))) for name in ("out_a.tif", "out_b.tif")]
+        records = [client.status(job_id, wait=600) for job_id in ids]
+        assert [r["status"] for r in records] == ["ok", "ok"]
+        expected = gdal.Open(str(EXPECTED_DIR / "target_norm_prealigned.tif")).ReadAsArray()
+        for name in ("out_a.tif", "out_b.tif"):
+            np.testing.assert_array_equal(gdal.Open(str(workdir / name)).ReadAsArray(), expected)
+        assert client.health()["jobs"] == {"ok": 2}
+
+        with pytest.raises(RuntimeError, match="400.*unknown options: ncp"):
+            client.submit(dict(job, ncp=1))
+    finally:
+        _stop(service, server)
+
+
+def test_unix_socket_and_cancel(tmp_path, monkeypatch):
+    release = threading.Event()
+
+    def slow_job(job, options, quiet=False, feedback=None):
+        release.wait(60)
+        return {"ref": job["ref"], "target": job["target"], "status": "ok", "elapsed_s": 0}
+
+    monkeypatch.setattr(cli, "run_job", slow_job)
+    service, server, client = _start("unix:" + str(tmp_path / "arrnorm.sock"), workers=1)
+    try:
+        job = {"ref": "ref.tif", "target": "target.tif"}
+        first, second = client.submit(job), client.submit(job)
+        # the single worker holds the first job, so the second is still queued
+        assert client.status(first, wait=0.2)["status"] == "running"
+        assert client.cancel(second)["canceled"]
+        release.set()
+        assert client.status(first, wait=60)["status"] == "ok"
+        assert client.status(second)["status"] == "canceled"
+        assert client.health()["jobs"] == {"ok": 1, "canceled": 1}
+        with pytest.raises(RuntimeError, match="400"):
+            client._request("GET", "/jobs/{}?wait=soon".format(first))
+        # negative and NaN waits do not wait
+        assert client.status(first, wait=-5)["status"] == "ok"
+        assert client.status(first, wait="nan")["status"] == "ok"
+    finally:
+        release.set()
+        _stop(service, server)
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from osgeo import gdal
+
+from ArrNorm.core import tiled
+from ArrNorm.core.arrnorm import Normalization
+
+
+def test_parse_tiles():
+    assert tiled.parse_tiles(None) is None
+    assert tiled.parse_tiles(4) == (4, 4)
+    assert tiled.parse_tiles("3x5") == (3, 5)
+    assert tiled.parse_tiles([2, 6]) == (2, 6)
+    with pytest.raises(ValueError):
+        tiled.parse_tiles("0x3")
+    assert tiled.tile_edges(10, 3) == [0, 3, 6, 10]
+
+
+def test_tiles_without_enough_pixels_take_their_neighbors():
+    def fit(row, col, pixels, slope):
+        return tiled.TileFit(row, col, (0, 0, 1, 1), np.zeros(1), np.full(1, slope), np.ones(1), pixels)
+
+    grid = [[fit(0, 0, 1000, 1.0), fit(0, 1, 10, 9.0), fit(0, 2, 3000, 2.0)],
+            [fit(1, 0, 0, 9.0), fit(1, 1, 10, 9.0), fit(1, 2, 10, 9.0)]]
+    grid[1][0].error = "singular"
+    tiled.fill_from_neighbors(grid, min_pixels=100)
+    assert [t.usable for t in grid[0]] == [True, False, True]
+    # pixel-weighted mean of the usable tiles of the nearest ring
+    np.testing.assert_allclose(grid[0][1].slopes, [(1000 * 1.0 + 3000 * 2.0) / 4000])
+    np.testing.assert_allclose(grid[1][0].slopes, [1.0])
+    with pytest.raises(ValueError, match="no tile"):
+        tiled.fill_from_neighbors(grid, min_pixels=10 ** 6)
+
+
+def test_tiled_follows_a_gradient_without_seams(tmp_path, scene, write_raster):
+    # the gain rises from 0.7 to 1.0 across the columns
+    ref, tgt, changed = scene(rows=240, cols=240, gain=0.7 + 0.3 * np.arange(240) / 240, offset=100)
+    write_raster(tmp_path / "ref.tif", ref)
+    write_raster(tmp_path / "tgt.tif", tgt)
+    output, grid = tiled.main(str(tmp_path / "ref.tif"), str(tmp_path / "tgt.tif"), str(tmp_path / "out.tif"),
+                              "2x4", min_pixels=200, workers=2, block_rows=50, feedback=None)
+    assert len(grid) == 2 and len(grid[0]) == 4 and all(t.usable for row in grid for t in row)
+    out = gdal.Open(output).ReadAsArray()
+    error = np.abs(out - ref)[:, ~changed].mean()
+
+    # one global fit, as the untiled pipeline does
+    output, grid = tiled.main(str(tmp_path / "ref.tif"), str(tmp_path / "tgt.tif"), str(tmp_path / "one.tif"),
+                              1, feedback=None)
+    global_error = np.abs(gdal.Open(output).ReadAsArray() - ref)[:, ~changed].mean()
+    assert error < global_error / 3
+
+    # the interpolated slopes change smoothly from column to column
+    row = [tiled.TileFit(0, j, None, np.zeros(1), np.full(1, float(j))) for j in range(4)]
+    field = tiled.CoefficientField([row], [0, 60, 120, 180, 240], [0, 240], 240)
+    _a, b = field.block(0, 1)
+    assert b[0, 0, 0] == 0 and b[0, 0, -1] == 3
+    assert np.diff(b[0, 0]).max() <= 1 / 60 + 1e-12
+
+
+def test_tiled_keeps_nodata_with_a_grid_larger_than_the_raster(tmp_path, scene, write_raster):
+    ref, tgt, changed = scene(rows=3, cols=200)
+    tgt[:, :, :10] = 0
+    ref_path = write_raster(tmp_path / "ref.tif", ref)
+    tgt_path = write_raster(tmp_path / "tgt.tif", tgt, nodata=0)
+
+    # more tile rows than pixel rows: one row of tiles per pixel row, 100 pixels each
+    output, grid = tiled.main(ref_path, tgt_path, str(tmp_path / "out.tif"), "500x2", ncp_threshold=0.5,
+                              min_pixels=20, block_rows=2, feedback=None)
+    assert len(grid) == 3 and len(grid[0]) == 2
+    ds = gdal.Open(output)
+    assert all(ds.GetRasterBand(k + 1).GetNoDataValue() == 0 for k in range(3))
+    out = ds.ReadAsArray()
+    assert (out[:, :, :10] == 0).all() and (out[:, :, 10:] != 0).all()
+    same = ~changed
+    same[:, :10] = False
+    assert np.abs(out - ref)[:, same].mean() < 10
+
+    class Feedback:
+        def pushInfo(self, msg):
+            pass
+
+    # the pipeline plans the tile workers for the grid tiled.main will use
+    norm = Normalization(ref_path, tgt_path, 30, 0.99, 0.95, False, False, None, False, None, False,
+                         str(tmp_path / "norm.tif"), Feedback(), tuning_profile=False, memory_budget="64M",
+                         tiles="500x100000", tile_workers=4)
+    assert norm.tiles == (3, 200)
+    assert norm.tile_bytes() >= 1 and 1 <= norm.tile_workers <= 4